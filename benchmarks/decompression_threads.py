@@ -0,0 +1,63 @@
+"""
+Benchmarks the time needed to lay out and render a BAM track using different numbers of 
+bam/cram decompression threads.
+
+Usage:
+    python decompression_threads.py [bam_path chrom start end] [--threads 1 2 4 8] [--repeats 3]
+
+By default, the illumina example bam from examples/data is used; speedups are most 
+noticeable for deep bams or crams and large windows.
+"""
+
+import argparse
+import os
+import time
+
+import genomeview
+
+
+def time_render(bam_path, chrom, start, end, threads, repeats):
+    timings = []
+    for _ in range(repeats):
+        genomeview.utilities.alignment_file_pool.clear()
+
+        doc = genomeview.Document(900)
+        view = genomeview.GenomeView(chrom, start, end, "+")
+        doc.add_view(view)
+
+        track = genomeview.SingleEndBAMTrack(bam_path)
+        track.threads = threads
+        track.draw_mismatches = False
+        track.level_of_detail = "rects"
+        view.add_track(track)
+
+        t0 = time.time()
+        for _ in doc.render():
+            pass
+        timings.append(time.time() - t0)
+
+    return min(timings)
+
+
+def main():
+    example_bam = os.path.join(os.path.dirname(__file__), "..", "examples", "data", "illumina.chr14.bam")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bam_path", nargs="?", default=example_bam)
+    parser.add_argument("chrom", nargs="?", default="14")
+    parser.add_argument("start", nargs="?", type=int, default=66900000)
+    parser.add_argument("end", nargs="?", type=int, default=66920000)
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 2, 4, 8])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    baseline = None
+    for threads in args.threads:
+        elapsed = time_render(args.bam_path, args.chrom, args.start, args.end, threads, args.repeats)
+        if baseline is None:
+            baseline = elapsed
+        print("threads={:<3} {:8.3f}s  speedup {:.2f}x".format(threads, elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,8 +11,9 @@ from genomeview.bamtrack import *
 from genomeview.bedtrack import BEDTrack
 from genomeview.graphtrack import *
 from genomeview.intervaltrack import *
+from genomeview.readfilter import ReadFilter
 
-from genomeview.export import render_to_file, save
+from genomeview.export import render_to_file, render_to_pdf, render_to_png, save
 
 from genomeview.convenience import visualize_data
-from genomeview.utilities import get_one_track
+from genomeview.utilities import get_one_track, set_decompression_threads
@@ -1,19 +1,107 @@
 import collections
+import collections.abc
 import logging
-import pysam
+import numpy
+import re
 
 import os
+import random
 
 from genomeview.track import Track
 from genomeview.intervaltrack import Interval, IntervalTrack
 from genomeview import MismatchCounts
-from genomeview.utilities import match_chrom_format
+from genomeview.utilities import expand_ranges, match_chrom_format, open_alignment_file
 from genomeview.graphtrack import GraphTrack
+from genomeview.readbatch import PairIndex, ReadBatch, READ1, REVERSE, SECONDARY, UNMAPPED
+from genomeview.readfilter import ReadFilter
 
 
+MD_TOKEN = re.compile(r"(\d+)|(\^[A-Za-z]+)|([A-Za-z])")
+
+# CIGAR operations (M, D, = and X) described by the MD tag
+IN_MD_TAG = numpy.zeros(16, dtype=bool)
+IN_MD_TAG[[0, 2, 7, 8]] = True
+
 def allreads(read):
     return True
 
+def downsample_reads(reads, max_depth, seed=0, key=None):
+    """
+    Deterministically downsamples reads so that at most ``max_depth`` reads cover any position. 
+    Reads are considered in a seeded random order, and each is kept only if fewer than 
+    ``max_depth`` of the reads kept so far overlap it.
+
+    Args:
+        reads: list of reads (pysam.AlignedSegment)
+        max_depth: maximum number of reads (or units, see ``key``) covering any position
+        seed: seed for the random number generator
+        key: optional function mapping a read to the unit that is sampled; all reads 
+            sharing a unit (eg ``key=lambda read: read.query_name`` for read pairs) are 
+            kept or dropped together, and a unit covers the whole span of its reads
+
+    Returns:
+        a tuple (list of reads kept, number of reads dropped)
+    """
+    units = []
+    spans = {}
+    for i, read in enumerate(reads):
+        unit = key(read) if key else i
+        units.append(unit)
+
+        start = read.reference_start
+        end = max(read.reference_end or start, start+1)
+        span = spans.get(unit)
+        if span is None:
+            spans[unit] = [start, end]
+        else:
+            span[0], span[1] = min(span[0], start), max(span[1], end)
+
+    if not spans:
+        return [], 0
+
+    order = list(spans)
+    random.Random(seed).shuffle(order)
+
+    offset = min(start for start, end in spans.values())
+    depth = numpy.zeros(max(end for start, end in spans.values()) - offset, dtype=numpy.int32)
+
+    kept_units = set()
+    for unit in order:
+        start, end = spans[unit]
+        covered = depth[start-offset:end-offset]
+        if covered.max() < max_depth:
+            covered += 1
+            kept_units.add(unit)
+
+    kept = [read for read, unit in zip(reads, units) if unit in kept_units]
+    return kept, len(reads) - len(kept)
+
+class _IntervalRows(collections.abc.Mapping):
+    """
+    Read-only mapping from interval id to row, over the rows assigned to a batch of reads 
+    (or read pairs) during layout; used as ``intervals_to_rows`` by the bam tracks. The 
+    index by id is only built if the mapping is used.
+    """
+    def __init__(self, ids, rows):
+        self._ids = ids
+        self._rows = rows
+        self._index = None
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {id_:i for i, id_ in enumerate(self._ids())}
+        return self._index
+
+    def __getitem__(self, id_):
+        return int(self._rows[self._get_index()[id_]])
+
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __len__(self):
+        return len(self._rows)
+
+
 def color_by_strand(interval):
     # brightness = 0.2 + (cur_reads[0].mapq/40.0*0.8)
 
@@ -40,17 +128,51 @@ class SingleEndBAMTrack(IntervalTrack):
             mismatches wrt the reference genome are only shown when at least several reads support
             a variant at that position (useful when displaying high-error rate data types eg 
             pacbio). Only relevant if draw_mismatches is also True. (default: True)
+        max_consensus_bytes (int): the quick consensus is skipped (and all mismatches are shown) 
+            for windows whose counts could take more than this much memory, as estimated 
+            by :py:meth:`estimate_consensus_nbytes` from the depth and length of the reads 
+            (default: 256 MB).
         draw_mismatches (bool): whether to show mismatches with respect to the reference genome.
             (default: True).
+        use_md_tag (bool): whether to locate mismatches using the MD tag of reads, when present, 
+            rather than by comparing each read to the reference sequence (default: True). 
+            Either way, mismatches are only drawn if the view has a reference sequence.
 
         include_secondary (bool): whether to draw alignments specified as "secondary" in the BAM flags 
             (default: True).
         
+        read_filter: a :py:class:`genomeview.ReadFilter` specifying which reads should be 
+            included in the display, by mapping quality, flags, tags, read group or strand 
+            (default: None, show all reads).
         include_read_fn: callback function used to specify which reads should be included in 
             the display. The function takes as its only argument a read (pysam.AlignedSegment) 
             and returns True (yes, display the read) or False (no, don't display). If this 
-            function is not specified, by default all reads are shown.
+            function is not specified, by default all reads are shown. Prefer ``read_filter`` 
+            where possible, which is faster.
+
+        max_depth (int): if specified, reads are downsampled so that at most this many reads 
+            cover any position (default: None, show all reads), which also limits the number 
+            of rows. Read pairs are kept or dropped together by PairedEndBAMTrack. The number 
+            of reads hidden is shown in the track label.
+        downsample_seed: seed used to make the downsampling reproducible (default: 0).
+
+        level_of_detail (str): how reads are drawn; one of "full" (reads with mismatches, 
+            indels and clipping), "rects" (reads as plain rectangles), "density" (a heatmap
+            of the number of reads covering each pixel) or "coverage" (a coverage summary, 
+            without individual reads). By default ("auto"), the level is chosen from the number 
+            of bases per pixel of the current view using ``detail_thresholds``.
+        detail_thresholds (dict): maps "rects", "density" and "coverage" to the number of 
+            bases per pixel above which that level of detail is used in "auto" mode 
+            (default: 200, 500 and 5000, ie windows above about 180kb, 450kb and 4.5mb at a 
+            width of 900 pixels). Any level other than "full" is shown in the track label.
+        summary_height (float): height (pixels) of the "density" and "coverage" displays.
+
+        threads (int): number of threads used to decompress the bam/cram file (default: None, 
+            use the global setting from :py:func:`genomeview.utilities.set_decompression_threads`).
     """
+    # reads sharing a downsampling key are kept or dropped together
+    _downsample_key = None
+
     def __init__(self, bam_path, name=None):
         """
         Args:
@@ -61,9 +183,14 @@ class SingleEndBAMTrack(IntervalTrack):
         super().__init__([], name=name)
 
         self.bam_path = bam_path
-        self.bam = pysam.AlignmentFile(bam_path)
+        self.threads = None
         self.intervals = self
         self.mismatch_counts = None
+        self._region_reads = None
+        self._region_preloaded = False
+        self._shared_consensus = None
+        self._batch = None
+        self._batch_rows = None
         
         self.nuc_colors = {"A":"blue", "C":"orange", "G":"green", "T":"black", "N":"gray"}
         self.insertion_color = "purple"
@@ -71,7 +198,9 @@ class SingleEndBAMTrack(IntervalTrack):
         self.deletion_color = "cyan"
 
         self.quick_consensus = True
+        self.max_consensus_bytes = 256 * 2**20
         self.draw_mismatches = True
+        self.use_md_tag = True
         self.include_secondary = True
 
         self.min_indel_size = 0
@@ -80,9 +209,81 @@ class SingleEndBAMTrack(IntervalTrack):
         
         self.draw_read_labels = False
 
+        self.read_filter = None
         self.include_read_fn = allreads
         # self.color_fn = color_by_strand
-        
+
+        self.max_depth = None
+        self.downsample_seed = 0
+        self.downsampled_count = 0
+
+        self.level_of_detail = "auto"
+        self.detail_thresholds = {"rects":200, "density":500, "coverage":5000}
+        self.summary_height = 50
+        self.summary_color = "gray"
+        self._detail = "full"
+        self._summary_depths = None
+
+    @property
+    def bam(self):
+        return open_alignment_file(self.bam_path, self.threads)
+
+    def fetch_region(self):
+        """
+        Returns a list of all reads overlapping the current view.
+
+        The region is decoded from the bam file only once and the resulting reads are 
+        shared by the quick consensus and :py:meth:`fetch_batch`, until the batch has been 
+        created or :py:meth:`release_region` is called (this happens automatically once the 
+        track has been rendered).
+        """
+        chrom = self.match_chrom_format(self.scale.chrom)
+        key = (self.bam_path, chrom, self.scale.start, self.scale.end)
+
+        if self._region_reads is None or self._region_reads[0] != key:
+            reads = list(self.bam.fetch(chrom, self.scale.start, self.scale.end))
+            self._region_reads = (key, reads)
+
+        return self._region_reads[1]
+
+    def release_region(self):
+        """
+        Frees the reads cached by :py:meth:`fetch_region`.
+        """
+        self._region_reads = None
+        self._region_preloaded = False
+        self._shared_consensus = None
+        self._batch = None
+
+    def preload_region(self, scale, reads, shared_consensus=None):
+        """
+        Provides the reads for the view ``scale`` up front, so that the track does not 
+        decode the region from the bam file itself (used by :py:class:`GroupedBAMTrack` to 
+        partition the reads of a region in a single pass).
+
+        Args:
+            scale: the :py:class:`genomeview.Scale` that the track will be laid out with
+            reads: list of reads to display
+            shared_consensus: optional :py:class:`SharedConsensus`, used for the quick 
+                consensus instead of tallying ``reads``
+        """
+        chrom = self.match_chrom_format(scale.chrom)
+        self._region_reads = ((self.bam_path, chrom, scale.start, scale.end), reads)
+        self._region_preloaded = True
+        self._shared_consensus = shared_consensus
+
+    def stream_region(self):
+        """
+        Iterator over the reads overlapping the current view, reading from the cache 
+        populated by :py:meth:`fetch_region` if present, or otherwise streaming 
+        directly from the bam file (without caching).
+        """
+        if self._region_reads is not None:
+            yield from self.fetch_region()
+        else:
+            chrom = self.match_chrom_format(self.scale.chrom)
+            yield from self.bam.fetch(chrom, self.scale.start, self.scale.end)
+
     def fetch(self):
         """
         Iterator over reads from the bam file
@@ -90,19 +291,58 @@ class SingleEndBAMTrack(IntervalTrack):
         Overload this method in subclasses to feed this track reads from a different source
         (for example, reads that are already in memory, rather than being read from a file).
         """
-        chrom = self.match_chrom_format(self.scale.chrom)
-        start, end = self.scale.start, self.scale.end
-        
-        for read in self.bam.fetch(chrom, start, end):
-            if not self.include_read_fn or self.include_read_fn(read):
-                yield read
+        for i, read in self._fetch_numbered():
+            yield read
+
+    def _fetch_numbered(self):
+        """
+        The reads of :py:meth:`fetch`, as (number, read) tuples. Reads are numbered among all 
+        the reads of the region that pass ``include_read_fn``, before ``read_filter`` and 
+        downsampling are applied, so that the ids of the reads' intervals (name + number) 
+        don't depend on the filters.
+        """
+        reads = [read for read in self.fetch_region() 
+                 if not self.include_read_fn or self.include_read_fn(read)]
+
+        read_filter = self.get_read_filter()
+        numbered = [(i, read) for i, read in enumerate(reads) if read_filter(read)]
+
+        self.downsampled_count = 0
+        if self.max_depth is not None:
+            kept, self.downsampled_count = downsample_reads(
+                [read for i, read in numbered], self.max_depth, self.downsample_seed, self._downsample_key)
+            kept = set(map(id, kept))
+            numbered = [(i, read) for i, read in numbered if id(read) in kept]
+
+        return numbered
+
+    def _numbered_reads(self):
+        if type(self).fetch is not SingleEndBAMTrack.fetch:
+            # fetch() has been overloaded to provide reads from elsewhere
+            return list(enumerate(self.fetch()))
+        return self._fetch_numbered()
         
+    def get_read_filter(self):
+        """
+        Returns the :py:class:`genomeview.ReadFilter` used to select the reads to display:
+        ``read_filter`` (if specified), also excluding unmapped reads and, unless 
+        ``include_secondary`` is True, secondary alignments.
+        """
+        read_filter = self._visible_filter()
+        if self.read_filter is not None:
+            read_filter = read_filter.combine(self.read_filter)
+        return read_filter
+
+    def _visible_filter(self):
+        exclude_flags = UNMAPPED
+        if not self.include_secondary:
+            exclude_flags |= SECONDARY
+        return ReadFilter(exclude_flags=exclude_flags)
+
     def __iter__(self):
-        c = 0
-        for i, read in enumerate(self.fetch()):
-            c += 1
-            if read.is_unmapped: continue
-            if read.is_secondary and not self.include_secondary: continue
+        visible = self._visible_filter()
+        for i, read in self._numbered_reads():
+            if not visible(read): continue
             id_ = read.query_name + str(i)
             interval = Interval(id_, self.scale.chrom, read.reference_start, read.reference_end, 
                                 not read.is_reverse)
@@ -111,65 +351,368 @@ class SingleEndBAMTrack(IntervalTrack):
                 interval.label = read.query_name
             yield interval
 
+    def fetch_batch(self):
+        """
+        Returns the reads displayed in the current view (see :py:meth:`fetch`) as a 
+        :py:class:`genomeview.readbatch.ReadBatch`. The batch is created when the track is 
+        laid out, and freed once the track has been rendered; the reads decoded by 
+        :py:meth:`fetch_region` are released as soon as the batch exists, so that only the 
+        batch holds on to the displayed reads (reads provided by :py:meth:`preload_region` 
+        belong to the caller and are kept).
+        """
+        if self._batch is None:
+            numbered = self._numbered_reads()
+            batch = ReadBatch.from_reads([read for i, read in numbered], 
+                                         index=numpy.array([i for i, read in numbered], dtype=numpy.int64))
+
+            # in case fetch() has been overloaded to provide reads from elsewhere
+            visible = self._visible_filter().mask(batch)
+            if not visible.all():
+                batch = batch.take(visible)
+
+            self._batch = batch
+            if not self._region_preloaded:
+                self._region_reads = None
+        return self._batch
+
     def match_chrom_format(self, chrom):
         """
         Ensures that the input argument `chrom` matches the chromosome name formatting in
         the bam file being visualized (ie "chr14" vs "14").
         """
         return match_chrom_format(chrom, self.bam.references)
+
+    def get_label(self):
+        notes = []
+        if self._detail != "full":
+            notes.append("level of detail: {}".format(self._detail))
+        if self.downsampled_count:
+            notes.append("{:,} reads hidden by downsampling".format(self.downsampled_count))
+
+        if not notes:
+            return self.name
+        note = "; ".join(notes)
+        if self.name is None:
+            return note
+        return "{} ({})".format(self.name, note)
         
+    def get_level_of_detail(self):
+        """
+        Returns the level of detail used to draw the current view (see ``level_of_detail``).
+        """
+        if self.level_of_detail != "auto":
+            return self.level_of_detail
+
+        detail = "full"
+        for level in ["rects", "density", "coverage"]:
+            if self.scale.bases_per_pixel > self.detail_thresholds[level]:
+                detail = level
+        return detail
+
     def layout(self, scale):
-        super().layout(scale)
+        self.scale = scale
+        self._detail = self.get_level_of_detail()
+        self.downsampled_count = 0
+
+        if self._detail in ["density", "coverage"]:
+            self.layout_summary()
+            return
+
         self.reset_mismatch_counts()
+        self.reset_rows()
+        self._batch = None
+        self.layout_batch(self.fetch_batch())
+
+    def layout_batch(self, batch):
+        """
+        Assigns each read in the batch to a row.
+        """
+        starts = self.scale.topixels(batch.start)
+        ends = self.scale.topixels(batch.end) + self.margin_x
+        if self.draw_read_labels:
+            ends += numpy.array([len(name) for name in batch.names]) * self.row_height * 0.75
+
+        place = self.row_packer.place
+        self._batch_rows = numpy.array(
+            [place(start, end) for start, end in zip(starts.tolist(), ends.tolist())], dtype=numpy.int64)
+        names, index = batch.names, batch.index
+        self.intervals_to_rows = _IntervalRows(
+            lambda: (name + str(i) for name, i in zip(names, index.tolist())), self._batch_rows)
+
+        self.height = (len(self.rows)+1) * (self.row_height+self.margin_y)
+
+    def layout_summary(self):
+        """
+        Computes the mean read depth within each pixel of the view, streaming over the 
+        reads once (without caching them or laying them out individually).
+        """
+        start, end = self.scale.start, self.scale.end
+        length = end - start
+
+        read_filter = self.get_read_filter()
+        read_starts = []
+        read_ends = []
+        for read in self.stream_region():
+            if not read_filter(read): continue
+            if self.include_read_fn and not self.include_read_fn(read): continue
+            read_starts.append(read.reference_start)
+            read_ends.append(read.reference_end)
+
+        depth = coverage_depth(read_starts, read_ends, start, end)
+
+        n_bins = max(1, min(int(self.scale.pixel_width), length))
+        edges = (numpy.arange(n_bins+1) * length) // n_bins
+        self._summary_depths = numpy.add.reduceat(depth, edges[:-1]) / numpy.diff(edges)
+
+        self.height = self.summary_height
 
     def reset_mismatch_counts(self):
-        if self.quick_consensus and self.draw_mismatches:
-            self.mismatch_counts = MismatchCounts(
-                self.scale.chrom, self.scale.start, self.scale.end)
+        self.mismatch_counts = None
+        if self.quick_consensus and self.draw_mismatches and self._detail == "full":
+            if self._shared_consensus is not None:
+                reads = self._shared_consensus.reads
+            else:
+                reads = self.fetch_region()
+
+            length = self.scale.end - self.scale.start
+            nbytes = self.estimate_consensus_nbytes(reads)
+            if nbytes > self.max_consensus_bytes:
+                logging.warning(
+                    "Skipping quick consensus for {:,}bp window: would need about {:.0f}MB "
+                    "(max_consensus_bytes is {:.0f}MB)".format(
+                        length, nbytes/2**20, self.max_consensus_bytes/2**20))
+                return
+
+            if self._shared_consensus is not None:
+                self.mismatch_counts = self._shared_consensus.get()
+            else:
+                self.mismatch_counts = MismatchCounts(
+                    self.scale.chrom, self.scale.start, self.scale.end)
+                self.mismatch_counts.tally_alignments(reads)
+
+    def estimate_consensus_nbytes(self, reads):
+        """
+        Estimates the memory needed to tally the quick consensus of the current view from 
+        ``reads``, given their depth and number of aligned bases (see 
+        :py:meth:`genomeview.MismatchCounts.estimate_nbytes`).
+        """
+        mapped = [read for read in reads if not read.is_unmapped]
+        depth = coverage_depth([read.reference_start for read in mapped], [read.reference_end for read in mapped], 
+                               self.scale.start, self.scale.end)
+        max_depth = int(depth.max()) if len(depth) else 0
+        aligned_bases = sum(read.query_alignment_length for read in mapped)
 
-            # workaround for some quirk of pysam with crams and large cigars
-            # (or something like that, opening a fresh file handle seems to fix the issue)
-            bam = pysam.AlignmentFile(self.bam_path)
-            self.mismatch_counts.tally_reads(bam)
+        return MismatchCounts.estimate_nbytes(self.scale.end-self.scale.start, max_depth, aligned_bases)
 
     def layout_interval(self, interval):
         super().layout_interval(interval)
 
+    def render(self, renderer):
+        if self._detail in ["density", "coverage"]:
+            yield from self.render_summary(renderer)
+        elif self._detail == "rects":
+            batch = self.fetch_batch()
+            yield from self.draw_read_rects(renderer, batch, numpy.arange(len(batch)), self._batch_rows)
+            yield from self.render_label(renderer)
+        else:
+            batch = self.fetch_batch()
+            for i in range(len(batch)):
+                label = batch.names[i] if self.draw_read_labels else None
+                interval = self._read_interval(batch, i, batch.names[i] + str(batch.index[i]), label)
+                interval.row = int(self._batch_rows[i])
+                yield from self.draw_interval(renderer, interval)
+
+            yield from self.render_label(renderer)
+        self.release_region()
+
+    def draw_read_rects(self, renderer, batch, indices, rows):
+        """
+        Draws the reads at ``indices`` of the batch as plain rectangles (the "rects" level 
+        of detail) in the given rows, all at once.
+        """
+        colors = [self.color_fn(self._read_interval(batch, i, batch.names[i] + str(batch.index[i])))
+                  for i in indices.tolist()]
+
+        starts = self.scale.topixels(batch.start[indices])
+        ends = self.scale.topixels(batch.end[indices])
+        tops = rows*(self.row_height+self.margin_y)
+
+        yield from renderer.rects(starts, tops, ends-starts, self.row_height, fill=colors, stroke="none")
+
+    def _read_interval(self, batch, i, id_, label=None):
+        interval = Interval(id_, self.scale.chrom, int(batch.start[i]), int(batch.end[i]), 
+                            not (batch.flag[i] & REVERSE), label)
+        interval.read = batch.reads[i] if batch.reads is not None else None
+        interval.batch_index = i
+        return interval
+
+    def get_row(self, interval):
+        row = getattr(interval, "row", None)
+        if row is None:
+            return super().get_row(interval)
+        return row
+
+    def render_summary(self, renderer):
+        """
+        Draws the per-pixel read depths, either as a heatmap ("density") or as a coverage 
+        plot ("coverage").
+        """
+        depths = self._summary_depths
+        max_depth = max(depths.max(), 1)
+        bin_width = self.scale.pixel_width / len(depths)
+
+        if self._detail == "density":
+            shades = numpy.round(255 - 215 * depths / max_depth).astype(int)
+        else:
+            shades = numpy.round(depths / max_depth * (self.summary_height-20) * 2) / 2
+
+        # draw runs of bins with the same shade/height as single elements
+        run_starts = numpy.flatnonzero(numpy.diff(shades, prepend=numpy.nan))
+        run_ends = numpy.append(run_starts[1:], len(shades))
+
+        xs = run_starts * bin_width
+        widths = (run_ends - run_starts) * bin_width
+        shades = shades[run_starts]
+
+        if self._detail == "density":
+            shown = shades != 255
+            colors = ["rgb({0},{0},{0})".format(shade) for shade in shades[shown].tolist()]
+            yield from renderer.rects(xs[shown], 20, widths[shown], self.summary_height-20, 
+                                      fill=colors, stroke="none")
+        else:
+            shown = shades > 0
+            yield from renderer.rects(xs[shown], self.summary_height-shades[shown], widths[shown], shades[shown], 
+                                      fill=self.summary_color, stroke="none")
+
+        yield from renderer.text(self.scale.pixel_width-5, 14, "max depth: {:,.0f}".format(depths.max()), 
+                                 anchor="end", fill="gray")
+        yield from self.render_label(renderer)
+
     def draw_interval(self, renderer, interval):
         """
         Draw a read and then, if ``self.draw_mismatches`` is True, draw mismatches/indels 
         on top.
         """
+        if self._detail == "rects":
+            start = self.scale.topixels(interval.start)
+            end = self.scale.topixels(interval.end)
+            top = self.get_row(interval)*(self.row_height+self.margin_y)
+
+            yield from renderer.rect(start, top, end-start, self.row_height, 
+                                     fill=self.color_fn(interval), stroke="none")
+            return
+
         yield from super().draw_interval(renderer, interval)
 
         if self.draw_mismatches:
             yield from self._draw_cigar(renderer, interval)
 
-    def _draw_mismatch(self, renderer, length, genome_position, sequence_position, yoffset, alnseq):
-        extras = {"stroke":"none"}
+    def _find_mismatches_md(self, ops, lengths, op_ref, op_query, md):
+        """
+        Locates mismatches using the MD tag, given the CIGAR operations and lengths of a 
+        read and the reference and query coordinates where each operation starts; returns 
+        arrays of reference positions and query positions.
+        """
+        # aligned (M/=/X) and deleted blocks, in the order that the MD tag describes them
+        in_md = IN_MD_TAG[ops]
+        block_ref = op_ref[in_md]
+        block_query = numpy.where(ops == 2, -1, op_query)[in_md]
+        block_len = lengths[in_md]
+
+        md_offsets = []
+        offset = 0
+        for matches, deletion, mismatch in MD_TOKEN.findall(md):
+            if matches:
+                offset += int(matches)
+            elif deletion:
+                offset += len(deletion) - 1
+            else:
+                md_offsets.append(offset)
+                offset += 1
 
-        for i in range(length):
-            if genome_position+i < self.scale.start: continue
-            if genome_position+i >= self.scale.end: break
+        block_md_start = numpy.cumsum(block_len) - block_len
+        md_offsets = numpy.array(md_offsets, dtype=numpy.int64)
+        md_offsets = md_offsets[md_offsets < block_len.sum()]
 
-            alt = alnseq[sequence_position+i]
-            try:
-                ref = self.scale.get_seq(genome_position+i, genome_position+i+1)
-            except AssertionError:
-                logging.warn("Unable to get reference sequence; will not draw mismatches")
-                return
+        block = numpy.searchsorted(block_md_start, md_offsets, side="right") - 1
+        within = md_offsets - block_md_start[block]
+        block_query = block_query[block]
+        aligned = block_query >= 0
+
+        positions = block_ref[block] + within
+        return positions[aligned], (block_query + within)[aligned]
+
+    def _find_mismatches_reference(self, ops, lengths, op_ref, op_query, seq):
+        """
+        Locates mismatches by comparing the aligned bases of a read (given its CIGAR 
+        operations, as for :py:meth:`_find_mismatches_md`, and its sequence as an array 
+        of ascii codes) against the reference sequence; returns arrays of reference 
+        positions and query positions.
+        """
+        try:
+            reference = self.scale.get_seq_array()
+        except AssertionError:
+            logging.warn("Unable to get reference sequence; will not draw mismatches")
+            return None
+
+        aligned = ops == 0
+
+        positions = expand_ranges(op_ref[aligned], lengths[aligned])
+        query_positions = expand_ranges(op_query[aligned], lengths[aligned])
+
+        visible = (positions >= self.scale.start) & (positions < self.scale.end)
+        positions = positions[visible]
+        query_positions = query_positions[visible]
+
+        different = seq[query_positions] != reference[positions-self.scale.start]
+        return positions[different], query_positions[different]
+
+    def _find_mismatches(self, batch, i):
+        """
+        Returns the reference positions and mismatching bases (as a string) of read ``i`` 
+        of the batch, sorted by position. Uses the MD tag if present (and 
+        ``self.use_md_tag`` is True); otherwise, the read is compared to the reference 
+        sequence. No mismatches are returned if the view has no reference sequence.
+        """
+        if self.scale.source is None:
+            logging.warn("Unable to get reference sequence; will not draw mismatches")
+            return numpy.zeros(0, dtype=numpy.int64), ""
+
+        ops, lengths = batch.cigar(i)
+        op_ref, op_query = batch.cigar_positions(i)
+        seq = batch.sequence(i)
+
+        if self.use_md_tag and batch.md[i] is not None:
+            positions, query_positions = self._find_mismatches_md(ops, lengths, op_ref, op_query, batch.md[i])
+        else:
+            found = self._find_mismatches_reference(ops, lengths, op_ref, op_query, seq)
+            if found is None:
+                return numpy.zeros(0, dtype=numpy.int64), ""
+            positions, query_positions = found
+
+        return positions, seq[query_positions].tobytes().decode()
+
+    def _draw_mismatch(self, renderer, mismatch_positions, mismatch_bases, yoffset):
+        shown = []
+        for i, (genome_position, alt) in enumerate(zip(mismatch_positions.tolist(), mismatch_bases)):
+            if genome_position < self.scale.start: continue
+            if genome_position >= self.scale.end: break
+
+            if not self.mismatch_counts or alt=="N" or self.mismatch_counts.supported(alt, genome_position):
+                shown.append(i)
 
-            if alt != ref:
-                curstart = self.scale.topixels(genome_position+i)
-                curend = self.scale.topixels(genome_position+i+1)
+        if not shown: return
 
-                color = self.nuc_colors[alnseq[sequence_position+i]]
+        positions = mismatch_positions[shown]
+        curstart = self.scale.topixels(positions)
+        curend = self.scale.topixels(positions+1)
 
-                if not self.mismatch_counts or alt=="N" or self.mismatch_counts.query(alt, genome_position+i):
-                    width = max(curend-curstart, self.min_cigar_line_width)
-                    midpoint = (curstart+curend)/2
-                    yield from renderer.rect(midpoint-width/2, yoffset, width, self.row_height, fill=color, 
-                                             **extras)
+        colors = [self.nuc_colors[mismatch_bases[i]] for i in shown]
+
+        width = numpy.maximum(curend-curstart, self.min_cigar_line_width)
+        midpoint = (curstart+curend)/2
+        yield from renderer.rects(midpoint-width/2, yoffset, width, self.row_height, fill=colors, 
+                                  stroke="none")
 
     def _draw_deletion(self, renderer, length, genome_position, yoffset):
         extras = {"stroke":"none"}
@@ -253,41 +796,38 @@ class SingleEndBAMTrack(IntervalTrack):
         """
         draw mismatches/insertions/deletions and clipping
         """
-        read = interval.read
-        if read.is_secondary: return
+        batch = self.fetch_batch()
+        i = interval.batch_index
+        if batch.flag[i] & SECONDARY: return
         
         # min_width = 2
 
-        row = self.intervals_to_rows[interval.id]
+        row = self.get_row(interval)
         yoffset = row*(self.row_height+self.margin_y)
 
-        genome_position = read.reference_start
-        sequence_position = 0
-        alnseq = read.query_sequence
+        mismatch_positions, mismatch_bases = self._find_mismatches(batch, i)
 
-        for code, length in read.cigartuples:
-            length = int(length)
-            if code == 0: #"M":
-                yield from self._draw_mismatch(renderer, length, genome_position, sequence_position, yoffset, alnseq)
+        ops, lengths = batch.cigar(i)
+        op_ref, _ = batch.cigar_positions(i)
+
+        # the mismatches within each operation
+        first_mismatch = numpy.searchsorted(mismatch_positions, op_ref)
+        last_mismatch = numpy.searchsorted(mismatch_positions, op_ref+lengths)
 
-                sequence_position += length
-                genome_position += length
+        for code, length, genome_position, first, last in zip(
+                ops.tolist(), lengths.tolist(), op_ref.tolist(), first_mismatch.tolist(), last_mismatch.tolist()):
+            if code == 0: #"M":
+                yield from self._draw_mismatch(renderer, mismatch_positions[first:last], 
+                                               mismatch_bases[first:last], yoffset)
             elif code in [2,3]: #in "D":
                 # if not self.mismatch_counts or self.mismatch_counts.query("DEL", genome_position, genome_position+length+1):
                 yield from self._draw_deletion(renderer, length, genome_position, yoffset)
-
-                genome_position += length
             elif code == 1: # I
                 # if not self.mismatch_counts or self.mismatch_counts.query("INS", genome_position-2, genome_position+2):
                 yield from self._draw_insertion(renderer, length, genome_position, yoffset)
-
-                sequence_position += length
             elif code in [4, 5]: #"HS":
                 yield from self._draw_clipping(renderer, length, genome_position, yoffset)
 
-                if code == 4:
-                    sequence_position += length
-
 
 
 
@@ -303,60 +843,73 @@ class PairedEndBAMTrack(SingleEndBAMTrack):
 
         self.overlap_color = "lime"
 
+        self._pairs = None
+        self._pair_rows = None
+
+    @staticmethod
+    def _downsample_key(read):
+        return read.query_name
+
     def layout(self, scale):
         if scale == self.scale: return
         
         self.scale = scale
+        self._detail = self.get_level_of_detail()
+        self.downsampled_count = 0
+
+        if self._detail in ["density", "coverage"]:
+            self.layout_summary()
+            return
+
         self.reset_mismatch_counts()
-        
-        # for chrom, start, end in self.scale.regions():
-        chrom, start, end = self.scale.chrom, self.scale.start, self.scale.end
-        cur_read_coords = collections.defaultdict(list)
-
-        for read in self.fetch():
-            if read.is_unmapped: continue
-            cur_read_coords[read.query_name].append(
-                (read.reference_start, read.reference_end, read.next_reference_start, read.is_proper_pair))
-        
-        # a bit of hocus-pocus to deal with reads whose mates map outside of our region of interest
-        for pair in cur_read_coords.values():
-            if len(pair) == 1:
-                read_end = pair[0]
-                if read_end[3]:
-                    pair.append((read_end[2], read_end[2]))
-                pair.sort()
-
-        for read_name, coords in sorted(cur_read_coords.items(), key=lambda x: x[1]):
-            pair_start = coords[0][0]
-            pair_end = coords[-1][1]
-            interval = Interval(read_name, chrom, pair_start, pair_end)
-            if self.draw_read_labels:
-                interval.label = read_name
-            self.layout_interval(interval)
-            #self.intervals.append(interval)
-                
+        self.reset_rows()
+        self._batch = None
+        self._pairs = PairIndex(self.fetch_batch())
+        self.layout_pairs(self._pairs)
+
+    def layout_pairs(self, pairs):
+        """
+        Assigns each read pair to a row, in order of the pairs' coordinates.
+        """
+        order = pairs.order
+        starts = self.scale.topixels(pairs.start[order])
+        ends = self.scale.topixels(pairs.end[order]) + self.margin_x
+        if self.draw_read_labels:
+            ends += numpy.array([len(pairs.names[i]) for i in order]) * self.row_height * 0.75
+
+        place = self.row_packer.place
+        self._pair_rows = numpy.empty(len(pairs), dtype=numpy.int64)
+        self._pair_rows[order] = [place(start, end) for start, end in zip(starts.tolist(), ends.tolist())]
+        names = pairs.names
+        self.intervals_to_rows = _IntervalRows(lambda: names, self._pair_rows)
+
         self.height = (len(self.rows)+1) * (self.row_height+self.margin_y)
     
-    
-    def draw_read_pair(self, renderer, reads):
-        reads = [read for read in reads if not read.is_unmapped]
-        if len(reads) == 0: return
+    def draw_read_pair(self, renderer, batch, indices):
+        """
+        Draws the reads at ``indices`` of the batch (one or both ends of a read pair).
+        """
+        if len(indices) == 0: return
 
-        chrom = reads[0].reference_name
-        row = self.intervals_to_rows[reads[0].query_name]
+        first = indices[0]
+        pair = self._pairs.pair_of_read[first]
+        name = self._pairs.names[pair]
+        row = int(self._pair_rows[pair])
         
         pair_start = None
-        if len(reads) > 1:
-            pair_start = reads[0].reference_end
-            pair_end = reads[-1].reference_start
-        elif reads[0].is_proper_pair:
+        if len(indices) > 1:
+            pair_start = int(batch.end[first])
+            pair_end = int(batch.start[indices[-1]])
+        elif batch.proper_pair[first]:
             # some more hocus-pocus to deal with reads whose mates map outside of our region of interest
-            if reads[0].next_reference_start < reads[0].reference_start:
-                pair_start = reads[0].next_reference_start
-                pair_end = reads[0].reference_start
+            read_start = int(batch.start[first])
+            next_start = int(batch.next_start[first])
+            if next_start < read_start:
+                pair_start = next_start
+                pair_end = read_start
             else:
-                pair_start = reads[0].reference_start
-                pair_end = reads[0].next_reference_start
+                pair_start = read_start
+                pair_end = next_start
 
         if pair_start is not None:
             x1 = self.scale.topixels(pair_start)
@@ -365,51 +918,93 @@ class PairedEndBAMTrack(SingleEndBAMTrack):
 
             yield from renderer.line(x1, y, x2, y, **{"stroke-width":1, "stroke":"gray"})
         
-        for i, read_end in enumerate(reads):
-            interval = Interval(read_end.query_name, chrom, read_end.reference_start,
-                                read_end.reference_end, not read_end.is_reverse)
-            
+        for j, i in enumerate(indices):
+            label = None
             if self.draw_read_labels:
-                interval.label = "{}_{}".format(read_end.query_name, 1 if read_end.is_read1 else 2)
+                label = "{}_{}".format(name, 1 if batch.flag[i] & READ1 else 2)
 
-            interval.read = read_end
+            interval = self._read_interval(batch, i, name, label)
+            interval.row = row
 
             yield from self.draw_interval(renderer, interval)
 
-            if i == 1 and self.draw_read_labels:
-                end = self.scale.topixels(read_end.reference_end)
+            if j == 1 and self.draw_read_labels:
+                end = self.scale.topixels(interval.end)
                 top = row*(self.row_height+self.margin_y)
 
                 yield from renderer.text(end+self.label_distance, top+self.row_height,
-                                         read_end.query_name, anchor="start")
+                                         name, anchor="start")
+
+
+    def draw_pair_rects(self, renderer, batch):
+        """
+        Draws all read pairs at the "rects" level of detail: first the lines connecting 
+        mates, then the reads themselves (as in :py:meth:`draw_read_pair`).
+        """
+        pair_rows = self._pair_rows[self._pairs.pair_of_read]
+
+        units = self._pairs.units()
+        first = numpy.array([unit[0] for unit in units if len(unit) == 2], dtype=numpy.int64)
+        second = numpy.array([unit[1] for unit in units if len(unit) == 2], dtype=numpy.int64)
+
+        # reads whose mates map outside of our region of interest
+        singles = numpy.array([unit[0] for unit in units if len(unit) == 1], dtype=numpy.int64)
+        singles = singles[batch.proper_pair[singles]]
+
+        line_starts = numpy.concatenate([batch.end[first], 
+            numpy.minimum(batch.start[singles], batch.next_start[singles])])
+        line_ends = numpy.concatenate([batch.start[second],
+            numpy.maximum(batch.start[singles], batch.next_start[singles])])
+        line_rows = numpy.concatenate([pair_rows[first], pair_rows[singles]])
+
+        ys = line_rows*(self.row_height+self.margin_y) + self.row_height/2
+        yield from renderer.lines(self.scale.topixels(line_starts), ys, self.scale.topixels(line_ends), ys,
+                                  **{"stroke-width":1, "stroke":"gray"})
+
+        indices = numpy.array([i for unit in units for i in unit], dtype=numpy.int64)
+        yield from self.draw_read_rects(renderer, batch, indices, pair_rows[indices])
 
-            
     def render(self, renderer):
-        read_buffer = {}
-        for read in self.fetch():
-            if read.is_unmapped: continue
-            if read.query_name in read_buffer:
-                other_read = read_buffer.pop(read.query_name)
-                cur_reads = [other_read, read]
-            else:
-                read_buffer[read.query_name] = read
-                continue
-            
-            for read_end in cur_reads:
-                yield from self.draw_read_pair(renderer, cur_reads)
-                
-        for read_name, read in read_buffer.items():
-            yield from self.draw_read_pair(renderer, [read])
+        if self._detail in ["density", "coverage"]:
+            yield from self.render_summary(renderer)
+            self.release_region()
+            return
+
+        batch = self.fetch_batch()
+        if self._pairs is None:
+            self._pairs = PairIndex(batch)
+
+        if self._detail == "rects":
+            yield from self.draw_pair_rects(renderer, batch)
+        else:
+            for indices in self._pairs.units():
+                yield from self.draw_read_pair(renderer, batch, indices)
         
         for x in self.render_label(renderer):
             yield x
 
+        self._pairs = None
+        self.release_region()
 
 
-def _get_filter_fn(keyfn, value):
-    def filter_fn(read):
-        return keyfn(read) == value
-    return filter_fn
+
+class SharedConsensus:
+    """
+    A quick consensus (:py:class:`genomeview.MismatchCounts`) for a region that is shared by 
+    several tracks; the reads are only tallied the first time the consensus is needed.
+    """
+    def __init__(self, chrom, start, end, reads):
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.reads = reads
+        self._mismatch_counts = None
+
+    def get(self):
+        if self._mismatch_counts is None:
+            self._mismatch_counts = MismatchCounts(self.chrom, self.start, self.end)
+            self._mismatch_counts.tally_alignments(self.reads)
+        return self._mismatch_counts
 
 def get_group_by_tag_fn(tag):
     """
@@ -438,6 +1033,8 @@ class GroupedBAMTrack(Track):
         space_between (float): the amount of space (pixels) between groups. (Default: 10)
         category_label_fn: a function that nicely formats the category labels. Takes as argument
             the result of the keyfn and should return a string. (Default: render as string)
+        threads (int): number of threads used to decompress the bam/cram file; also used by 
+            the subtracks (default: None, use the global setting)
     """
     def __init__(self, bam_path, keyfn, bam_track_class, name=None):
         """
@@ -446,27 +1043,35 @@ class GroupedBAMTrack(Track):
         self.keyfn = keyfn
         self.bam_track_class = bam_track_class
         self.bam_path = bam_path
-        self.bam = pysam.AlignmentFile(bam_path)
+        self.threads = None
         self.subtracks = []
         
         self.space_between = 10
         self.category_label_fn = str
-        
+
+    @property
+    def bam(self):
+        return open_alignment_file(self.bam_path, self.threads)
+
     def layout(self, scale):
         self.scale = scale
         
-        categories = set()
         chrom = match_chrom_format(self.scale.chrom, self.bam.references)
-        
-        for read in self.bam.fetch(chrom, self.scale.start, self.scale.end):
-            category = self.keyfn(read)
-            categories.add(category)
-        
-        categories = sorted(categories)
+        reads = list(self.bam.fetch(chrom, self.scale.start, self.scale.end))
+
+        groups = collections.defaultdict(list)
+        for read in reads:
+            groups[self.keyfn(read)].append(read)
+
+        # all groups share a single quick consensus, built from all reads in the region
+        consensus = SharedConsensus(self.scale.chrom, self.scale.start, self.scale.end, reads)
+
         self.height = 0
-        for category in categories:
+        self.subtracks = []
+        for category in sorted(groups):
             cur_track = self.bam_track_class(self.bam_path, name=self.category_label_fn(category))
-            cur_track.include_read_fn = _get_filter_fn(self.keyfn, category)
+            cur_track.threads = self.threads
+            cur_track.preload_region(scale, groups[category], consensus)
             cur_track.layout(scale)
             self.height += cur_track.height + self.space_between
             
@@ -480,6 +1085,37 @@ class GroupedBAMTrack(Track):
             cury += subtrack.height + self.space_between
 
 
+def coverage_depth(block_starts, block_ends, start, end):
+    """
+    Computes the depth of coverage at each position in [start, end) from the start and end 
+    coordinates of aligned blocks (or whole reads), using a difference array.
+    """
+    length = end - start
+    block_starts = numpy.clip(numpy.asarray(block_starts, dtype=numpy.int64) - start, 0, length)
+    block_ends = numpy.clip(numpy.asarray(block_ends, dtype=numpy.int64) - start, 0, length)
+
+    depth = numpy.bincount(block_starts, minlength=length+1) - numpy.bincount(block_ends, minlength=length+1)
+    return numpy.cumsum(depth[:length])
+
+def coverage_runs(block_starts, block_ends, start, end):
+    """
+    Computes the depth of coverage at each position in [start, end) from aligned blocks.
+
+    Returns:
+        a tuple (x, y) of numpy arrays, where only the first and last position of each run of 
+        positions with identical coverage are kept
+    """
+    length = end - start
+    depth = coverage_depth(block_starts, block_ends, start, end)
+
+    changes = depth[1:] != depth[:-1]
+    keep = numpy.ones(length, dtype=bool)
+    keep[1:-1] = changes[:-1] | changes[1:]
+
+    x = numpy.arange(start, end)[keep]
+    return x, depth[keep]
+
+
 class BAMCoverageTrack(GraphTrack):
     def __init__(self, bam_path, name=None):
         if name is None:
@@ -487,33 +1123,25 @@ class BAMCoverageTrack(GraphTrack):
         super().__init__(name=name)
         
         self.bam_path = bam_path
-        self.bam = pysam.AlignmentFile(bam_path)
-        
-    def layout(self, scale):
-        import numpy as np
-        import pandas as pd
+        self.threads = None
+
+    @property
+    def bam(self):
+        return open_alignment_file(self.bam_path, self.threads)
 
+    def layout(self, scale):
         super().layout(scale)
 
         chrom = match_chrom_format(scale.chrom, self.bam.references)
-        counts = collections.defaultdict(int)
-        
+
+        block_starts = []
+        block_ends = []
         for read in self.bam.fetch(chrom, scale.start, scale.end):
-            for i in read.get_reference_positions():
-                counts[i] += 1
-        
-        x = np.arange(scale.start, scale.end+1)
-        y = []
-        for i, curx in enumerate(x):
-            y.append(counts[curx])
-        y = np.array(y)
-        
-        s = pd.Series(y, index=x).sort_index()
-        s = s[(s!=s.shift(-1))|(s!=s.shift(1))]
-        
-        x = s.index
-        y = s.values
-        
+            for block_start, block_end in read.get_blocks():
+                block_starts.append(block_start)
+                block_ends.append(block_end)
+
+        x, y = coverage_runs(block_starts, block_ends, scale.start, scale.end+1)
+
         if len(x):
             self.add_series(x, y)
-            
\ No newline at end of file
@@ -199,7 +199,7 @@ class BEDTrack(IntervalTrack):
             return
                     
         # print(1)
-        row = self.intervals_to_rows[interval.id]
+        row = self.get_row(interval)
         top = row*(self.row_height+self.margin_y)
         top_thin = top + self.row_height/2 - self.thin_width/2
         midline = top + self.row_height/2 - self.thinnest_width/2
@@ -236,6 +236,7 @@ class BEDTrack(IntervalTrack):
 
         # Draw the "exons", both thin (non-coding/UTR) and thick (coding)
         # print(interval, tx.exons)
+        exon_xs, exon_ys, exon_widths, exon_heights = [], [], [], []
         for which in ["thin", "thick"]:
             for cur_start, cur_end in tx.exons:
                 if which == "thick":
@@ -263,8 +264,13 @@ class BEDTrack(IntervalTrack):
                     cur_start -= self.min_exon_width / 2
                     width = self.min_exon_width
 
-                yield from renderer.rect(cur_start, cur_y, width, cur_width, fill=color, 
-                                         **{"stroke":"none", "id":temp_label})
+                exon_xs.append(cur_start)
+                exon_ys.append(cur_y)
+                exon_widths.append(width)
+                exon_heights.append(cur_width)
+
+        yield from renderer.rects(exon_xs, exon_ys, exon_widths, exon_heights, fill=color, 
+                                  **{"stroke":"none", "id":temp_label})
 
 
         if interval.label is not None:
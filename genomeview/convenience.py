@@ -23,14 +23,16 @@ def visualize_data(file_paths, chrom, start, end, reference_path=None,
         chrom: chromosome (or contig) to be rendered
         start: start coordinate of region to be rendered
         end: end coordinate of region to be rendered
-        reference_path: path to fasta file specifying reference genomic 
-            sequence. This is required in order to display mismatches
+        reference_path: path to fasta (or .2bit) file specifying reference 
+            genomic sequence. This is required in order to display mismatches
             in bam tracks.
         width: the pixel width of the document
         axis_on_top: specifies whether the axis should be added at the bottom
             (default) or at the top
     """
-    if reference_path is not None:
+    if reference_path is not None and reference_path.lower().endswith(".2bit"):
+        source = genomeview.TwoBitGenomeSource(reference_path)
+    elif reference_path is not None:
         source = genomeview.FastaGenomeSource(reference_path)
     else:
         source = None
@@ -56,11 +58,12 @@ def visualize_data(file_paths, chrom, start, end, reference_path=None,
         
     for name, path in zip(names, file_paths):
         if path.lower().endswith(".bam") or path.lower().endswith(".cram"):
-            if utilities.is_paired_end(path):
+            info = utilities.probe_alignment_file(path, chrom, start, end)
+            if info.paired:
                 cur_track = genomeview.PairedEndBAMTrack(path, name=name)
             else:
                 cur_track = genomeview.SingleEndBAMTrack(path, name=name)
-                if utilities.is_long_frag_dataset(path):
+                if info.long_reads:
                     cur_track.min_indel_size = 5
 
         elif path.lower().endswith(".bed") or path.lower().endswith(".bed.gz") or path.lower().endswith(".bigbed") or path.lower().endswith(".bb"):
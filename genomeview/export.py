@@ -1,18 +1,27 @@
-import logging
 import os
+import shutil
 import subprocess
-import sys
 import tempfile
 
+from genomeview.pdf import PDF
+from genomeview.raster import Raster, write_png
 
-def save(doc, outpath, outformat=None):
+
+def save(doc, outpath, outformat=None, converter=None):
     """
     Saves document `doc` to a file at `outpath`. By default, this file 
     will be in SVG format; if it ends with .pdf or .png, or if outformat
     is specified, the document will be converted to PDF or PNG if possible.
 
-    Conversion to PDF and PNG require rsvg-convert (provided by librsvg), 
-    inkscape or webkitToPDF (PDF conversion only).
+    By default, PDFs and PNGs are drawn directly (see :py:func:`render_to_pdf` and 
+    :py:func:`render_to_png`), without needing any external converter. In PDFs, all text 
+    is set in the built-in Helvetica fonts (whatever its font family), and aligned using 
+    Helvetica's glyph widths; characters outside the Windows-1252 character set are 
+    replaced by "?". PNGs use a small built-in bitmap font.
+
+    Alternatively, the document can be rendered as an SVG and converted by rsvg-convert 
+    (provided by librsvg), inkscape or webkitToPDF (PDF conversion only) by specifying 
+    ``converter``, eg to use other fonts.
 
     Attributes:
         doc: the :py:class:`genomeview.Document` to be saved
@@ -20,6 +29,9 @@ def save(doc, outpath, outformat=None):
             .pdf or .png will change the default output format
         outformat: override the file format; must be one of "pdf", "png", or
             (the default) "svg"
+        converter: None (the default) to draw PDFs and PNGs directly, or the external 
+            converter to use: one of "librsvg" (or "rsvg-convert"), "inkscape", 
+            "webkittopdf", or "auto" to use the first one that is installed
     """
     if isinstance(outpath, bytes):
         outpath = outpath.decode()
@@ -32,17 +44,26 @@ def save(doc, outpath, outformat=None):
         else:
             outformat = "svg"
 
+    if outformat not in ["svg", "png", "pdf"]:
+        raise ValueError("Unknown output format: {}".format(outformat))
+
     if outformat == "svg":
         with open(outpath, "w") as outf:
             render_to_file(doc, outf)
-    else:
+    elif converter is not None:
         # render to a temporary file then convert to PDF or PNG
         with tempfile.TemporaryDirectory() as outdir:
             temp_svg_path = os.path.join(outdir, "temp.svg")
             with open(temp_svg_path, "w") as outf:
                 render_to_file(doc, outf)
 
-            convert_svg(temp_svg_path, outpath, outformat)
+            convert_svg(temp_svg_path, outpath, outformat, converter)
+    elif outformat == "png":
+        with open(outpath, "wb") as outf:
+            render_to_png(doc, outf)
+    else:
+        with open(outpath, "wb") as outf:
+            render_to_pdf(doc, outf)
 
 
 
@@ -55,6 +76,36 @@ def render_to_file(doc, outf):
         outf.write(l + "\n")
 
 
+def render_to_png(doc, outf, scale=1.0, draw_text=True):
+    """
+    Renders the document as a png to a binary file-like object, without needing an 
+    external converter. ``scale`` is the number of pixels per unit of document width; 
+    if ``draw_text`` is False, text is skipped (see :py:class:`genomeview.raster.Raster`).
+    """
+    backend = Raster(scale=scale, draw_text=draw_text)
+    for l in doc.render(backend):
+        pass
+
+    write_png(backend.pixels(), outf)
+
+
+def render_to_pdf(docs, outf):
+    """
+    Renders the document as a pdf to a binary file-like object, without needing an 
+    external converter. ``docs`` can also be a list of documents, which are written 
+    as the pages of a single pdf.
+    """
+    if not isinstance(docs, (list, tuple)):
+        docs = [docs]
+
+    backend = PDF()
+    for doc in docs:
+        for l in doc.render(backend):
+            pass
+
+    backend.write(outf)
+
+
 
 
 #############################################################################
@@ -63,32 +114,34 @@ def render_to_file(doc, outf):
 
         
 
-def convert_svg(inpath, outpath, outformat):
-    converter = _getExportConverter(outformat)
+def convert_svg(inpath, outpath, outformat, converter="auto"):
+    """
+    Converts the svg file at ``inpath`` to a pdf or png file at ``outpath``, using an 
+    external converter (see :py:func:`save`).
+    """
+    outformat = outformat.lower()
+    converter = _getExportConverter(outformat, None if converter == "auto" else converter)
 
     if converter == "webkittopdf":
-        exportData = _convertSVG_webkitToPDF(inpath, outpath, outformat)
+        _convertSVG_webkitToPDF(inpath, outpath, outformat)
     elif converter == "librsvg":
-        exportData = _convertSVG_rsvg_convert(inpath, outpath, outformat)
+        _convertSVG_rsvg_convert(inpath, outpath, outformat)
     elif converter == "inkscape":
-        exportData = _convertSVG_inkscape(inpath, outpath, outformat)
-
-    return exportData
+        _convertSVG_inkscape(inpath, outpath, outformat)
 
 
 def _getExportConverter(exportFormat, requested_converter=None):
-    if requested_converter == "webkittopdf" and exportFormat=="png":
-        logging.error("webkitToPDF does not support export to PNG; use librsvg or inkscape instead, or "
-            "export to PDF")
-        sys.exit(1)
+    if requested_converter == "rsvg-convert":
+        requested_converter = "librsvg"
 
-    if exportFormat == "png" and requested_converter is None:
-        return "librsvg"
+    if requested_converter not in [None, "webkittopdf", "librsvg", "inkscape"]:
+        raise ValueError("Unknown converter: {}".format(requested_converter))
 
-    if requested_converter == "rsvg-convert":
-        return "librsvg"
+    if requested_converter == "webkittopdf" and exportFormat == "png":
+        raise ValueError("webkitToPDF does not support export to PNG; use librsvg or inkscape "
+                         "instead, or export to PDF")
 
-    if requested_converter in [None, "webkittopdf"]:
+    if requested_converter in [None, "webkittopdf"] and exportFormat == "pdf":
         if _checkWebkitToPDF():
             return "webkittopdf"
 
@@ -101,69 +154,33 @@ def _getExportConverter(exportFormat, requested_converter=None):
             return "inkscape"
 
     raise Exception("No converter found for conversion to {}".format(exportFormat))
-    return None
 
 
 
 def _checkWebkitToPDF():
-    try:
-        subprocess.check_call("webkitToPDF", stderr=subprocess.PIPE, shell=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return shutil.which("webkitToPDF") is not None
 
 def _checkRSVGConvert():
-    try:
-        subprocess.check_call("rsvg-convert -v", stdout=subprocess.PIPE, shell=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return shutil.which("rsvg-convert") is not None
 
 def _checkInkscape():
-    try:
-        subprocess.check_call("inkscape --version", stdout=subprocess.PIPE, shell=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return shutil.which("inkscape") is not None
 
 
 
 def _convertSVG_webkitToPDF(inpath, outpath, outformat):
-    if outformat.lower() != "pdf":
-        return None
-
-    try:
-        cmd = "webkitToPDF {} {}".format(inpath, outpath)
-        subprocess.check_call(cmd, shell=True)#, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError:
-        return None
-
-    return open(outpath, "rb").read()
+    subprocess.check_call(["webkitToPDF", inpath, outpath])
 
 def _convertSVG_inkscape(inpath, outpath, outformat):
-    options = ""
-    outformat = outformat.lower()
+    options = []
     if outformat == "png":
-        options = "--export-dpi 150 --export-background white"
-
-    try:
-        subprocess.check_call("inkscape {} {} --export-{}={}".format(options, inpath, outformat, outpath), 
-            shell=True)
-    except subprocess.CalledProcessError as e:
-        print("EXPORT ERROR:", str(e))
-
-    return open(outpath, "rb").read()
+        options = ["--export-dpi", "150", "--export-background", "white"]
 
+    subprocess.check_call(["inkscape"] + options + [inpath, "--export-{}={}".format(outformat, outpath)])
 
 def _convertSVG_rsvg_convert(inpath, outpath, outformat):
-    options = ""
-    outformat = outformat.lower()
+    options = []
     if outformat == "png":
-        options = "-a --background-color white"
-
-    try:
-        subprocess.check_call("rsvg-convert -f {} {} -o {} {}".format(outformat, options, outpath, inpath), shell=True)
-    except subprocess.CalledProcessError as e:
-        print("EXPORT ERROR:", str(e))
+        options = ["-a", "--background-color", "white"]
 
-    return open(outpath, "rb").read()
\ No newline at end of file
+    subprocess.check_call(["rsvg-convert", "-f", outformat] + options + ["-o", outpath, inpath])
@@ -5,10 +5,15 @@ Genome Sources are used to describe reference genomes, typically either on disk
 """
 
 import collections
+import numpy
+import struct
 
 from genomeview.utilities import match_chrom_format
 
 comp = str.maketrans('ATCGNatcgn','TAGCNtagcn')
+
+_COMPLEMENT = numpy.arange(256, dtype=numpy.uint8)
+_COMPLEMENT[numpy.frombuffer(b'ATCGNatcgn', dtype=numpy.uint8)] = numpy.frombuffer(b'TAGCNtagcn', dtype=numpy.uint8)
     
 def reverse_comp(st):
     """ Returns the reverse complement of a DNA sequence; non ACGT bases will be ignored. """
@@ -44,6 +49,146 @@ class GenomeSource(object):
 
 
 
+class ArrayGenomeSource(GenomeSource):
+    """
+    An in-memory genome source that stores all contigs in a single numpy array of ascii 
+    codes (rather than as python strings). :py:meth:`get_seq_array` returns read-only 
+    views of this array for forward-strand sequence, without copying.
+
+    Use :py:meth:`to_shared_memory` to move the genome into a shared-memory segment; 
+    pickling the resulting source (eg to send it to process-pool workers) only pickles 
+    the name of the segment, and each worker maps the same memory.
+
+    Args:
+        names_to_contigs: an ordered mapping of contig/chromosome names to their sequences 
+            (as str, bytes or numpy arrays of ascii codes)
+    """
+    def __init__(self, names_to_contigs, aligner_type="bwa"):
+        self._bwa = None
+        self._ssw = None
+        self._blacklist = None
+        self.aligner_type = aligner_type
+
+        self._offsets = collections.OrderedDict()
+        contigs = []
+        offset = 0
+        for name, seq in names_to_contigs.items():
+            if isinstance(seq, str):
+                seq = seq.encode("ascii")
+            seq = numpy.frombuffer(seq, dtype=numpy.uint8) if isinstance(seq, bytes) else \
+                  numpy.asarray(seq, dtype=numpy.uint8)
+            contigs.append(seq)
+            self._offsets[name] = (offset, len(seq))
+            offset += len(seq)
+
+        if contigs:
+            self._set_buffer(numpy.concatenate(contigs))
+        else:
+            self._set_buffer(numpy.zeros(0, dtype=numpy.uint8))
+        self._shm = None
+        self._owns_shm = False
+
+    def _set_buffer(self, buffer):
+        buffer.flags.writeable = False
+        self._buffer = buffer
+
+    def get_seq_array(self, chrom, start, end, strand):
+        """
+        Same as :py:meth:`get_seq`, but returns the sequence as a numpy array of ascii 
+        codes; forward-strand sequence is a read-only view of the genome.
+        """
+        chrom = match_chrom_format(chrom, self._offsets)
+        offset, length = self._offsets[chrom]
+
+        start = max(0, start)
+        end = max(start, min(end+1, length))
+        seq = self._buffer[offset+start:offset+end]
+
+        if strand == "-":
+            seq = _COMPLEMENT[seq[::-1]]
+        return seq
+
+    def get_seq(self, chrom, start, end, strand):
+        return self.get_seq_array(chrom, start, end, strand).tobytes().decode("ascii")
+
+    def keys(self):
+        return list(self._offsets.keys())
+
+    @property
+    def names_to_contigs(self):
+        return collections.OrderedDict(
+            (name, self._buffer[offset:offset+length]) for name, (offset, length) in self._offsets.items())
+
+    def to_shared_memory(self, name=None):
+        """
+        Copies the genome into a new shared-memory segment, and returns a source backed by 
+        that segment. The returned source owns the segment: call its :py:meth:`unlink` 
+        method once all processes are done with it.
+        """
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, len(self._buffer)))
+        shared = numpy.frombuffer(shm.buf, dtype=numpy.uint8, count=len(self._buffer))
+        shared[:] = self._buffer
+
+        source = ArrayGenomeSource({}, aligner_type=self.aligner_type)
+        source._offsets = collections.OrderedDict(self._offsets)
+        source._set_buffer(shared)
+        source._shm = shm
+        source._owns_shm = True
+        return source
+
+    def _attach(self, shm_name):
+        from multiprocessing import shared_memory
+
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name, track=False)
+        except TypeError:
+            # before python 3.13, attaching always registers the segment with the 
+            # resource tracker; this is harmless for multiprocessing workers, which share
+            # the tracker of the process that created the segment
+            shm = shared_memory.SharedMemory(name=shm_name)
+
+        size = sum(length for _, length in self._offsets.values())
+        self._set_buffer(numpy.frombuffer(shm.buf, dtype=numpy.uint8, count=size))
+        self._shm = shm
+
+    def close(self):
+        """ 
+        Detaches this process from the shared-memory segment, if any. Arrays previously 
+        returned by :py:meth:`get_seq_array` must no longer be in use.
+        """
+        if self._shm is not None:
+            self._buffer = None
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        """ Closes and removes the shared-memory segment created by :py:meth:`to_shared_memory`. """
+        shm = self._shm
+        self.close()
+        if shm is not None and self._owns_shm:
+            shm.unlink()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shm is not None:
+            state["_buffer"] = None
+            state["_shm"] = self._shm.name
+        state["_owns_shm"] = False
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop("_shm")
+        self.__dict__.update(state)
+        self._shm = None
+        if shm_name is not None:
+            self._attach(shm_name)
+        else:
+            self._set_buffer(self._buffer)
+
+
+
 class FastaGenomeSource(GenomeSource):
     """ 
     A genome source based on a Fasta file. 
@@ -51,20 +196,77 @@ class FastaGenomeSource(GenomeSource):
     This is essentially a pickle-able wrapper for pysam.FastaFile; 
     as such, it is capable of using indexed fasta files available
     via http/ftp/s3/etc.
+
+    Sequence is read from the fasta file in blocks of ``chunk_size`` nucleotides, 
+    aligned to multiples of ``chunk_size``, and the most recently used blocks are kept 
+    in memory (up to ``cache_bytes`` in total) so that nearby regions can be fetched 
+    without decoding them again. The cache is not pickled.
     """
-    def __init__(self, path):
+    def __init__(self, path, chunk_size=2**16, cache_bytes=64*2**20):
         self.path = path
         self._fasta = None
+
+        self.chunk_size = chunk_size
+        self.cache_bytes = cache_bytes
+        self._chunks = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._chrom_names = {}
+        self._references = None
         
     def get_seq(self, chrom, start, end, strand):
-        chrom = match_chrom_format(chrom, self.keys())
+        chrom = self.resolve_chrom(chrom)
         
-        # seq = self.fasta[chrom][start:end+1]
-        seq = self.fasta.fetch(chrom, start, end+1)
+        if (end + 1 - start) > self.cache_bytes // 2:
+            # don't flush the whole cache for a single large region
+            seq = self.fasta.fetch(chrom, start, end+1)
+        else:
+            first_chunk = start // self.chunk_size
+            last_chunk = end // self.chunk_size
+            seq = "".join(self._get_chunk(chrom, chunk_id)
+                          for chunk_id in range(first_chunk, last_chunk+1))
+            offset = first_chunk * self.chunk_size
+            seq = seq[start-offset:end+1-offset]
+
         if strand == "-":
             seq = reverse_comp(seq)
         return seq
 
+    def _get_chunk(self, chrom, chunk_id):
+        key = (chrom, chunk_id)
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+
+        chunk_start = chunk_id * self.chunk_size
+        chunk = self.fasta.fetch(chrom, chunk_start, chunk_start+self.chunk_size)
+
+        self._chunks[key] = chunk
+        self._cached_bytes += len(chunk)
+        while self._cached_bytes > self.cache_bytes:
+            _, evicted = self._chunks.popitem(last=False)
+            self._cached_bytes -= len(evicted)
+
+        return chunk
+
+    def clear_cache(self):
+        """ Removes all cached sequence. """
+        self._chunks = collections.OrderedDict()
+        self._cached_bytes = 0
+
+    def resolve_chrom(self, chrom):
+        """ 
+        Returns the name of ``chrom`` as used in the fasta file (eg "chr1" vs "1"; see 
+        :py:func:`genomeview.utilities.match_chrom_format`). 
+        """
+        if chrom not in self._chrom_names:
+            self._chrom_names[chrom] = match_chrom_format(chrom, self._reference_set())
+        return self._chrom_names[chrom]
+
+    def _reference_set(self):
+        if self._references is None:
+            self._references = frozenset(self.fasta.references)
+        return self._references
+
     def keys(self):
         return list(self.fasta.references)
 
@@ -80,4 +282,159 @@ class FastaGenomeSource(GenomeSource):
     def __getstate__(self):
         state = self.__dict__.copy()
         state["_fasta"] = None
+        state["_chunks"] = collections.OrderedDict()
+        state["_cached_bytes"] = 0
+        return state
+
+
+
+class TwoBitGenomeSource(GenomeSource):
+    """
+    A genome source based on a UCSC .2bit file, which is memory-mapped rather than read 
+    into memory; pages of the file are therefore shared between processes (eg workers 
+    rendering many regions in parallel), and only the parts of the genome that are 
+    displayed are ever read from disk.
+
+    Runs of Ns are returned as "N", and soft-masked (repeat) sequence is returned in 
+    lowercase, as in the corresponding fasta file. Only local files are supported.
+    """
+    _SIGNATURE = 0x1A412743
+    # the four bases encoded by each possible byte of packed sequence
+    _UNPACK = numpy.frombuffer(b"TCAG", dtype=numpy.uint8)[
+        (numpy.arange(256, dtype=numpy.uint8)[:, None] >> numpy.array([6, 4, 2, 0], dtype=numpy.uint8)) & 3]
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+        self._byteorder = "<"
+        self._offsets = None
+        self._contigs = {}
+        self._chrom_names = {}
+
+    @property
+    def twobit(self):
+        """ the memory-mapped .2bit file """
+        if self._mmap is None:
+            import mmap
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _read_ints(self, offset, count, width=4):
+        dtype = self._byteorder + ("u4" if width == 4 else "u8")
+        return numpy.frombuffer(self.twobit, dtype=dtype, count=count, offset=offset)
+
+    def _read_index(self):
+        if self._offsets is not None:
+            return self._offsets
+
+        signature = struct.unpack("<I", self.twobit[:4])[0]
+        if signature == self._SIGNATURE:
+            self._byteorder = "<"
+        elif struct.unpack(">I", self.twobit[:4])[0] == self._SIGNATURE:
+            self._byteorder = ">"
+        else:
+            raise ValueError("Not a 2bit file: {}".format(self.path))
+
+        version, count = self._read_ints(4, 2)
+        offset_width = 8 if version == 1 else 4
+
+        offsets = collections.OrderedDict()
+        position = 16
+        for i in range(count):
+            name_length = self.twobit[position]
+            name = self.twobit[position+1:position+1+name_length].decode()
+            position += 1 + name_length
+            offsets[name] = int(self._read_ints(position, 1, offset_width)[0])
+            position += offset_width
+
+        self._offsets = offsets
+        return offsets
+
+    def _get_contig(self, chrom):
+        """ returns (length, N blocks, mask blocks, offset of the packed sequence) """
+        if chrom in self._contigs:
+            return self._contigs[chrom]
+
+        position = self._read_index()[chrom]
+        length, n_count = self._read_ints(position, 2)
+        position += 8
+        n_blocks = self._read_ints(position, 2*n_count).reshape(2, n_count).astype(numpy.int64)
+        position += 8 * n_count
+        mask_count = self._read_ints(position, 1)[0]
+        position += 4
+        mask_blocks = self._read_ints(position, 2*mask_count).reshape(2, mask_count).astype(numpy.int64)
+        position += 8 * mask_count + 4 # skip reserved
+
+        # store blocks as (starts, ends)
+        n_blocks[1] += n_blocks[0]
+        mask_blocks[1] += mask_blocks[0]
+
+        contig = (int(length), n_blocks, mask_blocks, position)
+        self._contigs[chrom] = contig
+        return contig
+
+    @staticmethod
+    def _apply_blocks(seq, blocks, start, end, fn):
+        """ applies fn to the parts of seq (spanning start...end-1) within (start, end) blocks """
+        block_starts, block_ends = blocks
+
+        first = block_ends.searchsorted(start, side="right")
+        last = block_starts.searchsorted(end, side="left")
+        if first >= last:
+            return
+
+        if last - first < 32:
+            for block_start, block_end in zip(block_starts[first:last], block_ends[first:last]):
+                cur = slice(max(block_start, start) - start, min(block_end, end) - start)
+                seq[cur] = fn(seq[cur])
+        else:
+            size = end - start + 1
+            diff = numpy.bincount(numpy.maximum(block_starts[first:last], start) - start, minlength=size) \
+                 - numpy.bincount(numpy.minimum(block_ends[first:last], end) - start, minlength=size)
+            inside = numpy.cumsum(diff[:-1]) > 0
+            seq[inside] = fn(seq[inside])
+
+    def get_seq_array(self, chrom, start, end, strand):
+        """
+        Same as :py:meth:`get_seq`, but returns the sequence as a numpy array of ascii codes.
+        """
+        chrom = self.resolve_chrom(chrom)
+        length, n_blocks, mask_blocks, dna_offset = self._get_contig(chrom)
+
+        start = max(0, start)
+        end = min(end+1, length)
+        if end <= start:
+            return numpy.zeros(0, dtype=numpy.uint8)
+
+        packed = numpy.frombuffer(self.twobit, dtype=numpy.uint8, 
+                                  count=(end+3)//4 - start//4, offset=dna_offset+start//4)
+        first = start % 4
+        seq = self._UNPACK[packed].ravel()[first:first+end-start]
+
+        self._apply_blocks(seq, n_blocks, start, end, lambda bases: ord("N"))
+        self._apply_blocks(seq, mask_blocks, start, end, lambda bases: bases | 0x20)
+
+        if strand == "-":
+            seq = _COMPLEMENT[seq[::-1]]
+        return seq
+
+    def get_seq(self, chrom, start, end, strand):
+        return self.get_seq_array(chrom, start, end, strand).tobytes().decode("ascii")
+
+    def resolve_chrom(self, chrom):
+        """ 
+        Returns the name of ``chrom`` as used in the 2bit file (eg "chr1" vs "1"; see 
+        :py:func:`genomeview.utilities.match_chrom_format`). 
+        """
+        if chrom not in self._chrom_names:
+            self._chrom_names[chrom] = match_chrom_format(chrom, self._read_index())
+        return self._chrom_names[chrom]
+
+    def keys(self):
+        return list(self._read_index().keys())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmap"] = None
         return state
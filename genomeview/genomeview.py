@@ -1,11 +1,12 @@
 import collections
+import numpy
 
 
 from genomeview.svg import Renderer, SVG
 
 
 class Document:
-    header = """<svg version="1.1" baseProfile="full" width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">"""
+    header = """<svg version="1.1" baseProfile="full" width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">"""
     footer = """</svg>"""
         
     def __init__(self, width):
@@ -45,18 +46,27 @@ class Document:
         for element in self.elements:
             element.layout(self.view_width)
         
-    def render(self):
+    def render(self, backend=None):
+        """
+        Renders the document, yielding the lines of the svg. Optionally, the document can 
+        be drawn by another graphics ``backend`` (by default, ``self.renderer``).
+        """
+        if backend is None:
+            backend = self.renderer
+
         self.layout()
         
         total_height = sum(element.height+self.between_views for element in self.elements) + self.margin_y*2
         yield self.header.format(height=total_height, width=self.width)
+        yield from backend.start_document(self.width, total_height)
         
         cury = self.margin_y
         for element in self.elements:
-            renderer = Renderer(self.renderer, self.margin_x, cury, self.view_width, element.height)
+            renderer = Renderer(backend, self.margin_x, cury, self.view_width, element.height)
             yield from renderer.render(element)
             cury += element.height + self.between_views
             
+        yield from backend.stop_document()
         yield self.footer
         
     def _repr_svg_(self):
@@ -166,6 +176,7 @@ class Scale:
 
         self.pixel_width = None
         self._param = None
+        self._bases_per_pixel = None
 
         self.source = source
         self._seq = None
@@ -183,7 +194,15 @@ class Scale:
 
         nt_width = self.end - self.start
         
-        self.bases_per_pixel = nt_width / self.pixel_width
+        self._bases_per_pixel = nt_width / self.pixel_width
+
+    @property
+    def bases_per_pixel(self):
+        """
+        The number of bases displayed in each pixel.
+        """
+        self._setup()
+        return self._bases_per_pixel
 
     def topixels(self, genomic_position):
         """
@@ -205,10 +224,12 @@ class Scale:
         dist = genomic_size / float(self.bases_per_pixel)
         return dist
     
-    def get_seq(self, start=None, end=None, strand="+"):
+    def get_seq_array(self, start=None, end=None):
         """
-        Gets the nucleotide sequence of an interval. By default, returns the 
-        sequence for the current genomic interval.
+        Gets the nucleotide sequence of an interval as a read-only numpy array of 
+        (uppercase) ascii codes, ie a view of the cached sequence of the current genomic 
+        interval, suitable for vectorized comparisons. By default, returns the sequence 
+        for the current genomic interval.
         """
         self._setup()
 
@@ -223,11 +244,21 @@ class Scale:
         assert end <= self.end
 
         if self._seq is None:
-            self._seq = self.source.get_seq(self.chrom, self.start, self.end, self.strand).upper()
+            if hasattr(self.source, "get_seq_array"):
+                seq = self.source.get_seq_array(self.chrom, self.start, self.end, self.strand).tobytes().upper()
+            else:
+                seq = self.source.get_seq(self.chrom, self.start, self.end, self.strand).upper().encode("ascii")
+            self._seq = numpy.frombuffer(seq, dtype=numpy.uint8)
 
-        cur_seq = self._seq[start-self.start:end-self.start]
+        return self._seq[start-self.start:end-self.start]
+
+    def get_seq(self, start=None, end=None, strand="+"):
+        """
+        Gets the nucleotide sequence of an interval. By default, returns the 
+        sequence for the current genomic interval.
+        """
         if strand != self.strand:
             raise Exception("ack")
 
-        return cur_seq
+        return self.get_seq_array(start, end).tobytes().decode("ascii")
 
@@ -70,16 +70,19 @@ class GraphTrack(Track):
         
     def render(self, renderer):
         for label, series in self.series.items():
-            for i in range(len(series.x)-1):
-                if any(numpy.isnan(series.x[i:i+2])) or any(numpy.isnan(series.y[i:i+2])):
-                    continue
-                x1 = self.scale.topixels(series.x[i])
-                x2 = self.scale.topixels(series.x[i+1])
-                y1 = self.ytopixels(series.y[i])
-                y2 = self.ytopixels(series.y[i+1])
-                
-                yield from renderer.line(x1, y1, x2, y2, 
-                    **{"stroke-width":1, "stroke":series.color, "stroke-linecap":"square"})
+            x = numpy.asarray(series.x)
+            y = numpy.asarray(series.y)
+
+            missing = numpy.isnan(x) | numpy.isnan(y)
+            valid = ~(missing[:-1] | missing[1:])
+
+            x1 = self.scale.topixels(x[:-1][valid])
+            x2 = self.scale.topixels(x[1:][valid])
+            y1 = self.ytopixels(y[:-1][valid])
+            y2 = self.ytopixels(y[1:][valid])
+
+            yield from renderer.lines(x1, y1, x2, y2, 
+                **{"stroke-width":1, "stroke":series.color, "stroke-linecap":"square"})
 
         # since the labels are drawn at the top of the ticks, let's make sure the top tick/label is 
         # more than 12 pixels from the top of the track so it doesn't get clipped
@@ -1,3 +1,5 @@
+import math
+
 from genomeview.track import Track
 
 class Interval:
@@ -24,6 +26,70 @@ class Interval:
     def __repr__(self):
         return "{}:{:,}-{:,}{}".format(self.chrom, self.start, self.end, self.strand)
         
+class RowPacker:
+    """
+    Packs intervals into rows, placing each interval into the first row (ie, with the lowest 
+    index) whose end lies to the left of the start of the interval, or into a new row if 
+    there is no such row.
+
+    The row ends are kept in a segment tree of minimums, so that finding the first free 
+    row takes O(log rows) rather than a linear scan over all rows.
+
+    Attributes:
+        ends: list of the current end coordinate of each row
+    """
+    def __init__(self):
+        self.ends = []
+        self._capacity = 1
+        self._tree = [math.inf, math.inf]
+
+    def place(self, start, end):
+        """
+        Places an interval spanning ``start`` to ``end`` and returns the index of its row.
+        """
+        row = self.find(start)
+        if row is None:
+            row = len(self.ends)
+            self.ends.append(end)
+            if row >= self._capacity:
+                self._grow()
+        self._update(row, end)
+        return row
+
+    def find(self, start):
+        """
+        Returns the index of the first row ending before ``start``, or None.
+        """
+        tree = self._tree
+        if not tree[1] < start:
+            return None
+
+        node = 1
+        while node < self._capacity:
+            node *= 2
+            if not tree[node] < start:
+                node += 1
+        return node - self._capacity
+
+    def _update(self, row, end):
+        tree = self._tree
+        self.ends[row] = end
+        node = row + self._capacity
+        tree[node] = end
+        node //= 2
+        while node:
+            tree[node] = min(tree[2*node], tree[2*node+1])
+            node //= 2
+
+    def _grow(self):
+        self._capacity *= 2
+        tree = [math.inf] * (2 * self._capacity)
+        tree[self._capacity:self._capacity+len(self.ends)] = self.ends
+        for node in range(self._capacity-1, 0, -1):
+            tree[node] = min(tree[2*node], tree[2*node+1])
+        self._tree = tree
+
+
 def color_by_strand(interval):
     # brightness = 0.2 + (cur_reads[0].mapq/40.0*0.8)
     color = "#E89E9D"
@@ -36,8 +102,7 @@ def color_by_strand(interval):
 class IntervalTrack(Track):
     def __init__(self, intervals, name=None):
         super().__init__(name)
-        self.rows = []
-        self.intervals_to_rows = {}
+        self.reset_rows()
         
         self.row_height = 8
         self.margin_x = 15
@@ -48,30 +113,37 @@ class IntervalTrack(Track):
 
         self.color_fn = color_by_strand
 
+    def reset_rows(self):
+        """
+        Removes all intervals from the layout.
+        """
+        self.row_packer = RowPacker()
+        self.rows = self.row_packer.ends
+        self.intervals_to_rows = {}
+
     def layout_interval(self, interval):
-        row = 0
         interval_start = self.scale.topixels(interval.start)
-        for row, row_end in enumerate(self.rows):
-            if interval_start > row_end:
-                break
-        else:
-            self.rows.append(None)
-            row = len(self.rows) - 1
         
         new_end = self.scale.topixels(interval.end) + self.margin_x
         if interval.label is not None:
             new_end += len(interval.label) * self.row_height * 0.75
-        self.rows[row] = new_end
+
+        row = self.row_packer.place(interval_start, new_end)
 
         assert not interval.id in self.intervals_to_rows
         self.intervals_to_rows[interval.id] = row
         
 
+    def get_row(self, interval):
+        """
+        Returns the row that an interval was assigned to during layout.
+        """
+        return self.intervals_to_rows[interval.id]
+
     def layout(self, scale):
         super().layout(scale)
 
-        self.rows = []
-        self.intervals_to_rows = {}
+        self.reset_rows()
 
         for interval in self.intervals:
             self.layout_interval(interval)
@@ -82,7 +154,7 @@ class IntervalTrack(Track):
         start = self.scale.topixels(interval.start)
         end = self.scale.topixels(interval.end)
         
-        row = self.intervals_to_rows[interval.id]
+        row = self.get_row(interval)
         top = row*(self.row_height+self.margin_y)
         
         color = self.color_fn(interval)
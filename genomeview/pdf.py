@@ -0,0 +1,279 @@
+import zlib
+
+import numpy
+
+from genomeview.raster import _option, _opacity, _parse_color
+from genomeview.svg import GraphicsBackend
+
+
+class PDF(GraphicsBackend):
+    """
+    Writes documents as PDF, without needing an external converter. Each rendered
+    document becomes a page (one unit of document width is one point), so several
+    documents can be rendered with the same backend and then written out together
+    as a multi-page PDF using :py:meth:`write`.
+
+    Text uses the built-in Helvetica fonts, so no fonts are embedded.
+    """
+    def __init__(self):
+        self.pages = []
+        self._opacities = {}
+
+        self._content = None
+        self._states = []
+
+    def start_document(self, width, height):
+        self._content = []
+        # flip the y-axis, so that (0, 0) is the top left, as in svg
+        self._content.append("1 0 0 -1 0 {} cm".format(_num(height)))
+        self._states = [{}]
+        self.pages.append((width, height, self._content))
+        yield from ()
+
+    def stop_document(self):
+        self._content = None
+        yield from ()
+
+    def _set(self, key, value, command):
+        # only writes graphics state that has changed
+        state = self._states[-1]
+        if state.get(key) != value:
+            state[key] = value
+            self._content.append(command)
+
+    def _set_color(self, kind, color, opacity):
+        """ sets the fill or stroke color, returning its alpha (0 if nothing would be painted) """
+        color = _parse_color(color)
+        if color is None or color[3]*opacity <= 0:
+            return 0
+
+        red, green, blue, alpha = color
+        operator = "rg" if kind == "fill" else "RG"
+        self._set(kind, color[:3], "{} {} {} {}".format(_num(red, 3), _num(green, 3), _num(blue, 3), operator))
+        return alpha * opacity
+
+    def _set_stroke(self, options):
+        alpha = self._set_color("stroke", _option(options, "stroke", "none"), _opacity(options, "stroke"))
+        if alpha:
+            width = float(_option(options, "stroke-width", 1))
+            self._set("stroke-width", width, "{} w".format(_num(width)))
+            cap = {"butt":0, "round":1, "square":2}.get(_option(options, "stroke-linecap", "butt"), 0)
+            self._set("stroke-linecap", cap, "{} J".format(cap))
+        return alpha
+
+    def _set_opacity(self, fill_alpha, stroke_alpha):
+        # opacity is set through a graphics state dictionary, shared by all the pages
+        opacities = (_num(fill_alpha or 1, 3), _num(stroke_alpha or 1, 3))
+        name = self._opacities.get(opacities)
+        if name is None:
+            name = self._opacities[opacities] = "GS{}".format(len(self._opacities)+1)
+        self._set("opacity", opacities, "/{} gs".format(name))
+
+    def _paint(self, path, fill_alpha, stroke_alpha):
+        """
+        Paints the path (a list of path operators) with the fill and/or stroke that have 
+        been set, given their alpha (0 for no fill or stroke)
+        """
+        if not fill_alpha and not stroke_alpha:
+            return
+
+        self._set_opacity(fill_alpha, stroke_alpha)
+        self._content.extend(path)
+        if fill_alpha and stroke_alpha:
+            self._content.append("B")
+        elif fill_alpha:
+            self._content.append("f")
+        else:
+            self._content.append("S")
+
+    def _polygon(self, points, options, closed=True, fill=True):
+        path = ["{} {} {}".format(_num(x), _num(y), "l" if i else "m") for i, (x, y) in enumerate(points)]
+        if closed:
+            path.append("h")
+
+        fill_alpha = 0
+        if fill:
+            fill_alpha = self._set_color("fill", _option(options, "fill", "black"), _opacity(options, "fill"))
+        self._paint(path, fill_alpha, self._set_stroke(options))
+
+
+    def text(self, x, y, text, size=10, anchor="middle", family="Helvetica", **kwdargs):
+        alpha = self._set_color("fill", _option(kwdargs, "fill", "black"), _opacity(kwdargs, "fill"))
+        if not alpha: return
+
+        text = str(text)
+        bold = _is_bold(kwdargs)
+        width = _text_width(text, size, bold)
+        left = {"start":x, "middle":x-width/2, "end":x-width}[anchor]
+
+        escaped = text.encode("cp1252", "replace").decode("latin-1")
+        escaped = escaped.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+        self._set_opacity(alpha, 0)
+        # the text matrix flips the glyphs back upright
+        self._content.extend(["BT", "/{} {} Tf".format("F2" if bold else "F1", _num(size)),
+                              "1 0 0 -1 {} {} Tm".format(_num(left), _num(y)),
+                              "({}) Tj".format(escaped), "ET"])
+        yield from ()
+
+    def text_with_background(self, x, y, text, size=10, anchor="middle", text_color="black", bg="white", bg_opacity=0.8, **kwdargs):
+        width = _text_width(str(text), size, _is_bold(kwdargs))
+        left = {"start":x, "middle":x-width/2, "end":x-width}[anchor]
+        size = float(size)
+        yield from self.rect(left, y-size*0.77, width, size, fill=bg, stroke="none", opacity=bg_opacity)
+
+        kwdargs["fill"] = text_color
+        yield from self.text(x, y, text, size, anchor, **kwdargs)
+
+    def rect(self, x, y, width, height, **kwdargs):
+        defaults = {"fill":"white", "stroke":"black"}
+        defaults.update(kwdargs)
+
+        # as in svg, rects with no area aren't drawn
+        if width <= 0 or height <= 0: return
+
+        fill_alpha = self._set_color("fill", _option(defaults, "fill", "black"), _opacity(defaults, "fill"))
+        stroke_alpha = self._set_stroke(defaults)
+        self._paint(["{} {} {} {} re".format(_num(x), _num(y), _num(width), _num(height))], fill_alpha, stroke_alpha)
+        yield from ()
+
+    def line(self, x1, y1, x2, y2, **kwdargs):
+        defaults = {"stroke":"black"}
+        defaults.update(kwdargs)
+        self._polygon([(x1, y1), (x2, y2)], defaults, closed=False, fill=False)
+        yield from ()
+
+    def line_with_arrows(self, x1, y1, x2, y2, n=None, arrows=None, direction="right",
+                         color="black", filled=True,
+                         arrow_scale=None, arrowKwdArgs=None, **kwdargs):
+        defaults = {"stroke":color}
+        defaults.update(kwdargs)
+        yield from self.line(x1, y1, x2, y2, **defaults)
+
+        if arrowKwdArgs is None: arrowKwdArgs = {}
+        if arrow_scale is None:
+            arrow_scale = kwdargs.get("stroke-width", 1)
+        if n is not None:
+            arrows = numpy.arange(n) / n
+
+        for arrow in arrows:
+            yield from self.arrow(x1+float(x2-x1)*arrow, y1+float(y2-y1)*arrow, direction,
+                                  filled=filled, color=color, scale=arrow_scale, **arrowKwdArgs)
+
+    def arrow(self, x, y, direction, color="black", scale=1.0, filled=True, **kwdargs):
+        sign = 1 if direction == "right" else -1
+        points = [(x-2.5*scale*sign, y-5*scale), (x+2.5*scale*sign, y), (x-2.5*scale*sign, y+5*scale)]
+
+        self._polygon(points, dict(kwdargs, stroke=color, fill=color), closed=filled, fill=filled)
+        yield from ()
+
+    def block_arrow(self, left, top, width, height, arrow_width, direction, **kwdargs):
+        options = dict(kwdargs)
+        options.setdefault("stroke", "none")
+        options.setdefault("fill", "black")
+
+        if direction == "right":
+            points = [(left, top), (left+width, top), (left+width+arrow_width, top+height/2),
+                      (left+width, top+height), (left, top+height)]
+        else:
+            points = [(left, top), (left+width, top), (left+width, top+height),
+                      (left, top+height), (left-arrow_width, top+height/2)]
+
+        self._polygon(points, options)
+        yield from ()
+
+
+    def comment(self, text):
+        if self._content is not None:
+            self._content.append("% {}".format(str(text).replace("\n", " ")))
+        yield from ()
+
+    def start_clipped_group(self, x, y, width, height, name):
+        self._content.append("q {} {} {} {} re W n".format(_num(x), _num(y), _num(width), _num(height)))
+        self._states.append(dict(self._states[-1]))
+        yield from ()
+
+    def stop_clipped_group(self):
+        self._content.append("Q")
+        self._states.pop()
+        yield from ()
+
+
+    def write(self, outf):
+        """ writes the pages rendered so far to a binary file-like object, as a PDF """
+        objects = []
+        def add(obj):
+            objects.append(obj)
+            return len(objects)
+
+        catalog = add(None)
+        pages = add(None)
+        fonts = {"F1":add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"),
+                 "F2":add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")}
+        states = {name:add("<< /Type /ExtGState /ca {} /CA {} >>".format(fill, stroke).encode())
+                  for (fill, stroke), name in self._opacities.items()}
+
+        resources = "<< /Font << {} >> /ExtGState << {} >> >>".format(
+            " ".join("/{} {} 0 R".format(name, obj) for name, obj in fonts.items()),
+            " ".join("/{} {} 0 R".format(name, obj) for name, obj in states.items()))
+
+        page_ids = []
+        for width, height, content in self.pages:
+            stream = zlib.compress("\n".join(content).encode("latin-1"))
+            stream_id = add(b"<< /Length " + str(len(stream)).encode() + b" /Filter /FlateDecode >>\nstream\n"
+                            + stream + b"\nendstream")
+            page_ids.append(add("<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] /Resources {} /Contents {} 0 R >>".format(
+                pages, _num(width), _num(height), resources, stream_id).encode()))
+
+        objects[catalog-1] = "<< /Type /Catalog /Pages {} 0 R >>".format(pages).encode()
+        objects[pages-1] = "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join("{} 0 R".format(page_id) for page_id in page_ids), len(page_ids)).encode()
+
+        data = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for i, obj in enumerate(objects):
+            offsets.append(len(data))
+            data += "{} 0 obj\n".format(i+1).encode() + obj + b"\nendobj\n"
+
+        xref = len(data)
+        data += "xref\n0 {}\n0000000000 65535 f \n".format(len(objects)+1).encode()
+        for offset in offsets:
+            data += "{:010d} 00000 n \n".format(offset).encode()
+        data += "trailer\n<< /Size {} /Root {} 0 R >>\nstartxref\n{}\n%%EOF\n".format(
+            len(objects)+1, catalog, xref).encode()
+
+        outf.write(bytes(data))
+
+
+def _num(value, digits=2):
+    """ formats a number compactly for a content stream """
+    formatted = "{:.{}f}".format(value, digits).rstrip("0").rstrip(".")
+    if formatted in ["-0", ""]:
+        return "0"
+    return formatted
+
+def _is_bold(options):
+    return str(_option(options, "font-weight", "normal")) in ["bold", "bolder", "600", "700", "800", "900"]
+
+def _text_width(text, size, bold=False):
+    widths = _HELVETICA_BOLD_WIDTHS if bold else _HELVETICA_WIDTHS
+    return sum(widths.get(char, 556) for char in text) * float(size) / 1000
+
+
+# the widths of the printable ascii characters (" " to "~") in the built-in fonts, in
+# thousandths of the font size
+_HELVETICA_WIDTHS = dict(zip([chr(i) for i in range(32, 127)], [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584]))
+
+_HELVETICA_BOLD_WIDTHS = dict(zip([chr(i) for i in range(32, 127)], [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584]))
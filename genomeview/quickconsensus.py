@@ -1,73 +1,628 @@
+import collections
 import numpy
 
-from genomeview.utilities import match_chrom_format
+from genomeview.utilities import expand_ranges, match_chrom_format
+
+# reads ignored by the default pysam/htslib pileup: unmapped, secondary, qc-fail and duplicates
+PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+
+def _include_in_pileup(read):
+    if read.flag & PILEUP_SKIP_FLAGS:
+        return False
+    if read.is_paired and not read.is_proper_pair:
+        # orphans
+        return False
+    return read.query_sequence is not None and read.cigartuples is not None
+
+def _may_overlap_mate(read):
+    if read.mate_is_unmapped or not read.is_proper_pair:
+        return False
+    if read.next_reference_id >= 0 and read.reference_id != read.next_reference_id:
+        return False
+    if abs(read.template_length) >= 2*read.query_length and read.next_reference_start >= read.reference_end:
+        return False
+    return True
+
+# minimum fraction of the reads at a position supporting a variant for it to be drawn
+DEFAULT_THRESHOLDS = {"A":0.2, "C":0.2, "G":0.2, "T":0.2, "DEL":0.3, "INS":0.2}
+
+_NUC_ROWS = numpy.full(256, -1, dtype=numpy.int64)
+for _nuc, _row in [("A", 0), ("C", 1), ("G", 2), ("T", 3)]:
+    _NUC_ROWS[ord(_nuc)] = _row
+
+
+class _AlignedBlocks:
+    """
+    The aligned blocks (matches, deletions and insertion anchors) of a set of reads, 
+    with the query sequences and base qualities of all reads packed into flat buffers 
+    so that they can be tallied with a handful of numpy operations.
+    """
+    def __init__(self, reads):
+        seqs = []
+        quals = []
+        offset = 0
+
+        match_ref, match_query, match_len = [], [], []
+        del_ref, del_len, del_query = [], [], []
+        ins_ref, ins_query = [], []
+        read_offsets = []
+        self.reads = []
+
+        for read in reads:
+            if not _include_in_pileup(read): continue
+
+            seq = read.query_sequence
+            read_quals = read.query_qualities
+            if read_quals is None:
+                read_quals = numpy.full(len(seq), 255, dtype=numpy.uint8)
+            seqs.append(seq)
+            quals.append(numpy.asarray(read_quals, dtype=numpy.uint8))
+
+            genome_position = read.reference_start
+            sequence_position = offset
+            cigar = read.cigartuples
+
+            for i, (code, length) in enumerate(cigar):
+                if code in [0, 7, 8]: # M, =, X
+                    match_ref.append(genome_position)
+                    match_query.append(sequence_position)
+                    match_len.append(length)
+                    # the pileup reports insertions at the last aligned base before the insertion
+                    if i+1 < len(cigar) and cigar[i+1][0] == 1:
+                        ins_ref.append(genome_position+length-1)
+                        ins_query.append(sequence_position+length-1)
+                    genome_position += length
+                    sequence_position += length
+                elif code == 2: # D
+                    # deletions are filtered by the quality of the next aligned base
+                    del_ref.append(genome_position)
+                    del_len.append(length)
+                    del_query.append(sequence_position if sequence_position < offset+len(seq) else -1)
+                    genome_position += length
+                elif code == 3: # N
+                    genome_position += length
+                elif code in [1, 4]: # I, S
+                    sequence_position += length
+
+            read_offsets.append(offset)
+            offset += len(seq)
+            self.reads.append(read)
+
+        self.seq = numpy.frombuffer("".join(seqs).encode(), dtype=numpy.uint8)
+        if quals:
+            self.quals = numpy.concatenate(quals)
+        else:
+            self.quals = numpy.zeros(0, dtype=numpy.uint8)
+
+        self.match_ref = numpy.array(match_ref, dtype=numpy.int64)
+        self.match_query = numpy.array(match_query, dtype=numpy.int64)
+        self.match_len = numpy.array(match_len, dtype=numpy.int64)
+        self.del_ref = numpy.array(del_ref, dtype=numpy.int64)
+        self.del_len = numpy.array(del_len, dtype=numpy.int64)
+        self.del_query = numpy.array(del_query, dtype=numpy.int64)
+        self.ins_ref = numpy.array(ins_ref, dtype=numpy.int64)
+        self.ins_query = numpy.array(ins_query, dtype=numpy.int64)
+        self.read_offsets = read_offsets
+
+    def adjust_overlap_qualities(self):
+        """
+        Mimics htslib's overlap detection in the pileup: where both ends of a read pair 
+        are aligned to the same position, the base quality of one of them is set to zero 
+        (so that the position is only counted once; see :py:func:`_tweak_overlap_quality`).
+        """
+        waiting = {}
+        for i, read in enumerate(self.reads):
+            if not _may_overlap_mate(read): continue
+
+            if read.query_name not in waiting:
+                if read.next_reference_start >= read.reference_start:
+                    waiting[read.query_name] = i
+                continue
+
+            a = waiting.pop(read.query_name)
+            _tweak_overlap_quality(self.reads[a], read, self.seq, self.quals, 
+                                   self.read_offsets[a], self.read_offsets[i])
+
+
+def _name_hash(name):
+    """ htslib's X31 string hash of the read name, followed by its Wang integer hash """
+    mask = 0xffffffff
+    encoded = name.encode()
+    key = encoded[0] if encoded else 0
+    for c in encoded[1:]:
+        key = ((key << 5) - key + c) & mask
+
+    key = (key + (~(key << 15) & mask)) & mask
+    key ^= key >> 10
+    key = (key + (key << 3)) & mask
+    key ^= key >> 6
+    key = (key + (~(key << 11) & mask)) & mask
+    key ^= key >> 16
+    return key
+
+
+class _CigarWalk:
+    """
+    Steps through the aligned bases of a read, following htslib's ``cigar_iref2iseq_set`` 
+    and ``cigar_iref2iseq_next``: ``k`` is the current cigar operation, ``icig`` the 
+    position within it, and ``iseq``/``iref`` the query and (read-relative) reference 
+    positions of the current base.
+    """
+    def __init__(self, read):
+        self.cigar = read.cigartuples
+        self.k = 0
+        self.icig = 0
+        self.iseq = 0
+        self.iref = 0
+
+    def set(self, pos):
+        """ moves to the first aligned base at or after read-relative reference position pos """
+        if pos < 0: return -1
+        while self.k < len(self.cigar):
+            op, length = self.cigar[self.k]
+            if op in [0, 7, 8]: # M, =, X
+                pos -= length
+                if pos < 0:
+                    self.icig = length + pos
+                    self.iseq += self.icig
+                    self.iref += self.icig
+                    return 0
+                self.iseq += length
+                self.iref += length
+            elif op in [1, 4]: # I, S
+                self.iseq += length
+            elif op in [2, 3]: # D, N
+                pos = max(pos - length, 0)
+                self.iref += length
+            self.k += 1
+            self.icig = 0
+        self.iseq = -1
+        return -1
+
+    def next(self):
+        """ moves to the next aligned base """
+        while self.k < len(self.cigar):
+            op, length = self.cigar[self.k]
+            if op in [0, 7, 8]:
+                if self.icig < length - 1:
+                    self.iseq += 1
+                    self.icig += 1
+                    self.iref += 1
+                    return 0
+            elif op in [2, 3]:
+                self.iref += length
+            elif op in [1, 4]:
+                self.iseq += length
+            self.k += 1
+            self.icig = -1
+        self.iseq = -1
+        self.iref = -1
+        return -1
+
+    def remaining(self):
+        """ number of aligned bases after the current one in the current (match) operation """
+        return self.cigar[self.k][1] - 1 - self.icig
+
+    def after_deletion(self):
+        return self.k > 0 and self.cigar[self.k-1][0] == 2
+
+    def advance(self, n):
+        self.icig += n
+        self.iseq += n
+        self.iref += n
+
+
+def _tweak_overlap_quality(a, b, seq, quals, a_offset, b_offset):
+    """
+    Adjusts the base qualities of the overlapping mates a (the leftmost) and b the way 
+    htslib's pileup does (``tweak_overlap_quality``, htslib 1.13 and later). Reads are 
+    stepped through together from the start of b: where the bases agree, one mate 
+    (chosen by a hash of the read name) gets the sum of both qualities and the other 
+    zero; where they disagree, the lower quality base is zeroed and the other reduced. 
+    Where one mate has a deletion, the bases of the other mate across the deletion are 
+    reduced or zeroed the same way. The qualities of both reads are modified in ``quals``,
+    at the given offsets of each read into the packed ``seq`` and ``quals``.
+    """
+    a_walk, b_walk = _CigarWalk(a), _CigarWalk(b)
+    a_pos, b_pos = a.reference_start, b.reference_start
+    iref = b_pos
+
+    a_ret = a_walk.set(iref - a_pos)
+    if a_ret < 0: return
+    b_ret = b_walk.set(iref - b_pos)
+    if b_ret < 0: return
+
+    a_keeps = _name_hash(a.query_name) & 1
+
+    def reduce(offset, walk, keep):
+        i = offset + walk.iseq
+        quals[i] = int(quals[i] * 0.8) if keep else 0
+
+    while True:
+        while a_ret >= 0 and a_walk.iref >= 0 and a_walk.iref < iref - a_pos:
+            a_ret = a_walk.next()
+        if a_ret < 0: return
+
+        while b_ret >= 0 and b_walk.iref >= 0 and b_walk.iref < iref - b_pos:
+            b_ret = b_walk.next()
+        if b_ret < 0: return
+
+        iref = max(iref, a_walk.iref + a_pos, b_walk.iref + b_pos) + 1
+
+        # where a or b has a deletion, catch the other one up to it
+        if a_walk.iref + a_pos != b_walk.iref + b_pos:
+            if a_walk.iref + a_pos < b_walk.iref + b_pos and b_walk.after_deletion():
+                while True:
+                    reduce(a_offset, a_walk, a_keeps)
+                    a_ret = a_walk.next()
+                    if a_ret < 0: return
+                    if a_walk.iref + a_pos >= b_walk.iref + b_pos: break
+            elif a_walk.after_deletion():
+                while True:
+                    reduce(b_offset, b_walk, not a_keeps)
+                    b_ret = b_walk.next()
+                    if b_ret < 0: return
+                    if b_walk.iref + b_pos >= a_walk.iref + a_pos: break
+            else:
+                # eg, reference skips
+                continue
+
+        if a_walk.iseq >= a.query_length or b_walk.iseq >= b.query_length:
+            return
+
+        # the following bases of the current match operations are compared one by one, 
+        # in the same way, so compare them all at once
+        n = 1
+        if a_walk.iref + a_pos == b_walk.iref + b_pos:
+            n += min(a_walk.remaining(), b_walk.remaining())
+
+        a_i = numpy.arange(a_offset + a_walk.iseq, a_offset + a_walk.iseq + n)
+        b_i = numpy.arange(b_offset + b_walk.iseq, b_offset + b_walk.iseq + n)
+        _compare_overlapping_bases(seq, quals, a_i, b_i, a_keeps)
+
+        a_walk.advance(n - 1)
+        b_walk.advance(n - 1)
+        iref += n - 1
+
+
+def _compare_overlapping_bases(seq, quals, a_i, b_i, a_keeps):
+    a_qual = quals[a_i].astype(numpy.int64)
+    b_qual = quals[b_i].astype(numpy.int64)
+    a_reduced = (0.8 * a_qual).astype(numpy.int64)
+    b_reduced = (0.8 * b_qual).astype(numpy.int64)
+    total = numpy.minimum(a_qual + b_qual, 200)
+
+    same = seq[a_i] == seq[b_i]
+    a_higher = a_qual > b_qual
+    b_higher = a_qual < b_qual
+
+    keep_a = 1 if a_keeps else 0
+    new_a = numpy.where(same, keep_a * total, 
+                        numpy.where(a_higher, a_reduced, numpy.where(b_higher, 0, keep_a * a_reduced)))
+    new_b = numpy.where(same, (1-keep_a) * total, 
+                        numpy.where(b_higher, b_reduced, numpy.where(a_higher, 0, (1-keep_a) * b_reduced)))
+
+    quals[a_i] = new_a
+    quals[b_i] = new_b
+
+
+# approximate peak memory (in bytes) of the temporary arrays used to tally each aligned base
+_TALLY_BYTES_PER_BASE = 100
+
+# storage rows of the counts chunks
+_COUNT_ROWS = {"A":0, "C":1, "G":2, "T":3, "DEL":4, "INS":5}
+_DEPTH_ROWS = 5 # nucleotides and deletions contribute to the depth; insertions don't
+
+
+def _compact(counts):
+    """ returns the counts using the smallest unsigned integer type that can hold them """
+    return counts.astype(numpy.min_scalar_type(counts.max()), copy=False)
+
+
+class _CountsChunk:
+    """
+    The counts for a contiguous part of the window, stored as a (6, length) array of 
+    unsigned integers (one row each for A, C, G, T, DEL and INS) that is widened only 
+    when a count no longer fits.
+    """
+    def __init__(self, length):
+        self.counts = numpy.zeros([len(_COUNT_ROWS), length], dtype=numpy.uint8)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._total = None
+        self._masks = {}
+
+    def add(self, increment):
+        self.counts = _compact(self.counts + increment)
+        self._invalidate()
+
+    def add_one(self, row, position):
+        if self.counts[row, position] == numpy.iinfo(self.counts.dtype).max:
+            wider = numpy.min_scalar_type(int(self.counts[row, position]) + 1)
+            self.counts = self.counts.astype(wider)
+        self.counts[row, position] += 1
+        self._invalidate()
+
+    def total(self):
+        if self._total is None:
+            self._total = self.counts[:_DEPTH_ROWS].sum(axis=0, dtype=numpy.int64)
+        return self._total
+
+    def mask(self, row, threshold):
+        cached = self._masks.get(row)
+        if cached is not None and cached[0] == threshold:
+            return cached[1]
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mask = (self.counts[row] / self.total()) > threshold
+
+        self._masks[row] = (threshold, mask)
+        return mask
+
 
 class MismatchCounts(object):
     """
     keeps track of how many of each nucleotide (or insertion/deletion) are present at each position
     -> used for the quick consensus mode
+
+    The counts are stored as unsigned integers (as narrow as the depth allows) in chunks 
+    of ``chunk_size`` positions, which are only allocated once a read touches them. 
+    Use :py:meth:`estimate_nbytes` to check how much memory a window could need before 
+    tallying it.
+
+    ``counts`` and ``insertions`` used to be writable arrays; they are now read-only 
+    dense snapshots of the chunks (built on first access, and kept until the counts 
+    change), so counts must be updated using :py:meth:`add_count` instead.
+
+    Attributes:
+        thresholds (dict): the fraction of reads (by type, ie "A", "C", "G", "T", "DEL" 
+            or "INS") that must support a variant at a position for it to be considered 
+            real; changing a threshold only recomputes the mask for that type
+        max_batch_bases (int): reads are tallied in batches of about this many bases, 
+            which bounds the memory used by temporary arrays (default: 2**20)
     """
     types_to_id = {"A":0, "C":1, "G":2, "T":3, "DEL":5}
 
-    def __init__(self, chrom, start, end):
+    def __init__(self, chrom, start, end, thresholds=None, chunk_size=2**16):
         self.chrom = chrom
         self.start = start
         self.end = end
 
-        length = end - start
-        self.counts = numpy.zeros([6, length])#, dtype="uint8")
-        self.insertions = numpy.zeros(length)#, dtype="uint8")
+        self.min_base_quality = 13
+        self.max_batch_bases = 2**20
+
+        self.thresholds = dict(DEFAULT_THRESHOLDS)
+        if thresholds is not None:
+            self.thresholds.update(thresholds)
+
+        self.chunk_size = chunk_size
+        self._chunks = {}
+        self._snapshots = {}
+
+    @staticmethod
+    def estimate_nbytes(length, max_depth, aligned_bases=0, max_batch_bases=2**20, chunk_size=2**16):
+        """
+        Estimates the peak memory (in bytes) needed to tally a window of ``length`` 
+        positions, none of which is covered by more than ``max_depth`` reads, from reads 
+        with ``aligned_bases`` bases in total: the counts themselves, plus the temporary 
+        arrays used while tallying each batch of reads (see ``max_batch_bases``).
+        """
+        itemsize = numpy.min_scalar_type(max_depth).itemsize
+        counts = len(_COUNT_ROWS) * length * itemsize
+
+        # each batch is tallied from flat int64 arrays with several entries per aligned base, 
+        # and each chunk is updated from a dense int64 increment
+        tally = min(aligned_bases, max_batch_bases) * _TALLY_BYTES_PER_BASE
+        tally += 2 * len(_COUNT_ROWS) * min(length, chunk_size) * 8
+        return counts + tally
+
+    @property
+    def nbytes(self):
+        """ memory (in bytes) currently used by the counts """
+        return sum(chunk.counts.nbytes for chunk in self._chunks.values())
+
+    def _get_chunk(self, chunk_id):
+        chunk = self._chunks.get(chunk_id)
+        if chunk is None:
+            chunk_start = chunk_id * self.chunk_size
+            length = min(self.chunk_size, (self.end - self.start) - chunk_start)
+            chunk = self._chunks[chunk_id] = _CountsChunk(length)
+        return chunk
+
+    def _dense(self, rows, start, end):
+        """ the counts for the given storage rows, from window offset start to end """
+        dtypes = [chunk.counts.dtype for chunk in self._chunks.values()]
+        dense = numpy.zeros([len(rows), end-start], dtype=numpy.result_type(numpy.uint8, *dtypes))
+
+        for chunk_id in range(start // self.chunk_size, (end-1) // self.chunk_size + 1):
+            chunk = self._chunks.get(chunk_id)
+            if chunk is None: continue
+
+            chunk_start = chunk_id * self.chunk_size
+            cur_start = max(start, chunk_start)
+            cur_end = min(end, chunk_start + chunk.counts.shape[1])
+            dense[:, cur_start-start:cur_end-start] = \
+                chunk.counts[rows, cur_start-chunk_start:cur_end-chunk_start]
+        return dense
+
+    def _snapshot(self, name, build):
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            snapshot = self._snapshots[name] = build()
+            snapshot.flags.writeable = False
+        return snapshot
+
+    @property
+    def counts(self):
+        """ 
+        read-only dense (6, length) array of nucleotide (rows 0-3) and deletion (row 5) 
+        counts; see the class documentation
+        """
+        def build():
+            length = self.end - self.start
+            counts = numpy.zeros([6, length], dtype=numpy.int64)
+            counts[[0, 1, 2, 3, 5]] = self._dense(list(range(_DEPTH_ROWS)), 0, length)
+            return counts
+        return self._snapshot("counts", build)
+
+    @property
+    def insertions(self):
+        """ read-only dense array of the number of insertions following each position """
+        return self._snapshot("insertions", 
+                              lambda: self._dense([_COUNT_ROWS["INS"]], 0, self.end - self.start)[0].astype(numpy.int64))
 
     def tally_reads(self, bam):
-        depths = []
-        for pileupcolumn in bam.pileup(match_chrom_format(self.chrom, bam.references), self.start, self.end, truncate=True):
-            depths.append(pileupcolumn.n)
-            for pileupread in pileupcolumn.pileups:
-                if pileupread.is_refskip:
-                    continue
-                elif pileupread.is_del:
-                    self.add_count(pileupcolumn.pos, "DEL")
-                else:
-                    nuc =  pileupread.alignment.query_sequence[pileupread.query_position]
-                    if nuc != "N":
-                        self.add_count(pileupcolumn.pos, nuc)
-                if pileupread.indel > 0:
-                    self.add_count(pileupcolumn.pos, "INS")
+        chrom = match_chrom_format(self.chrom, bam.references)
+        self.tally_alignments(bam.fetch(chrom, self.start, self.end))
+
+    def tally_alignments(self, reads):
+        """
+        Counts nucleotides, deletions and insertions from an iterable of reads 
+        (pysam.AlignedSegment). The counts are accumulated from the aligned blocks
+        of a batch of reads at once using numpy, rather than base-by-base; each batch 
+        has about ``max_batch_bases`` bases, to bound the memory used.
+
+        Reads and bases are filtered the same way as by the default pysam pileup: 
+        unmapped, secondary, qc-fail, duplicate and orphan reads are skipped, as are 
+        bases below ``min_base_quality``, and bases covered by both ends of an 
+        overlapping read pair are only counted once.
+        """
+        batch = []
+        batch_bases = 0
+        for read in reads:
+            if not _include_in_pileup(read): continue
+            batch.append(read)
+            batch_bases += read.query_length
+
+            if batch_bases >= self.max_batch_bases:
+                batch = self._tally_batch(batch, last=False)
+                batch_bases = 0
+
+        self._tally_batch(batch, last=True)
+
+    def _tally_batch(self, reads, last):
+        """
+        Tallies a batch of reads. Unless this is the ``last`` batch, reads that may overlap 
+        a mate that hasn't been seen yet are not tallied, but returned to be tallied in the 
+        next batch (with their mate).
+        """
+        deferred = []
+        if not last:
+            names = collections.Counter(read.query_name for read in reads if _may_overlap_mate(read))
+            waiting = [_may_overlap_mate(read) and names[read.query_name] == 1 
+                       and read.next_reference_start >= read.reference_start for read in reads]
+            deferred = [read for read, wait in zip(reads, waiting) if wait]
+            reads = [read for read, wait in zip(reads, waiting) if not wait]
+
+        blocks = _AlignedBlocks(reads)
+        blocks.adjust_overlap_qualities()
+
+        passes_quality = blocks.quals >= self.min_base_quality
+
+        # nucleotides
+        positions = expand_ranges(blocks.match_ref, blocks.match_len)
+        query = expand_ranges(blocks.match_query, blocks.match_len)
+        rows = _NUC_ROWS[blocks.seq[query]]
+
+        keep = (positions >= self.start) & (positions < self.end) & passes_quality[query] & (rows >= 0)
+        all_rows = [rows[keep]]
+        all_offsets = [positions[keep] - self.start]
+
+        # deletions
+        del_quality_ok = blocks.del_query >= 0
+        del_quality_ok[del_quality_ok] = passes_quality[blocks.del_query[del_quality_ok]]
+        positions = expand_ranges(blocks.del_ref[del_quality_ok], blocks.del_len[del_quality_ok])
+
+        keep = (positions >= self.start) & (positions < self.end)
+        all_rows.append(numpy.full(keep.sum(), _COUNT_ROWS["DEL"]))
+        all_offsets.append(positions[keep] - self.start)
+
+        # insertions
+        positions = blocks.ins_ref
+        keep = (positions >= self.start) & (positions < self.end) & passes_quality[blocks.ins_query]
+        all_rows.append(numpy.full(keep.sum(), _COUNT_ROWS["INS"]))
+        all_offsets.append(positions[keep] - self.start)
+
+        self._add_counts(numpy.concatenate(all_rows), numpy.concatenate(all_offsets))
+        return deferred
+
+    def _add_counts(self, rows, offsets):
+        chunk_ids = offsets // self.chunk_size
+        order = numpy.argsort(chunk_ids, kind="stable")
+        rows, offsets, chunk_ids = rows[order], offsets[order], chunk_ids[order]
+
+        unique_ids, bounds = numpy.unique(chunk_ids, return_index=True)
+        bounds = list(bounds) + [len(chunk_ids)]
+
+        for i, chunk_id in enumerate(unique_ids):
+            chunk = self._get_chunk(int(chunk_id))
+            cur = slice(bounds[i], bounds[i+1])
+            length = chunk.counts.shape[1]
+            local = offsets[cur] - chunk_id * self.chunk_size
+
+            increment = numpy.bincount(rows[cur] * length + local, minlength=len(_COUNT_ROWS)*length)
+            chunk.add(increment.reshape(len(_COUNT_ROWS), length))
+        self._snapshots = {}
 
     def add_count(self, position, type_):
-        position -= self.start
-        if type_ == "INS":
-            self.insertions[position] += 1
-        else:
-            row = self.types_to_id[type_]
-            self.counts[row,position] += 1
+        """
+        Adds one to the count of ``type_`` at the (absolute) genome position; as when 
+        tallying reads, positions outside of the window are ignored.
+        """
+        if position < self.start or position >= self.end:
+            return
 
-    def query(self, type_, start, end=None):
-        if start < self.start or start >= self.end:
+        offset = position - self.start
+        chunk = self._get_chunk(offset // self.chunk_size)
+        chunk.add_one(_COUNT_ROWS[type_], offset % self.chunk_size)
+        self._snapshots = {}
+
+    def mask(self, type_):
+        """
+        Returns a boolean array with one entry per position in the window, which is True 
+        where the fraction of reads supporting ``type_`` exceeds its threshold.
+        """
+        row = _COUNT_ROWS[type_]
+        threshold = self.thresholds[type_]
+
+        mask = numpy.zeros(self.end - self.start, dtype=bool)
+        for chunk_id, chunk in self._chunks.items():
+            chunk_start = chunk_id * self.chunk_size
+            mask[chunk_start:chunk_start+chunk.counts.shape[1]] = chunk.mask(row, threshold)
+        return mask
+
+    def supported(self, type_, position):
+        """
+        Returns True if ``type_`` passes its threshold at the (absolute) genome position.
+        """
+        if position < self.start or position >= self.end:
             return False
 
-        start -= self.start
+        offset = position - self.start
+        chunk = self._chunks.get(offset // self.chunk_size)
+        if chunk is None:
+            return False
+        return bool(chunk.mask(_COUNT_ROWS[type_], self.thresholds[type_])[offset % self.chunk_size])
+
+    def query(self, type_, start, end=None):
         if end is None:
-            end = start
-        else:
-            end -= self.start
+            return self.supported(type_, start)
 
-        total = self.counts[:,start:(end+1)].sum(axis=0)
-        total = total.astype(float)
+        if start < self.start or start >= self.end:
+            return False
 
-        if (type_ == "INS"):
-            insertions = self.insertions[start:(end+1)]
-            if (insertions.sum() / total.sum()) > 0.2:
-               return True
+        start -= self.start
+        end = min(end - self.start, self.end - self.start - 1)
 
-        else:        
-            row = self.types_to_id[type_]
-            this_type = self.counts[row,start:(end+1)]
+        counts = self._dense(list(range(len(_COUNT_ROWS))), start, end+1)
+        total = counts[:_DEPTH_ROWS].sum(axis=0, dtype=numpy.int64)
+        this_type = counts[_COUNT_ROWS[type_]]
 
-            if type_ == "DEL":
-                if  ((this_type / total) > 0.3).any():
-                    return True
-            elif ((this_type / total) > 0.2).any():
-                return True
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            if (type_ == "INS"):
+                # insertions are compared to the total depth over the whole range
+                return bool((this_type.sum() / total.sum()) > self.thresholds["INS"])
 
-        return False
+            return bool(((this_type / total) > self.thresholds[type_]).any())
@@ -0,0 +1,428 @@
+import functools
+import math
+import re
+import struct
+import zlib
+
+import numpy
+
+from genomeview.svg import GraphicsBackend
+
+
+class Raster(GraphicsBackend):
+    """
+    Draws documents directly into an array of pixels (see :py:meth:`pixels`), eg to
+    be saved as a PNG by :py:func:`write_png`, without needing an external converter.
+
+    Shapes are anti-aliased. Text is drawn with a small built-in bitmap font, which is
+    monospaced, so text will be positioned a little differently than in the SVG.
+
+    Args:
+        scale (float): the number of pixels per unit of document width (eg 2 for a
+            high-resolution image)
+        background (str): the background color, or None for a transparent background
+        draw_text (bool): if False, text is skipped
+    """
+    def __init__(self, scale=1.0, background="white", draw_text=True):
+        self.scale = scale
+        self.background = background
+        self.draw_text = draw_text
+
+        self.canvas = None
+        self._clips = []
+
+    def start_document(self, width, height):
+        width = max(int(math.ceil(width*self.scale)), 1)
+        height = max(int(math.ceil(height*self.scale)), 1)
+
+        # premultiplied red, green, blue and alpha
+        self.canvas = numpy.zeros((height, width, 4), dtype=numpy.float32)
+        if self.background is not None:
+            self.canvas[:] = _premultiplied(_parse_color(self.background))
+        self._clips = [(0, 0, width, height)]
+        yield from ()
+
+    def pixels(self):
+        """ returns the canvas as a (height, width, 4) array of 8-bit RGBA values """
+        alpha = self.canvas[..., 3:]
+        rgb = numpy.divide(self.canvas[..., :3], alpha, out=numpy.zeros_like(self.canvas[..., :3]),
+                           where=alpha>0)
+        pixels = numpy.concatenate([rgb, alpha], axis=2)
+        return numpy.round(numpy.clip(pixels, 0, 1)*255).astype(numpy.uint8)
+
+    def _paint(self, left, top, coverage, color, opacity=1.0):
+        """
+        Paints ``color`` onto the canvas, where ``coverage`` is the fraction of each pixel
+        covered by the shape, starting at pixel (``left``, ``top``).
+        """
+        color = _parse_color(color)
+        if color is None or coverage.size == 0: return
+        alpha = color[3] * opacity
+        if alpha <= 0: return
+
+        cx0, cy0, cx1, cy1 = self._clips[-1]
+        x0, y0 = max(left, cx0), max(top, cy0)
+        x1, y1 = min(left+coverage.shape[1], cx1), min(top+coverage.shape[0], cy1)
+        if x0 >= x1 or y0 >= y1: return
+
+        coverage = coverage[y0-top:y1-top, x0-left:x1-left, None] * numpy.float32(alpha)
+        region = self.canvas[y0:y1, x0:x1]
+        region *= 1 - coverage
+        region += coverage * numpy.array(color[:3]+(1,), dtype=numpy.float32)
+
+    def _frame(self, x0, y0, x1, y1):
+        """ the visible pixels (left, top, right, bottom) touched by a box, in pixels """
+        cx0, cy0, cx1, cy1 = self._clips[-1]
+        left, top = max(int(math.floor(x0)), cx0), max(int(math.floor(y0)), cy0)
+        right, bottom = min(int(math.ceil(x1)), cx1), min(int(math.ceil(y1)), cy1)
+        if left >= right or top >= bottom:
+            return None
+        return left, top, right, bottom
+
+    def _box_coverage(self, frame, x0, y0, x1, y1):
+        left, top, right, bottom = frame
+        return numpy.outer(_coverage(y0, y1, top, bottom-top), _coverage(x0, x1, left, right-left))
+
+    def _fill_polygon(self, points, color, opacity=1.0, samples=4):
+        xs, ys = numpy.array(points, dtype=float).T * self.scale
+        frame = self._frame(xs.min(), ys.min(), xs.max(), ys.max())
+        if frame is None: return
+        left, top, right, bottom = frame
+
+        # the edges crossed by each of several horizontal scanlines per row of pixels
+        x0s, y0s, x1s, y1s = xs, ys, numpy.roll(xs, -1), numpy.roll(ys, -1)
+        scanlines = (numpy.arange(top, bottom)[:, None] + (numpy.arange(samples)+0.5)/samples).reshape(-1, 1)
+        crosses = (y0s <= scanlines) != (y1s <= scanlines)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            crossings = x0s + (scanlines-y0s) * (x1s-x0s) / (y1s-y0s)
+        crossings = numpy.sort(numpy.where(crosses, crossings, numpy.inf), axis=1)
+
+        # the polygon covers the spans between alternate crossings (ie, the even-odd rule)
+        starts, ends = crossings[:, 0:len(xs)-1:2, None], crossings[:, 1::2, None]
+        columns = numpy.arange(left, right)
+        coverage = numpy.clip(numpy.minimum(ends, columns+1) - numpy.maximum(starts, columns), 0, 1).sum(axis=1)
+        coverage = coverage.reshape(bottom-top, samples, -1).mean(axis=1)
+
+        self._paint(left, top, coverage, color, opacity)
+
+    def _stroke_segment(self, x1, y1, x2, y2, width, color, opacity=1.0, cap="butt"):
+        x1, y1, x2, y2, width = [value*self.scale for value in (x1, y1, x2, y2, width)]
+
+        length = math.hypot(x2-x1, y2-y1)
+        if length == 0: return
+        if cap == "square":
+            ex, ey = (x2-x1)/length*width/2, (y2-y1)/length*width/2
+            x1, y1, x2, y2 = x1-ex, y1-ey, x2+ex, y2+ey
+
+        # the line is drawn one column of pixels at a time (or one row, for steep lines)
+        steep = abs(y2-y1) > abs(x2-x1)
+        if steep:
+            x1, y1, x2, y2 = y1, x1, y2, x2
+        if x1 > x2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+
+        slope = (y2-y1) / (x2-x1)
+        half = width/2 * math.sqrt(1+slope*slope)
+
+        cx0, cy0, cx1, cy1 = self._clips[-1]
+        if steep:
+            cx0, cy0, cx1, cy1 = cy0, cx0, cy1, cx1
+        first, last = max(int(math.floor(x1)), cx0), min(int(math.ceil(x2)), cx1)
+        if first >= last: return
+
+        columns = numpy.arange(first, last)
+        centers = y1 + slope * (numpy.clip(columns+0.5, x1, x2) - x1)
+        top = max(int(math.floor(centers.min()-half)), cy0)
+        bottom = min(int(math.ceil(centers.max()+half)), cy1)
+        if top >= bottom: return
+
+        rows = numpy.arange(top, bottom)[:, None]
+        coverage = numpy.clip(numpy.minimum(centers+half, rows+1) - numpy.maximum(centers-half, rows), 0, 1)
+        coverage *= _coverage(x1, x2, first, last-first)
+
+        if steep:
+            self._paint(top, first, coverage.T, color, opacity)
+        else:
+            self._paint(first, top, coverage, color, opacity)
+
+    def _stroke(self, points, options, closed=False):
+        color = _option(options, "stroke", "none")
+        if _parse_color(color) is None: return
+
+        width = float(_option(options, "stroke-width", 1))
+        opacity = _opacity(options, "stroke")
+        cap = _option(options, "stroke-linecap", "butt")
+        if closed:
+            points = list(points) + [points[0]]
+        for (x1, y1), (x2, y2) in zip(points[:-1], points[1:]):
+            self._stroke_segment(x1, y1, x2, y2, width, color, opacity, cap)
+
+    def _fill(self, points, options):
+        self._fill_polygon(points, _option(options, "fill", "black"), _opacity(options, "fill"))
+
+
+    def text(self, x, y, text, size=10, anchor="middle", family="Helvetica", **kwdargs):
+        if not self.draw_text: return
+
+        text = "".join(char if " " <= char <= "~" else "?" for char in str(text))
+        if not text: return
+
+        glyphs = _FONT[[ord(char)-32 for char in text]]
+        # one blank column between glyphs
+        bitmap = numpy.concatenate([glyphs, numpy.zeros_like(glyphs[:, :, :1])], axis=2)
+        bitmap = bitmap.transpose(1, 0, 2).reshape(7, -1)[:, :-1]
+        if _option(kwdargs, "font-weight", "normal") in ["bold", "bolder", "600", "700", "800", "900"]:
+            bitmap = numpy.pad(bitmap, ((0, 0), (0, 1)))
+            bitmap[:, 1:] = numpy.maximum(bitmap[:, 1:], bitmap[:, :-1])
+
+        unit = float(size) / 10
+        width = bitmap.shape[1] * unit
+        left = {"start":x, "middle":x-width/2, "end":x-width}[anchor]
+        top = y - 7*unit
+
+        left, top, unit = left*self.scale, top*self.scale, unit*self.scale
+        frame = self._frame(left, top, left+width*self.scale, top+7*unit)
+        if frame is None: return
+        fx0, fy0, fx1, fy1 = frame
+
+        # each pixel is covered by the parts of the bitmap that overlap it
+        def overlaps(start, first, last, n):
+            pixels = numpy.arange(first, last)[:, None]
+            cells = start + numpy.arange(n)*unit
+            return numpy.clip(numpy.minimum(cells+unit, pixels+1) - numpy.maximum(cells, pixels), 0, 1)
+
+        coverage = overlaps(top, fy0, fy1, 7) @ bitmap @ overlaps(left, fx0, fx1, bitmap.shape[1]).T
+        self._paint(fx0, fy0, numpy.clip(coverage, 0, 1), _option(kwdargs, "fill", "black"),
+                    _opacity(kwdargs, "fill"))
+        yield from ()
+
+    def text_with_background(self, x, y, text, size=10, anchor="middle", text_color="black", bg="white", bg_opacity=0.8, **kwdargs):
+        if not self.draw_text: return
+
+        unit = float(size) / 10
+        width = (len(str(text))*6 - 1) * unit
+        left = {"start":x, "middle":x-width/2, "end":x-width}[anchor]
+        yield from self.rect(left, y-8*unit, width, 10*unit, fill=bg, stroke="none", opacity=bg_opacity)
+
+        kwdargs["fill"] = text_color
+        yield from self.text(x, y, text, size, anchor, **kwdargs)
+
+    def rect(self, x, y, width, height, **kwdargs):
+        defaults = {"fill":"white", "stroke":"black"}
+        defaults.update(kwdargs)
+
+        # as in svg, rects with no area aren't drawn
+        if width <= 0 or height <= 0: return
+
+        x0, y0 = x*self.scale, y*self.scale
+        x1, y1 = (x+width)*self.scale, (y+height)*self.scale
+        frame = self._frame(x0, y0, x1, y1)
+        if frame is not None:
+            self._paint(frame[0], frame[1], self._box_coverage(frame, x0, y0, x1, y1),
+                        _option(defaults, "fill", "black"), _opacity(defaults, "fill"))
+
+        stroke = _option(defaults, "stroke", "none")
+        if _parse_color(stroke) is not None:
+            # the stroke is centered on the outline
+            pad = float(_option(defaults, "stroke-width", 1)) * self.scale / 2
+            frame = self._frame(x0-pad, y0-pad, x1+pad, y1+pad)
+            if frame is not None:
+                coverage = self._box_coverage(frame, x0-pad, y0-pad, x1+pad, y1+pad)
+                if x1-x0 > 2*pad and y1-y0 > 2*pad:
+                    coverage -= self._box_coverage(frame, x0+pad, y0+pad, x1-pad, y1-pad)
+                self._paint(frame[0], frame[1], coverage, stroke, _opacity(defaults, "stroke"))
+        yield from ()
+
+    def line(self, x1, y1, x2, y2, **kwdargs):
+        defaults = {"stroke":"black"}
+        defaults.update(kwdargs)
+        self._stroke([(x1, y1), (x2, y2)], defaults)
+        yield from ()
+
+    def line_with_arrows(self, x1, y1, x2, y2, n=None, arrows=None, direction="right",
+                         color="black", filled=True,
+                         arrow_scale=None, arrowKwdArgs=None, **kwdargs):
+        defaults = {"stroke":color}
+        defaults.update(kwdargs)
+        yield from self.line(x1, y1, x2, y2, **defaults)
+
+        if arrowKwdArgs is None: arrowKwdArgs = {}
+        if arrow_scale is None:
+            arrow_scale = kwdargs.get("stroke-width", 1)
+        if n is not None:
+            arrows = numpy.arange(n) / n
+
+        for arrow in arrows:
+            yield from self.arrow(x1+float(x2-x1)*arrow, y1+float(y2-y1)*arrow, direction,
+                                  filled=filled, color=color, scale=arrow_scale, **arrowKwdArgs)
+
+    def arrow(self, x, y, direction, color="black", scale=1.0, filled=True, **kwdargs):
+        sign = 1 if direction == "right" else -1
+        points = [(x-2.5*scale*sign, y-5*scale), (x+2.5*scale*sign, y), (x-2.5*scale*sign, y+5*scale)]
+
+        options = dict(kwdargs, stroke=color, fill=color)
+        if filled:
+            self._fill(points, options)
+        self._stroke(points, options, closed=filled)
+        yield from ()
+
+    def block_arrow(self, left, top, width, height, arrow_width, direction, **kwdargs):
+        options = dict(kwdargs)
+        options.setdefault("stroke", "none")
+        options.setdefault("fill", "black")
+
+        if direction == "right":
+            points = [(left, top), (left+width, top), (left+width+arrow_width, top+height/2),
+                      (left+width, top+height), (left, top+height)]
+        else:
+            points = [(left, top), (left+width, top), (left+width, top+height),
+                      (left, top+height), (left-arrow_width, top+height/2)]
+
+        self._fill(points, options)
+        self._stroke(points, options, closed=True)
+        yield from ()
+
+
+    def start_clipped_group(self, x, y, width, height, name):
+        cx0, cy0, cx1, cy1 = self._clips[-1]
+        x0, y0 = int(round(x*self.scale)), int(round(y*self.scale))
+        x1, y1 = int(round((x+width)*self.scale)), int(round((y+height)*self.scale))
+        self._clips.append((max(x0, cx0), max(y0, cy0), min(x1, cx1), min(y1, cy1)))
+        yield from ()
+
+    def stop_clipped_group(self):
+        self._clips.pop()
+        yield from ()
+
+
+def _coverage(start, end, first, n):
+    """ the fraction of each of the ``n`` pixels from ``first`` onwards that lies between start and end """
+    pixels = numpy.arange(first, first+n)
+    return numpy.clip(numpy.minimum(end, pixels+1) - numpy.maximum(start, pixels), 0, 1)
+
+def _option(options, key, default):
+    # as in svg, missing (or empty) attributes take their default value
+    value = options.get(key)
+    if value is None or value == "":
+        return default
+    return value
+
+def _opacity(options, kind):
+    return float(_option(options, "opacity", 1)) * float(_option(options, kind+"-opacity", 1))
+
+def _premultiplied(color):
+    if color is None:
+        return (0, 0, 0, 0)
+    red, green, blue, alpha = color
+    return (red*alpha, green*alpha, blue*alpha, alpha)
+
+@functools.lru_cache(maxsize=None)
+def _parse_color(color):
+    """
+    Returns an svg color as (red, green, blue, alpha) values between 0 and 1, or None
+    for colors that aren't painted (eg "none").
+    """
+    color = str(color).strip().lower()
+    if color in ["none", "transparent", ""]:
+        return None
+
+    color = _NAMED_COLORS.get(color, color)
+    if color.startswith("#"):
+        digits = color[1:]
+        if len(digits) in [3, 4]:
+            digits = "".join(digit*2 for digit in digits)
+        if len(digits) == 6:
+            digits += "ff"
+        if len(digits) == 8:
+            return tuple(int(digits[i:i+2], 16)/255 for i in range(0, 8, 2))
+
+    match = re.match(r"rgba?\((.*)\)$", color)
+    if match:
+        values = [value.strip() for value in match.group(1).split(",")]
+        channels = [float(value[:-1])/100 if value.endswith("%") else float(value)/255 for value in values[:3]]
+        alpha = float(values[3]) if len(values) > 3 else 1.0
+        return tuple(min(max(channel, 0), 1) for channel in channels) + (alpha,)
+
+    raise ValueError("Unknown color: {}".format(color))
+
+
+def write_png(pixels, outf):
+    """
+    Writes a (height, width, 4) array of 8-bit RGBA values to a binary file-like
+    object as a PNG.
+    """
+    height, width, _ = pixels.shape
+
+    # each row starts with its filter type (0, ie no filtering)
+    rows = numpy.zeros((height, width*4+1), dtype=numpy.uint8)
+    rows[:, 1:] = pixels.reshape(height, width*4)
+
+    outf.write(b"\x89PNG\r\n\x1a\n")
+    _write_png_chunk(outf, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+    _write_png_chunk(outf, b"IDAT", zlib.compress(rows.tobytes(), 6))
+    _write_png_chunk(outf, b"IEND", b"")
+
+def _write_png_chunk(outf, kind, data):
+    outf.write(struct.pack(">I", len(data)))
+    outf.write(kind)
+    outf.write(data)
+    outf.write(struct.pack(">I", zlib.crc32(kind+data) & 0xffffffff))
+
+
+# a 5x7 pixel font for the printable ascii characters (" " to "~"); each glyph is 5
+# columns, with the top row in the lowest bit
+_FONT_DATA = """
+    0000000000 00005F0000 0007000700 147F147F14 242A7F2A12 2313086462 3649552250 0005030000
+    001C224100 0041221C00 082A1C2A08 08083E0808 0050300000 0808080808 0060600000 2010080402
+    3E5149453E 00427F4000 4261514946 2141454B31 1814127F10 2745454539 3C4A494930 0171090503
+    3649494936 064949291E 0036360000 0056360000 0008142241 1414141414 4122140800 0201510906
+    324979413E 7E1111117E 7F49494936 3E41414122 7F4141221C 7F49494941 7F09090101 3E41415132
+    7F0808087F 00417F4100 2040413F01 7F08142241 7F40404040 7F0204027F 7F0408107F 3E4141413E
+    7F09090906 3E4151215E 7F09192946 4649494931 01017F0101 3F4040403F 1F2040201F 7F2018207F
+    6314081463 0304780403 6151494543 00007F4141 0204081020 41417F0000 0402010204 4040404040
+    0001020400 2054545478 7F48444438 3844444420 384444487F 3854545418 087E090102 081454543C
+    7F08040478 00447D4000 2040443D00 007F102844 00417F4000 7C04180478 7C08040478 3844444438
+    7C14141408 081414187C 7C08040408 4854545420 043F444020 3C4040207C 1C2040201C 3C4030403C
+    4428102844 0C5050503C 4464544C44 0008364100 00007F0000 0041360800 0804081008
+"""
+
+def _decode_font(data):
+    columns = numpy.array([list(bytes.fromhex(glyph)) for glyph in data.split()], dtype=numpy.uint8)
+    # (glyph, row, column)
+    return ((columns[:, None, :] >> numpy.arange(7)[None, :, None]) & 1).astype(numpy.float64)
+
+_FONT = _decode_font(_FONT_DATA)
+
+
+_NAMED_COLORS = {name:"#"+value for name, value in (entry.split(":") for entry in """
+    aliceblue:f0f8ff antiquewhite:faebd7 aqua:00ffff aquamarine:7fffd4 azure:f0ffff beige:f5f5dc
+    bisque:ffe4c4 black:000000 blanchedalmond:ffebcd blue:0000ff blueviolet:8a2be2 brown:a52a2a
+    burlywood:deb887 cadetblue:5f9ea0 chartreuse:7fff00 chocolate:d2691e coral:ff7f50
+    cornflowerblue:6495ed cornsilk:fff8dc crimson:dc143c cyan:00ffff darkblue:00008b darkcyan:008b8b
+    darkgoldenrod:b8860b darkgray:a9a9a9 darkgreen:006400 darkgrey:a9a9a9 darkkhaki:bdb76b
+    darkmagenta:8b008b darkolivegreen:556b2f darkorange:ff8c00 darkorchid:9932cc darkred:8b0000
+    darksalmon:e9967a darkseagreen:8fbc8f darkslateblue:483d8b darkslategray:2f4f4f
+    darkslategrey:2f4f4f darkturquoise:00ced1 darkviolet:9400d3 deeppink:ff1493 deepskyblue:00bfff
+    dimgray:696969 dimgrey:696969 dodgerblue:1e90ff firebrick:b22222 floralwhite:fffaf0
+    forestgreen:228b22 fuchsia:ff00ff gainsboro:dcdcdc ghostwhite:f8f8ff gold:ffd700
+    goldenrod:daa520 gray:808080 green:008000 greenyellow:adff2f grey:808080 honeydew:f0fff0
+    hotpink:ff69b4 indianred:cd5c5c indigo:4b0082 ivory:fffff0 khaki:f0e68c lavender:e6e6fa
+    lavenderblush:fff0f5 lawngreen:7cfc00 lemonchiffon:fffacd lightblue:add8e6 lightcoral:f08080
+    lightcyan:e0ffff lightgoldenrodyellow:fafad2 lightgray:d3d3d3 lightgreen:90ee90
+    lightgrey:d3d3d3 lightpink:ffb6c1 lightsalmon:ffa07a lightseagreen:20b2aa lightskyblue:87cefa
+    lightslategray:778899 lightslategrey:778899 lightsteelblue:b0c4de lightyellow:ffffe0
+    lime:00ff00 limegreen:32cd32 linen:faf0e6 magenta:ff00ff maroon:800000
+    mediumaquamarine:66cdaa mediumblue:0000cd mediumorchid:ba55d3 mediumpurple:9370db
+    mediumseagreen:3cb371 mediumslateblue:7b68ee mediumspringgreen:00fa9a
+    mediumturquoise:48d1cc mediumvioletred:c71585 midnightblue:191970 mintcream:f5fffa
+    mistyrose:ffe4e1 moccasin:ffe4b5 navajowhite:ffdead navy:000080 oldlace:fdf5e6 olive:808000
+    olivedrab:6b8e23 orange:ffa500 orangered:ff4500 orchid:da70d6 palegoldenrod:eee8aa
+    palegreen:98fb98 paleturquoise:afeeee palevioletred:db7093 papayawhip:ffefd5
+    peachpuff:ffdab9 peru:cd853f pink:ffc0cb plum:dda0dd powderblue:b0e0e6 purple:800080
+    rebeccapurple:663399 red:ff0000 rosybrown:bc8f8f royalblue:4169e1 saddlebrown:8b4513
+    salmon:fa8072 sandybrown:f4a460 seagreen:2e8b57 seashell:fff5ee sienna:a0522d silver:c0c0c0
+    skyblue:87ceeb slateblue:6a5acd slategray:708090 slategrey:708090 snow:fffafa
+    springgreen:00ff7f steelblue:4682b4 tan:d2b48c teal:008080 thistle:d8bfd8 tomato:ff6347
+    turquoise:40e0d0 violet:ee82ee wheat:f5deb3 white:ffffff whitesmoke:f5f5f5 yellow:ffff00
+    yellowgreen:9acd32
+    """.split())}
@@ -0,0 +1,295 @@
+import numpy
+
+from genomeview.utilities import expand_ranges
+
+
+# bam flags
+PAIRED = 0x1
+PROPER_PAIR = 0x2
+UNMAPPED = 0x4
+REVERSE = 0x10
+READ1 = 0x40
+SECONDARY = 0x100
+
+# CIGAR operations consuming reference / query sequence
+CONSUMES_REFERENCE = numpy.zeros(16, dtype=bool)
+CONSUMES_REFERENCE[[0, 2, 3, 7, 8]] = True
+CONSUMES_QUERY = numpy.zeros(16, dtype=bool)
+CONSUMES_QUERY[[0, 1, 4, 7, 8]] = True
+
+
+class ReadBatch:
+    """
+    A set of reads (eg, those displayed by a bam track) stored column-wise as numpy arrays,
+    decoded from pysam in a single pass so that layout and drawing don't need to go back
+    to the individual pysam.AlignedSegment objects.
+
+    The CIGAR operations and sequences of all reads are packed into flat buffers; the
+    ops of read ``i`` are ``cigar_ops[cigar_offsets[i]:cigar_offsets[i+1]]`` (and likewise
+    for ``cigar_lengths``, and for ``seq`` using ``seq_offsets``).
+
+    Attributes:
+        start, end (numpy.ndarray): reference start and end coordinates of each read
+        flag (numpy.ndarray): bam flags
+        mapq (numpy.ndarray): mapping qualities
+        next_start (numpy.ndarray): reference start coordinate of each read's mate
+        names (list): query names
+        md (list): MD tag of each read (None if missing)
+        index (numpy.ndarray): position of each read in the sequence of reads the batch
+            was created from (before filtering)
+        reads (list): the pysam.AlignedSegment objects, for callbacks that need the full
+            read (eg ``color_fn``); None if the batch was created with ``keep_reads=False``
+    """
+    def __init__(self, start, end, flag, mapq, next_start, names, md,
+                 cigar_offsets, cigar_ops, cigar_lengths, seq_offsets, seq, index, reads=None):
+        self.start = start
+        self.end = end
+        self.flag = flag
+        self.mapq = mapq
+        self.next_start = next_start
+        self.names = names
+        self.md = md
+
+        self.cigar_offsets = cigar_offsets
+        self.cigar_ops = cigar_ops
+        self.cigar_lengths = cigar_lengths
+        self.seq_offsets = seq_offsets
+        self.seq = seq
+
+        self.index = index
+        self.reads = reads
+
+        self._op_ref = None
+        self._op_query = None
+
+    @classmethod
+    def from_reads(cls, reads, index=None, keep_reads=True):
+        """
+        Creates a batch from an iterable of pysam.AlignedSegment.
+
+        Args:
+            reads: the reads
+            index: optional sequence of integers to store as ``index`` (default: 0...n-1)
+            keep_reads: whether to keep references to the pysam objects (see ``reads``)
+        """
+        reads = list(reads)
+        n = len(reads)
+
+        start = numpy.empty(n, dtype=numpy.int64)
+        end = numpy.empty(n, dtype=numpy.int64)
+        flag = numpy.empty(n, dtype=numpy.uint16)
+        mapq = numpy.empty(n, dtype=numpy.uint8)
+        next_start = numpy.empty(n, dtype=numpy.int64)
+        cigar_counts = numpy.empty(n, dtype=numpy.int64)
+        seq_lengths = numpy.empty(n, dtype=numpy.int64)
+
+        names = []
+        md = []
+        cigars = []
+        seqs = []
+
+        for i, read in enumerate(reads):
+            start[i] = read.reference_start
+            reference_end = read.reference_end
+            end[i] = reference_end if reference_end is not None else read.reference_start
+            flag[i] = read.flag
+            mapq[i] = read.mapping_quality
+            next_start[i] = read.next_reference_start
+            names.append(read.query_name)
+
+            try:
+                md.append(read.get_tag("MD"))
+            except KeyError:
+                md.append(None)
+
+            cigar = read.cigartuples or []
+            cigars.extend(cigar)
+            cigar_counts[i] = len(cigar)
+
+            seq = read.query_sequence or ""
+            seqs.append(seq)
+            seq_lengths[i] = len(seq)
+
+        cigar = numpy.array(cigars, dtype=numpy.int64).reshape(-1, 2)
+
+        if index is None:
+            index = numpy.arange(n)
+
+        return cls(start, end, flag, mapq, next_start, names, md,
+                   _offsets(cigar_counts), cigar[:, 0].astype(numpy.uint8), cigar[:, 1],
+                   _offsets(seq_lengths), numpy.frombuffer("".join(seqs).encode(), dtype=numpy.uint8),
+                   numpy.asarray(index, dtype=numpy.int64), reads if keep_reads else None)
+
+    def __len__(self):
+        return len(self.start)
+
+    def take(self, indices):
+        """
+        Returns a new batch with the reads at ``indices`` (integers or a boolean mask).
+        """
+        indices = numpy.arange(len(self))[indices]
+
+        cigar = _take_ranges(self.cigar_offsets, indices)
+        seq = _take_ranges(self.seq_offsets, indices)
+
+        reads = None
+        if self.reads is not None:
+            reads = [self.reads[i] for i in indices]
+
+        return ReadBatch(
+            self.start[indices], self.end[indices], self.flag[indices], self.mapq[indices],
+            self.next_start[indices], [self.names[i] for i in indices], [self.md[i] for i in indices],
+            _offsets(numpy.diff(self.cigar_offsets)[indices]), self.cigar_ops[cigar], self.cigar_lengths[cigar],
+            _offsets(numpy.diff(self.seq_offsets)[indices]), self.seq[seq],
+            self.index[indices], reads)
+
+    def cigar(self, i):
+        """ the CIGAR operations and lengths of read ``i`` """
+        first, last = self.cigar_offsets[i], self.cigar_offsets[i+1]
+        return self.cigar_ops[first:last], self.cigar_lengths[first:last]
+
+    def cigar_positions(self, i):
+        """ 
+        the reference and query coordinates at which each CIGAR operation of read ``i`` 
+        starts; computed for all reads at once the first time this is called
+        """
+        if self._op_ref is None:
+            read_of_op = numpy.repeat(numpy.arange(len(self)), numpy.diff(self.cigar_offsets))
+
+            def starts_of_ops(consumes):
+                lengths = numpy.where(consumes[self.cigar_ops], self.cigar_lengths, 0)
+                before = numpy.zeros(len(lengths)+1, dtype=numpy.int64)
+                numpy.cumsum(lengths, out=before[1:])
+                return before[:-1] - before[self.cigar_offsets[:-1]][read_of_op]
+
+            self._op_ref = starts_of_ops(CONSUMES_REFERENCE) + self.start[read_of_op]
+            self._op_query = starts_of_ops(CONSUMES_QUERY)
+
+        first, last = self.cigar_offsets[i], self.cigar_offsets[i+1]
+        return self._op_ref[first:last], self._op_query[first:last]
+
+    def sequence(self, i):
+        """ the query sequence of read ``i``, as a numpy array of ascii codes """
+        return self.seq[self.seq_offsets[i]:self.seq_offsets[i+1]]
+
+    @property
+    def reverse(self):
+        return (self.flag & REVERSE) != 0
+
+    @property
+    def secondary(self):
+        return (self.flag & SECONDARY) != 0
+
+    @property
+    def unmapped(self):
+        return (self.flag & UNMAPPED) != 0
+
+    @property
+    def proper_pair(self):
+        return (self.flag & PROPER_PAIR) != 0
+
+    @property
+    def nbytes(self):
+        """ memory (in bytes) used by the numpy columns of the batch """
+        return sum(getattr(self, column).nbytes for column in
+                   ["start", "end", "flag", "mapq", "next_start", "cigar_offsets", "cigar_ops",
+                    "cigar_lengths", "seq_offsets", "seq", "index"])
+
+
+def _offsets(lengths):
+    offsets = numpy.zeros(len(lengths)+1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def _take_ranges(offsets, indices):
+    """ indices into a packed buffer of the entries belonging to items ``indices`` """
+    return expand_ranges(offsets[indices], offsets[indices+1] - offsets[indices])
+
+
+class PairIndex:
+    """
+    Groups the reads of a :py:class:`ReadBatch` into read pairs (by query name), with the 
+    coordinates of each pair stored in arrays. Built once per region, and used both to lay 
+    out and to draw paired-end reads.
+
+    Pairs whose mate falls outside of the batch (ie, outside of the current view) extend 
+    to the position of the mate if the read is properly paired.
+
+    Attributes:
+        names (list): the query name of each pair
+        pair_of_read (numpy.ndarray): the pair that each read of the batch belongs to
+        start, end (numpy.ndarray): the extent of each pair (including the gap between mates)
+        order (numpy.ndarray): the pairs, sorted by start and end coordinates (the order 
+            in which they are laid out)
+    """
+    def __init__(self, batch):
+        ids = {}
+        pair_of_read = numpy.fromiter(
+            (ids.setdefault(name, len(ids)) for name in batch.names), dtype=numpy.int64, count=len(batch))
+        self.names = names = list(ids)
+        self.pair_of_read = pair_of_read
+
+        n_pairs = len(names)
+        proper = batch.proper_pair.astype(numpy.int64)
+        fields = [batch.start, batch.end, batch.next_start, proper]
+
+        # the first and last alignment of each pair, comparing (start, end, mate start, 
+        # proper pair) lexicographically
+        by_pair = numpy.lexsort(fields[::-1] + [pair_of_read])
+        self._counts = counts = numpy.bincount(pair_of_read, minlength=n_pairs)
+        offsets = _offsets(counts)
+        first = [field[by_pair[offsets[:-1]]] for field in fields]
+        last = [field[by_pair[offsets[1:]-1]] for field in fields]
+
+        # a read whose mate is outside of the batch is paired with a placeholder at the mate's 
+        # position, (mate start, mate start), which sorts before a read with the same prefix
+        single = counts == 1
+        with_mate = single & (first[3] == 1)
+        mate = [first[2], first[2], numpy.full(n_pairs, _MISSING), numpy.full(n_pairs, _MISSING)]
+        mate_first = with_mate & _lexicographic_less(mate, first)
+
+        key0 = [numpy.where(mate_first, m, f) for m, f in zip(mate, first)]
+        key1 = [numpy.where(with_mate, numpy.where(mate_first, f, m), numpy.where(single, _MISSING, l))
+                for m, f, l in zip(mate, first, last)]
+
+        self.start = key0[0]
+        self.end = numpy.where(single & ~with_mate, key0[1], key1[1])
+        self.order = numpy.lexsort(key1[::-1] + key0[::-1])
+
+    def __len__(self):
+        return len(self.names)
+
+    def units(self):
+        """
+        Returns a list of the read pairs in the order that they should be drawn: each 
+        element is a list of the indices (into the batch) of the two mates of a pair, 
+        ordered by the position of the second mate in the batch, followed by the reads 
+        whose mate is not in the batch. Additional alignments sharing the name of a pair 
+        (eg supplementary alignments) are paired up in the order they appear.
+        """
+        pair_of_read = self.pair_of_read
+
+        # the number of earlier alignments with the same name as each read
+        grouped = numpy.argsort(pair_of_read, kind="stable")
+        occurrence = numpy.empty(len(grouped), dtype=numpy.int64)
+        occurrence[grouped] = numpy.arange(len(grouped)) - _offsets(self._counts)[pair_of_read[grouped]]
+
+        second = numpy.flatnonzero(occurrence % 2 == 1)
+        mates = numpy.empty(len(grouped), dtype=numpy.int64)
+        mates[grouped[1:]] = grouped[:-1]
+        singles = numpy.flatnonzero((occurrence % 2 == 0) & (occurrence == self._counts[pair_of_read]-1))
+
+        return ([[mate, i] for mate, i in zip(mates[second].tolist(), second.tolist())]
+                + [[i] for i in singles.tolist()])
+
+
+_MISSING = numpy.iinfo(numpy.int64).min
+
+def _lexicographic_less(a, b):
+    """ elementwise lexicographic comparison of two lists of columns """
+    less = numpy.zeros(len(a[0]), dtype=bool)
+    equal = numpy.ones(len(a[0]), dtype=bool)
+    for a_field, b_field in zip(a, b):
+        less |= equal & (a_field < b_field)
+        equal &= a_field == b_field
+    return less
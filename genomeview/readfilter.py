@@ -0,0 +1,133 @@
+import numpy
+
+from genomeview.readbatch import REVERSE
+
+
+class ReadFilter:
+    """
+    A declarative specification of which reads to display, eg::
+
+        ReadFilter(min_mapq=20, exclude_flags=0x400, tags={"HP":1})
+
+    The filter is compiled once into a single predicate, which is called with a read
+    (pysam.AlignedSegment) and returns True if the read passes; :py:meth:`mask` applies
+    the filter to a :py:class:`genomeview.readbatch.ReadBatch`. Filters are immutable and
+    hashable, with equal specifications comparing equal, so they can be used as (part of)
+    cache keys.
+
+    Args:
+        min_mapq (int): minimum mapping quality
+        require_flags (int): flag bits that must all be set
+        exclude_flags (int): flag bits that must all be unset
+        tags (dict): maps tag names to the required value, or to a list/set of allowed values;
+            reads missing the tag are excluded
+        read_groups: read group ids to include (shorthand for ``tags={"RG":read_groups}``)
+        strand (str): "+" or "-" to only include reads aligned to that strand
+    """
+    def __init__(self, min_mapq=0, require_flags=0, exclude_flags=0, tags=None,
+                 read_groups=None, strand=None):
+        tags = dict(tags or {})
+        if read_groups is not None:
+            tags["RG"] = read_groups
+
+        if strand == "+":
+            exclude_flags |= REVERSE
+        elif strand == "-":
+            require_flags |= REVERSE
+        elif strand is not None:
+            raise ValueError("strand must be one of '+', '-' or None, not {!r}".format(strand))
+
+        normalized_tags = []
+        for tag, allowed in sorted(tags.items()):
+            if isinstance(allowed, (list, tuple, set, frozenset)):
+                allowed = frozenset(allowed)
+            else:
+                allowed = frozenset([allowed])
+            normalized_tags.append((tag, allowed))
+
+        self._key = (int(min_mapq), int(require_flags), int(exclude_flags), tuple(normalized_tags))
+        self._predicate = self._compile()
+
+    @property
+    def min_mapq(self):
+        return self._key[0]
+
+    @property
+    def require_flags(self):
+        return self._key[1]
+
+    @property
+    def exclude_flags(self):
+        return self._key[2]
+
+    @property
+    def tags(self):
+        return dict(self._key[3])
+
+    def _compile(self):
+        min_mapq, require_flags, exclude_flags, tags = self._key
+
+        def predicate(read):
+            flag = read.flag
+            if flag & exclude_flags or (flag & require_flags) != require_flags:
+                return False
+            if min_mapq and read.mapping_quality < min_mapq:
+                return False
+            for tag, allowed in tags:
+                try:
+                    if read.get_tag(tag) not in allowed:
+                        return False
+                except KeyError:
+                    return False
+            return True
+
+        return predicate
+
+    def __call__(self, read):
+        return self._predicate(read)
+
+    def mask(self, batch):
+        """
+        Returns a boolean array specifying which reads of the batch pass the filter. Flags
+        and mapping qualities are checked using the batch's columns; tags are read from
+        ``batch.reads``.
+        """
+        min_mapq, require_flags, exclude_flags, tags = self._key
+
+        passes = ((batch.flag & exclude_flags) == 0) & ((batch.flag & require_flags) == require_flags)
+        if min_mapq:
+            passes &= batch.mapq >= min_mapq
+
+        if tags:
+            if batch.reads is None:
+                raise ValueError("Filtering by tag requires a ReadBatch that keeps its reads")
+            candidates = numpy.flatnonzero(passes)
+            passes[candidates] = [self._predicate(batch.reads[i]) for i in candidates]
+
+        return passes
+
+    def combine(self, other):
+        """
+        Returns a filter passing only the reads that pass both this filter and ``other``.
+        """
+        tags = self.tags
+        for tag, allowed in other.tags.items():
+            if tag in tags:
+                allowed = tags[tag] & allowed
+            tags[tag] = allowed
+
+        return ReadFilter(max(self.min_mapq, other.min_mapq),
+                          self.require_flags | other.require_flags,
+                          self.exclude_flags | other.exclude_flags,
+                          tags)
+
+    def __eq__(self, other):
+        return isinstance(other, ReadFilter) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        min_mapq, require_flags, exclude_flags, tags = self._key
+        return "ReadFilter(min_mapq={}, require_flags={:#x}, exclude_flags={:#x}, tags={})".format(
+            min_mapq, require_flags, exclude_flags, {tag:sorted(allowed, key=str) for tag, allowed in tags})
@@ -1,8 +1,38 @@
+import collections
+import functools
 import itertools
 import numpy
 
 class GraphicsBackend:
-    pass
+    """
+    Backends implement the individual drawing primitives (``rect``, ``line``, ``text`` 
+    etc). The batched primitives ``rects`` and ``lines`` take arrays of coordinates, 
+    plus options that are either a single value, or a list/array with one value per 
+    element (eg ``fill``); by default they draw each element in turn, but backends can 
+    override them to draw all the elements at once.
+    """
+    def start_document(self, width, height):
+        """ called at the start of each :py:meth:`genomeview.Document.render`, with its size """
+        yield from ()
+
+    def stop_document(self):
+        """ called at the end of each :py:meth:`genomeview.Document.render` """
+        yield from ()
+
+    def comment(self, text):
+        """ an optional comment describing the elements that follow """
+        yield from ()
+
+    def rects(self, xs, ys, widths, heights, **kwdargs):
+        xs, ys, widths, heights = _columns(xs, ys, widths, heights)
+        for x, y, width, height, options in zip(xs, ys, widths, heights, _split_options(kwdargs, len(xs))):
+            yield from self.rect(x, y, width, height, **options)
+
+    def lines(self, x1s, y1s, x2s, y2s, **kwdargs):
+        x1s, y1s, x2s, y2s = _columns(x1s, y1s, x2s, y2s)
+        for x1, y1, x2, y2, options in zip(x1s, y1s, x2s, y2s, _split_options(kwdargs, len(x1s))):
+            yield from self.line(x1, y1, x2, y2, **options)
+
     
 def _addOptions(kwdargs, defaults=None):
     if defaults is None: defaults = {}
@@ -13,31 +43,272 @@ def _addOptions(kwdargs, defaults=None):
             options.append("""{key}="{arg}" """.format(key=key, arg=arg))
     return "".join(options)
 
+def _is_per_element(arg):
+    return isinstance(arg, (list, tuple, numpy.ndarray))
+
+def _split_options(kwdargs, n):
+    """ the options for each of ``n`` elements, given options that may be per-element """
+    per_element = {key:list(arg) for key, arg in kwdargs.items() if _is_per_element(arg)}
+    for i in range(n):
+        options = dict(kwdargs)
+        for key, args in per_element.items():
+            options[key] = args[i]
+        yield options
+
+def _batchOptions(kwdargs, defaults, attributes=_addOptions):
+    """
+    Like :py:func:`_addOptions`, but for a batch of elements: returns a %-format string 
+    for the options, along with a list of per-element columns for its placeholders. 
+    ``attributes`` converts a dict of options into attributes.
+    """
+    defaults.update(kwdargs)
+    per_element = [key for key, arg in defaults.items() if _is_per_element(arg)]
+    if not per_element:
+        return attributes(defaults).replace("%", "%%"), []
+
+    # the attributes of each distinct combination of per-element options are only built once
+    combinations = {}
+    column = []
+    for values in zip(*[list(defaults[key]) for key in per_element]):
+        options = combinations.get(values)
+        if options is None:
+            element_options = dict(defaults)
+            element_options.update(zip(per_element, values))
+            options = combinations[values] = attributes(element_options)
+        column.append(options)
+    return "%s", [column]
+
+def _columns(*values):
+    """ broadcasts coordinates (arrays or scalars) against each other, as lists of floats """
+    values = numpy.broadcast_arrays(*[numpy.asarray(value, dtype=float) for value in values])
+    return [numpy.atleast_1d(value).tolist() for value in values]
+
+# attributes that only affect how a shape is painted, and can be moved onto a merged <path>
+_PRESENTATION_ATTRIBUTES = {"fill", "stroke", "stroke-width", "stroke-linecap", "stroke-linejoin", 
+                            "stroke-dasharray", "opacity", "fill-opacity", "stroke-opacity"}
+
+# attributes that can be written as css properties
+_CSS_PROPERTIES = _PRESENTATION_ATTRIBUTES | {"font-size", "font-family", "font-weight", "font-style", 
+                                              "text-anchor"}
+
+def _css_value(key, arg):
+    # unlike attributes, css lengths need units
+    if key in ["font-size", "stroke-width"]:
+        try:
+            float(arg)
+            return arg + "px"
+        except ValueError:
+            pass
+    return arg
+
+def _shape_style(kind, options):
+    """
+    Returns the style used to merge a shape (``kind`` is "fill" for filled shapes or 
+    "stroke" for lines) with the given options, or None if the shape can't be merged. 
+    The ``id`` is dropped, since the shape no longer exists on its own.
+    """
+    options = {key:str(arg) for key, arg in options.items() 
+               if arg is not None and arg != "" and key != "id"}
+    if not set(options).issubset(_PRESENTATION_ATTRIBUTES):
+        return None
+    if kind == "stroke":
+        options.setdefault("fill", "none")
+    return (kind, tuple(sorted(options.items())))
+
+@functools.lru_cache(maxsize=None)
+def _style_is_opaque(style):
+    kind, options = style
+    options = dict(options)
+    if any("opacity" in key for key in options): return False
+    if any(arg.startswith(("rgba", "hsla")) or arg == "transparent" for arg in options.values()): return False
+    # where same-style shapes overlap, the fill of one would otherwise paint over the stroke of another
+    return kind == "stroke" or options.get("stroke", "none") == "none"
+
+def _stroke_padding(options):
+    stroke = options.get("stroke")
+    if stroke is None or stroke == "none":
+        return 1
+    return 2 * float(options.get("stroke-width", 1)) + 1
+
+
+class _PathMerger:
+    """
+    Collects the elements drawn within one clipped group, and writes them out with 
+    shapes of the same style merged into a single ``<path>``.
+
+    To keep the result visually identical, each element is assigned a layer above every 
+    earlier element it overlaps (apart from overlapping shapes of the same opaque style, 
+    which can share a path); layers are then written out in order, one path per style.
+    """
+    cell_size = 32
+
+    def __init__(self, x, y, width, height):
+        self.clip = (x, y, x+width, y+height)
+        self.elements = []
+        self.grid = collections.defaultdict(list)
+
+    def add(self, tag, bbox, style=None, d=None):
+        """
+        Adds an element, given its svg ``tag`` and bounding box (x0, y0, x1, y1; None for 
+        elements that aren't painted, eg ``<defs>``). Shapes that can be merged also 
+        provide their ``style`` (see :py:func:`_shape_style`) and path data ``d``.
+        """
+        layer = 0
+        cells = []
+        if bbox is not None:
+            x0, y0, x1, y1 = bbox
+            cx0, cy0, cx1, cy1 = self.clip
+            x0, y0, x1, y1 = max(x0, cx0-1), max(y0, cy0-1), min(x1, cx1+1), min(y1, cy1+1)
+
+            cells = [(i, j) for i in range(int(x0//self.cell_size), int(x1//self.cell_size)+1)
+                            for j in range(int(y0//self.cell_size), int(y1//self.cell_size)+1)]
+
+            can_overlap = style is not None and _style_is_opaque(style)
+            for cell in cells:
+                for ox0, oy0, ox1, oy1, other_layer, other_style in self.grid[cell]:
+                    if other_layer < layer: continue
+                    if ox0 > x1 or ox1 < x0 or oy0 > y1 or oy1 < y0: continue
+                    if can_overlap and style == other_style: continue
+                    layer = other_layer + 1
+
+            for cell in cells:
+                self.grid[cell].append((x0, y0, x1, y1, layer, style))
+
+        self.elements.append((layer, style, tag, d))
+
+    def flush(self, attributes=_addOptions):
+        """ returns the merged elements, and empties the group """
+        layers = collections.defaultdict(dict)
+        for i, (layer, style, tag, d) in enumerate(self.elements):
+            key = style if style is not None else i
+            layers[layer].setdefault(key, []).append((tag, d))
+
+        merged = []
+        for layer in sorted(layers):
+            for style, elements in layers[layer].items():
+                if len(elements) == 1 or not isinstance(style, tuple):
+                    merged.extend(tag for tag, d in elements)
+                else:
+                    d = "".join(d for tag, d in elements)
+                    merged.append("""<path d="{}" {}/>""".format(d, attributes(dict(style[1]))))
+
+        self.elements = []
+        self.grid.clear()
+        return merged
+
+
 class SVG(GraphicsBackend):
-    _filter_id = 0
+    """
+    Writes documents as SVG.
+
+    Args:
+        merge_paths (bool): if True, rects, lines and block arrows of the same style within 
+            each clipped group (ie, each track) are merged into a single ``<path>``; this 
+            makes large documents much smaller and faster to display, and looks the same, 
+            but drops the ``id`` of the merged elements
+        shared_styles (bool): if True, each distinct combination of styling attributes 
+            (fill, stroke, font etc) is written once, as a css class in a ``<style>`` 
+            block at the end of the document, and arrowheads are drawn as ``<use>`` 
+            references to shared definitions
+
+    The ids of the background filters and arrowheads, and the css class names, are numbered 
+    by a counter shared by all documents, so that several documents can be displayed in the 
+    same page (eg, a notebook) without their definitions clashing.
+    """
+    newid = itertools.count(1)
+
+    def __init__(self, merge_paths=False, shared_styles=False):
+        self.merge_paths = merge_paths
+        self.shared_styles = shared_styles
+        self._groups = []
+        self._reset()
+
+    def _reset(self):
+        self._filters = {}
+        self._classes = {}
+        self._symbols = {}
+
+    def start_document(self, width, height):
+        self._groups = []
+        self._reset()
+        yield from ()
+
+    def stop_document(self):
+        if self._classes:
+            yield "<style>"
+            for style, name in self._classes.items():
+                yield "   .{} {{{}}}".format(
+                    name, ";".join("{}:{}".format(key, _css_value(key, arg)) for key, arg in style))
+            yield "</style>"
+
+    def _attributes(self, options):
+        """ 
+        Formats the options as attributes; with ``shared_styles``, the styling attributes 
+        are replaced by a css class.
+        """
+        if not self.shared_styles:
+            return _addOptions(options)
+
+        style = tuple(sorted((key, str(arg)) for key, arg in options.items()
+                             if key in _CSS_PROPERTIES and arg is not None and arg != ""))
+        more = _addOptions({key:arg for key, arg in options.items() if key not in _CSS_PROPERTIES})
+        if not style:
+            return more
+
+        name = self._classes.get(style)
+        if name is None:
+            name = self._classes[style] = "s{}".format(next(SVG.newid))
+        return """class="{}" """.format(name) + more
+
+    def _draw(self, tag, bbox, style=None, d=None):
+        if self._groups:
+            self._groups[-1].add(tag, bbox, style, d)
+        else:
+            yield tag
+
+    def comment(self, text):
+        yield from self._flush()
+        yield "<!-- {} -->".format(text)
 
     def text(self, x, y, text, size=10, anchor="middle", family="Helvetica", **kwdargs):
         defaults = {}
         assert anchor in ["start", "middle", "end"]
-        yield """<text x="{x:.2f}" y="{y:.2f}" font-size="{size}" font-family="{family}" text-anchor="{anchor}" {more}>{text}</text>""".format(
-            x=x, y=y, size=size, family=family, anchor=anchor, more=_addOptions(kwdargs, defaults), text=text)
+        if self.shared_styles:
+            defaults = {"font-size":size, "font-family":family, "text-anchor":anchor}
+            defaults.update(kwdargs)
+            tag = """<text x="{x:.2f}" y="{y:.2f}" {more}>{text}</text>""".format(
+                x=x, y=y, more=self._attributes(defaults), text=text)
+        else:
+            tag = """<text x="{x:.2f}" y="{y:.2f}" font-size="{size}" font-family="{family}" text-anchor="{anchor}" {more}>{text}</text>""".format(
+                x=x, y=y, size=size, family=family, anchor=anchor, more=_addOptions(kwdargs, defaults), text=text)
+
+        # generous bounds: no glyph is wider than 1.2em
+        width = len(str(text)) * float(size) * 1.2
+        left = {"start":x, "middle":x-width/2, "end":x-width}[anchor]
+        yield from self._draw(tag, (left-1, y-float(size)*1.2, left+width+1, y+float(size)*0.5))
 
     def text_with_background(self, x, y, text, size=10, anchor="middle", text_color="black", bg="white", bg_opacity=0.8, **kwdargs):
-        self._filter_id += 1
-
-        text_filter = [
-            """<defs>""",
-            """    <filter x="0" y="0" width="1" height="1" id="solid{}">""".format(self._filter_id),
-            """        <feFlood flood-opacity="{}" flood-color="{}"/>""".format(bg_opacity, bg),
-            """        <feComposite in="SourceGraphic"/>""",
-            """    </filter>""",
-            """</defs>"""]
-        for line in text_filter:
-            yield line
+        # each distinct background is only defined once per document
+        filter_id = self._filters.get((bg, bg_opacity))
+        if filter_id is None:
+            filter_id = self._filters[(bg, bg_opacity)] = next(SVG.newid)
+
+            text_filter = [
+                """<defs>""",
+                """    <filter x="0" y="0" width="1" height="1" id="solid{}">""".format(filter_id),
+                """        <feFlood flood-opacity="{}" flood-color="{}"/>""".format(bg_opacity, bg),
+                """        <feComposite in="SourceGraphic"/>""",
+                """    </filter>""",
+                """</defs>"""]
+            if self._groups:
+                yield from self._draw("\n".join(text_filter), None)
+            else:
+                for line in text_filter:
+                    yield line
 
         # this is a stoopid hack to get the filter to be fully behind the text, without making it blurry
         kwdargs["fill"] = bg
-        kwdargs["filter"] = "url(#solid{})".format(self._filter_id)
+        kwdargs["filter"] = "url(#solid{})".format(filter_id)
         yield from self.text(x, y, text, size, anchor, **kwdargs)
 
         kwdargs["fill"] = text_color
@@ -48,14 +319,69 @@ class SVG(GraphicsBackend):
 
     def rect(self, x, y, width, height, **kwdargs):
         defaults = {"fill":"white", "stroke":"black"}
+        defaults.update(kwdargs)
         tag = """<rect x="{x:.2f}" y="{y:.2f}" width="{w:.2f}" height="{h:.2f}" {more}/>""".format(
-            x=x, y=y, w=width, h=height, more=_addOptions(kwdargs, defaults))
-        yield tag
+            x=x, y=y, w=width, h=height, more=self._attributes(defaults))
+
+        if not self._groups:
+            yield tag
+            return
+
+        style = d = None
+        x, y, width, height = ["{:.2f}".format(value) for value in [x, y, width, height]]
+        # rects with no area aren't drawn at all, whereas a path would still be stroked
+        if float(width) > 0 and float(height) > 0:
+            style = _shape_style("fill", defaults)
+            d = "M{} {}h{}v{}h-{}z".format(x, y, width, height, width)
+
+        pad = _stroke_padding(defaults)
+        x, y = float(x), float(y)
+        yield from self._draw(tag, (x-pad, y-pad, x+float(width)+pad, y+float(height)+pad), style, d)
 
     def line(self, x1, y1, x2, y2, **kwdargs):
         defaults = {"stroke":"black"}
-        yield """<line x1="{x1:.2f}" x2="{x2:.2f}" y1="{y1:.2f}" y2="{y2:.2f}" {more} />""".format(
-            x1=x1, x2=x2,  y1=y1, y2=y2, more=_addOptions(kwdargs, defaults))
+        defaults.update(kwdargs)
+        tag = """<line x1="{x1:.2f}" x2="{x2:.2f}" y1="{y1:.2f}" y2="{y2:.2f}" {more} />""".format(
+            x1=x1, x2=x2,  y1=y1, y2=y2, more=self._attributes(defaults))
+
+        if not self._groups:
+            yield tag
+            return
+
+        style = _shape_style("stroke", defaults)
+        x1, y1, x2, y2 = ["{:.2f}".format(value) for value in [x1, y1, x2, y2]]
+        d = "M{} {}L{} {}".format(x1, y1, x2, y2)
+
+        pad = _stroke_padding(defaults)
+        x1, y1, x2, y2 = float(x1), float(y1), float(x2), float(y2)
+        yield from self._draw(tag, (min(x1, x2)-pad, min(y1, y2)-pad, max(x1, x2)+pad, max(y1, y2)+pad), style, d)
+
+    def rects(self, xs, ys, widths, heights, **kwdargs):
+        if self._groups:
+            # shapes are merged one at a time
+            yield from super().rects(xs, ys, widths, heights, **kwdargs)
+            return
+
+        defaults = {"fill":"white", "stroke":"black"}
+        options, columns = _batchOptions(kwdargs, defaults, self._attributes)
+        tag = """<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" """ + options + """/>"""
+
+        tags = [tag % values for values in zip(*_columns(xs, ys, widths, heights), *columns)]
+        if tags:
+            yield "\n".join(tags)
+
+    def lines(self, x1s, y1s, x2s, y2s, **kwdargs):
+        if self._groups:
+            yield from super().lines(x1s, y1s, x2s, y2s, **kwdargs)
+            return
+
+        defaults = {"stroke":"black"}
+        options, columns = _batchOptions(kwdargs, defaults, self._attributes)
+        tag = """<line x1="%.2f" x2="%.2f" y1="%.2f" y2="%.2f" """ + options + """ />"""
+
+        tags = [tag % values for values in zip(*_columns(x1s, x2s, y1s, y2s), *columns)]
+        if tags:
+            yield "\n".join(tags)
 
     def line_with_arrows(self, x1, y1, x2, y2, n=None, arrows=None, direction="right",
                          color="black", filled=True,
@@ -80,6 +406,10 @@ class SVG(GraphicsBackend):
                 color=color, scale=arrow_scale, **arrowKwdArgs)
 
     def arrow(self, x, y, direction, color="black", scale=1.0, filled=True, **kwdargs):
+        if self.shared_styles:
+            yield from self._shared_arrow(x, y, direction, color, scale, filled, **kwdargs)
+            return
+
         more = _addOptions(kwdargs)
 
         if filled:
@@ -113,12 +443,37 @@ class SVG(GraphicsBackend):
                 color=color,
                 xcenter=x,
                 more=more)
-        yield a
+
+        yield from self._draw(a, self._arrow_bounds(x, y, scale, kwdargs))
+
+    def _arrow_bounds(self, x, y, scale, options):
+        pad = float(options.get("stroke-width", 1)) * 2 + 1
+        return (x-abs(2.5*scale)-pad, y-abs(5*scale)-pad, x+abs(2.5*scale)+pad, y+abs(5*scale)+pad)
+
+    def _shared_arrow(self, x, y, direction, color, scale, filled, **kwdargs):
+        """ draws an arrowhead as a reference to a definition shared by identical arrowheads """
+        key = (direction, scale, color, filled, tuple(sorted(kwdargs.items())))
+        symbol = self._symbols.get(key)
+        if symbol is None:
+            symbol = self._symbols[key] = "arrow{}".format(next(SVG.newid))
+
+            sign = 1 if direction == "right" else -1
+            path = """<defs><path id="{id}" d="M {x0} {y0} L {x1} 0 L {x0} {y1}{close}" {more}/></defs>""".format(
+                id=symbol, x0=-2.5*scale*sign, y0=-5*scale, x1=2.5*scale*sign, y1=5*scale,
+                close=" z" if filled else "",
+                more=_addOptions(kwdargs, {"stroke":color, "fill":color if filled else "transparent"}))
+            yield from self._draw(path, None)
+
+        tag = """<use xlink:href="#{}" x="{:.2f}" y="{:.2f}" xcenter="{}" />""".format(symbol, x, y, x)
+        yield from self._draw(tag, self._arrow_bounds(x, y, scale, kwdargs))
         
     def block_arrow(self, left, top, width, height, arrow_width, direction, **kwdargs):
         coords = {"stroke": kwdargs.pop("stroke", "none"), "fill":kwdargs.pop("fill", "black")}
         coords["more"] = _addOptions(kwdargs)
 
+        if self.shared_styles:
+            coords["more"] = self._attributes(dict(stroke=coords["stroke"], fill=coords["fill"], **kwdargs))
+
         if direction == "right":
             path = """<path d="M {x0} {y0} L {x1} {y1} L {x2} {y2} L {x3} {y3} """ \
                    """L {x4} {y4} z" stroke="{stroke}" fill="{fill}" {more}/>"""
@@ -137,19 +492,55 @@ class SVG(GraphicsBackend):
             coords["x3"], coords["y3"] = left, top+height
             coords["x4"], coords["y4"] = left-arrow_width, top+height/2
 
+        if self.shared_styles:
+            path = path.replace(""" stroke="{stroke}" fill="{fill}" """, " ")
         path = path.format(**coords)
-        yield path
+
+        if not self._groups:
+            yield path
+            return
+
+        # the merged path keeps the same outline, drawn in the same direction
+        d = "M{:.2f} {:.2f}L{:.2f} {:.2f}L{:.2f} {:.2f}L{:.2f} {:.2f}L{:.2f} {:.2f}z".format(
+            *[coords[axis+str(i)] for i in range(5) for axis in "xy"])
+        style = None
+        if width >= 0:
+            style = _shape_style("fill", dict(kwdargs, stroke=coords["stroke"], fill=coords["fill"]))
+
+        xs = [coords["x{}".format(i)] for i in range(5)]
+        ys = [coords["y{}".format(i)] for i in range(5)]
+        pad = _stroke_padding(dict(kwdargs, stroke=coords["stroke"]))
+        yield from self._draw(path, (min(xs)-pad, min(ys)-pad, max(xs)+pad, max(ys)+pad), style, d)
 
 
     def start_clipped_group(self, x, y, width, height, name):
+        yield from self._flush()
         yield """<clipPath id="clip_path_{}"><rect x="{}" y="{}" width="{}" height="{}" /></clipPath>""".format(
             name, x, y, width, height)
         yield """<g clip-path="url(#clip_path_{})">""".format(name)
+
+        if self.merge_paths:
+            self._groups.append(_PathMerger(x, y, width, height))
         
     def stop_clipped_group(self):
+        if self.merge_paths:
+            for tag in self._groups.pop().flush(self._attributes):
+                yield _indent(tag)
         yield "</g>"
+
+    def _flush(self):
+        # writes out the elements drawn so far in the current group, before any nested group
+        if self._groups:
+            yield from self._groups[-1].flush(self._attributes)
     
 
+def _indent(subelement):
+    # batched primitives yield many elements as a single multi-line string
+    if "\n" in subelement:
+        subelement = subelement.replace("\n", "\n   ")
+    return "   " + subelement
+
+
 class Renderer:
     newid = itertools.count()
     
@@ -172,6 +563,20 @@ class Renderer:
     
     def line(self, x1, y1, x2, y2, *args, **kwdargs):
         yield from self.backend.line(x1+self.x, y1+self.y, x2+self.x, y2+self.y, *args, **kwdargs)
+
+    def rects(self, xs, ys, *args, **kwdargs):
+        """
+        Draws many rectangles at once; coordinates and sizes are arrays, and options 
+        (eg ``fill``) may be given per rectangle as lists or arrays.
+        """
+        yield from self.backend.rects(numpy.asarray(xs)+self.x, numpy.asarray(ys)+self.y, *args, **kwdargs)
+
+    def lines(self, x1s, y1s, x2s, y2s, *args, **kwdargs):
+        """
+        Draws many lines at once (see :py:meth:`rects`).
+        """
+        yield from self.backend.lines(numpy.asarray(x1s)+self.x, numpy.asarray(y1s)+self.y, 
+                                      numpy.asarray(x2s)+self.x, numpy.asarray(y2s)+self.y, *args, **kwdargs)
     
     def line_with_arrows(self, x1, y1, x2, y2, *args, **kwdargs):
         yield from self.backend.line_with_arrows(x1+self.x, y1+self.y, x2+self.x, y2+self.y, *args, **kwdargs)
@@ -183,23 +588,23 @@ class Renderer:
         yield from self.backend.block_arrow(left+self.x, top+self.y, *args, **kwdargs)
 
     def render(self, element):
-        yield "<!-- {} -->".format(element.name)
+        yield from self.backend.comment(element.name)
         yield from self.backend.start_clipped_group(self.x, self.y, self.width, self.height, self.id)
         # yield self.backend.rect(self.x, self.y, self.width, self.height, fill="blue")
 
         if hasattr(element, "prerenderers"):
             for prerenderer in element.prerenderers:
                 for subelement in prerenderer(self, element):
-                    yield "   " + subelement
+                    yield _indent(subelement)
 
         
         for subelement in element.render(self):
-            yield "   " + subelement
+            yield _indent(subelement)
 
         if hasattr(element, "postrenderers"):
             for postrenderer in element.postrenderers:
                 for subelement in postrenderer(self, element):
-                    yield "   " + subelement
+                    yield _indent(subelement)
 
         yield from self.backend.stop_clipped_group()
         
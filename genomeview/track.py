@@ -13,9 +13,16 @@ class Track:
         yield from renderer.line(25, 55, 400, 200)
         yield from renderer.line_with_arrows(250, 55, 400, 55)
         
+    def get_label(self):
+        """
+        Returns the text shown in the label of the track (by default, the track name).
+        """
+        return self.name
+
     def render_label(self, renderer):
-        if self.name is not None:
-            yield from renderer.text_with_background(5, 14, self.name, anchor="start", size=18, bg_opacity=0.9)
+        label = self.get_label()
+        if label is not None:
+            yield from renderer.text_with_background(5, 14, label, anchor="start", size=18, bg_opacity=0.9)
 
         
 class TrackLabel:
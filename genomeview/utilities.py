@@ -1,4 +1,8 @@
+import collections
+import numpy
+import os
 import pysam
+import threading
 
 def match_chrom_format(chrom, keys):
     if chrom in keys:
@@ -13,6 +17,106 @@ def match_chrom_format(chrom, keys):
     return chrom
 
 
+def expand_ranges(starts, lengths):
+    """
+    Returns the concatenation of numpy.arange(start, start+length) for each pair of
+    start and length, computed without a python loop.
+    """
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    total = lengths.sum()
+    if total == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    run_offsets = numpy.cumsum(lengths) - lengths
+    return numpy.repeat(starts - run_offsets, lengths) + numpy.arange(total)
+
+
+# number of threads used to decompress bam/cram files; see set_decompression_threads()
+decompression_threads = 1
+
+def set_decompression_threads(threads):
+    """
+    Sets the default number of threads used by htslib to decompress bam (bgzf) and cram 
+    files, for all tracks that don't specify their own ``threads``.
+    """
+    global decompression_threads
+    decompression_threads = max(1, int(threads))
+
+
+class AlignmentFilePool:
+    """
+    A pool of open alignment files (pysam.AlignmentFile), keyed by path and number of 
+    decompression threads, so that tracks showing the same file share a single handle 
+    (and index).
+
+    At most ``max_open`` files are kept open; when more are needed, the least recently 
+    used handle is closed. Handles are never shared between processes: after a fork, the 
+    pool starts out empty in the child process and files are reopened as needed.
+    """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._handles = collections.OrderedDict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def get(self, path, threads=None):
+        """
+        Returns an open pysam.AlignmentFile for ``path``, decompressed using ``threads`` 
+        threads (default: the global setting, see :py:func:`set_decompression_threads`).
+        """
+        if threads is None:
+            threads = decompression_threads
+        key = (path, threads)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # we're in a forked child; leave the parent's handles alone
+                self._handles = collections.OrderedDict()
+                self._pid = os.getpid()
+
+            if key in self._handles:
+                self._handles.move_to_end(key)
+                return self._handles[key]
+
+            handle = pysam.AlignmentFile(path, threads=threads)
+            self._handles[key] = handle
+
+            while len(self._handles) > self.max_open:
+                _, evicted = self._handles.popitem(last=False)
+                evicted.close()
+
+            return handle
+
+    def clear(self):
+        """
+        Closes all open files.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                for handle in self._handles.values():
+                    handle.close()
+            self._handles = collections.OrderedDict()
+            self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._handles)
+
+
+alignment_file_pool = AlignmentFilePool()
+
+def open_alignment_file(path, threads=None):
+    """
+    Returns an open pysam.AlignmentFile for ``path``, from the process-wide 
+    :py:class:`AlignmentFilePool`. The handle may be closed once it is evicted from 
+    the pool, so it should not be kept around by the caller; call this function 
+    again instead.
+
+    ``threads`` specifies the number of decompression threads (default: the global 
+    setting, see :py:func:`set_decompression_threads`).
+    """
+    return alignment_file_pool.get(path, threads)
+
+
 def get_one_track(doc_or_view, name):
     """
     Convenience function to get a single track by name from a document 
@@ -24,8 +128,8 @@ def get_one_track(doc_or_view, name):
     return tracks[0]
     
 
-def is_paired_end(bam_path, n=100):
-    bam = pysam.AlignmentFile(bam_path)
+def is_paired_end(bam_path, n=100, threads=None):
+    bam = open_alignment_file(bam_path, threads)
 
     for i, read in enumerate(bam.fetch()):
         if read.is_paired:
@@ -36,8 +140,86 @@ def is_paired_end(bam_path, n=100):
     return False
 
 
-def is_long_frag_dataset(bam_path, n=1000):
-    bam = pysam.AlignmentFile(bam_path)
+# @RG platforms (PL) and @PG programs that only ever produce long, unpaired reads
+LONG_READ_PLATFORMS = {"PACBIO", "ONT"}
+LONG_READ_PROGRAMS = {"blasr", "graphmap", "lra", "ngmlr", "nextgenmap-lr", "pbmm2", "winnowmap"}
+
+AlignmentFileInfo = collections.namedtuple("AlignmentFileInfo", ["paired", "long_reads"])
+
+_probe_cache = {}
+
+def probe_alignment_file(bam_path, chrom=None, start=None, end=None, threads=None):
+    """
+    Determines whether a bam/cram file contains paired-end reads and/or long reads 
+    (longer than 1kb), returning an :py:class:`AlignmentFileInfo`.
+
+    The header is checked first: if all read groups come from a long-read platform, 
+    or the reads were aligned with a long-read aligner, no reads need to be decoded. 
+    Otherwise, reads are sampled from the region chrom:start-end (if specified) using 
+    the index, falling back to the start of the file. Results are cached by path and 
+    modification time (and, when reads had to be sampled, by region).
+    """
+    try:
+        mtime = os.path.getmtime(bam_path)
+    except OSError: # eg, a remote file
+        mtime = None
+
+    key = (bam_path, mtime)
+    if key not in _probe_cache:
+        _probe_cache[key] = _probe_header(bam_path, threads)
+    if _probe_cache[key] is not None:
+        return _probe_cache[key]
+
+    key = (bam_path, mtime, chrom, start, end)
+    if key not in _probe_cache:
+        _probe_cache[key] = _probe_reads(bam_path, chrom, start, end, threads)
+    return _probe_cache[key]
+
+def _probe_header(bam_path, threads):
+    """ the answer given by the header alone, or None if reads need to be sampled """
+    bam = open_alignment_file(bam_path, threads)
+    header = bam.header.to_dict()
+
+    platforms = {rg.get("PL", "").upper() for rg in header.get("RG", [])}
+    programs = {pg.get("PN", pg.get("ID", "")).lower() for pg in header.get("PG", [])}
+    if (platforms and platforms <= LONG_READ_PLATFORMS) or (programs & LONG_READ_PROGRAMS):
+        return AlignmentFileInfo(paired=False, long_reads=True)
+    return None
+
+def _probe_reads(bam_path, chrom, start, end, threads):
+    bam = open_alignment_file(bam_path, threads)
+
+    reads = []
+    if chrom is not None and bam.has_index():
+        chrom = match_chrom_format(chrom, bam.references)
+        if chrom in bam.references:
+            reads = _sample_reads(bam.fetch(chrom, start, end))
+    if not reads:
+        reads = _sample_reads(bam.fetch(until_eof=not bam.has_index()))
+
+    paired = any(read.is_paired for read in reads[:101])
+
+    long_reads = False
+    for read in reads:
+        if read.is_paired:
+            break
+        if read.query_length > 1000:
+            long_reads = True
+            break
+
+    return AlignmentFileInfo(paired=paired, long_reads=long_reads)
+
+def _sample_reads(reads, n=1001):
+    sample = []
+    for read in reads:
+        sample.append(read)
+        if len(sample) >= n:
+            break
+    return sample
+
+
+def is_long_frag_dataset(bam_path, n=1000, threads=None):
+    bam = open_alignment_file(bam_path, threads)
 
     for i, read in enumerate(bam.fetch()):
         if read.is_paired:
@@ -18,7 +18,7 @@ setup(
     packages=find_packages(),
 
     # setup_requires=["pypandoc"],
-    install_requires=["pysam", "numpy", "pandas", "pyBigWig"], 
+    install_requires=["pysam", "numpy", "pyBigWig"], 
     python_requires=">=3.3",
     long_description=open('README.md').read(),
     long_description_content_type='text/markdown',
@@ -0,0 +1,261 @@
+import collections
+import numpy
+import pysam
+import pytest
+
+import genomeview
+from genomeview.readbatch import PairIndex, ReadBatch
+
+
+def test_md_mismatches():
+    track = genomeview.SingleEndBAMTrack("data/illumina.bam")
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    reads = list(bam.fetch("4", 96549060, 96550060))
+    batch = ReadBatch.from_reads(reads)
+
+    for i, read in enumerate(reads):
+        positions, query_positions = track._find_mismatches_md(
+            *batch.cigar(i), *batch.cigar_positions(i), batch.md[i])
+
+        # pysam reports mismatched reference bases (inferred from the MD tag) in lowercase
+        expected = [(ref_pos, query_pos) for query_pos, ref_pos, ref_base in read.get_aligned_pairs(with_seq=True)
+                    if query_pos is not None and ref_pos is not None and ref_base.islower()]
+
+        assert list(zip(positions, query_positions)) == expected
+
+
+def test_mismatches_need_reference(caplog):
+    # as when comparing reads to the reference, MD tags aren't used without a reference
+    track = genomeview.SingleEndBAMTrack("data/illumina.bam")
+    track.scale = genomeview.GenomeView("chr4", 96549060, 96550060, "+").scale
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    batch = ReadBatch.from_reads(bam.fetch("4", 96549060, 96550060))
+
+    assert any(md is not None and any(c.isalpha() for c in md) for md in batch.md)
+    for i in range(len(batch)):
+        positions, bases = track._find_mismatches(batch, i)
+        assert len(positions) == 0 and bases == ""
+    assert "Unable to get reference sequence" in caplog.text
+
+
+def test_read_batch():
+    bam = pysam.AlignmentFile("data/quick_consensus_test.bam")
+    reads = list(bam.fetch("4", 96549060, 96550060))
+    batch = ReadBatch.from_reads(reads).take(numpy.arange(1, len(reads), 2))
+
+    for i, read in enumerate(reads[1::2]):
+        assert batch.start[i] == read.reference_start and batch.end[i] == read.reference_end
+        assert batch.sequence(i).tobytes().decode() == read.query_sequence
+        assert list(zip(*[column.tolist() for column in batch.cigar(i)])) == read.cigartuples
+
+        expected = []
+        ref, query = read.reference_start, 0
+        for op, length in read.cigartuples:
+            expected.append((ref, query))
+            if op in [0, 2, 3, 7, 8]: ref += length
+            if op in [0, 1, 4, 7, 8]: query += length
+        assert list(zip(*[column.tolist() for column in batch.cigar_positions(i)])) == expected
+
+
+def test_pair_index():
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    reads = [read for read in bam.fetch("4", 96549060, 96550060) if not read.is_secondary]
+    pairs = PairIndex(ReadBatch.from_reads(reads))
+
+    by_name = collections.defaultdict(list)
+    for read in reads:
+        by_name[read.query_name].append(read)
+    assert pairs.names == list(by_name)
+
+    for i, (name, mates) in enumerate(by_name.items()):
+        coords = sorted((read.reference_start, read.reference_end) for read in mates)
+        if len(mates) == 1 and mates[0].is_proper_pair:
+            coords = sorted(coords + [(mates[0].next_reference_start,)*2])
+        assert (pairs.start[i], pairs.end[i]) == (coords[0][0], coords[-1][1])
+
+    units = pairs.units()
+    assert sorted(i for unit in units for i in unit) == list(range(len(reads)))
+    assert all(len(set(reads[i].query_name for i in unit)) == 1 for unit in units)
+
+
+def test_downsample_reads():
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    reads = list(bam.fetch("4", 96549060, 96551060))
+
+    kept, dropped = genomeview.downsample_reads(reads, 5, seed=1)
+    assert len(kept) + dropped == len(reads)
+    assert dropped > 0
+
+    mapped = [read for read in kept if not read.is_unmapped]
+    depth = genomeview.coverage_depth([read.reference_start for read in mapped], 
+                                      [read.reference_end for read in mapped], 96540000, 96560000)
+    assert depth.max() == 5
+
+    kept_again, _ = genomeview.downsample_reads(reads, 5, seed=1)
+    assert [read.query_name for read in kept] == [read.query_name for read in kept_again]
+
+    pairs, _ = genomeview.downsample_reads(reads, 5, seed=1, key=lambda read: read.query_name)
+    kept_names = set(read.query_name for read in pairs)
+    assert all(read in pairs for read in reads if read.query_name in kept_names)
+
+
+def test_downsampled_track():
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+1000, "+")
+    doc.add_view(view)
+
+    track = genomeview.PairedEndBAMTrack("data/illumina.bam", name="illumina")
+    track.draw_mismatches = False
+    track.max_depth = 3
+    view.add_track(track)
+
+    svg = doc._repr_svg_()
+    assert track.downsampled_count > 0
+    assert "reads hidden by downsampling" in svg
+
+    track.max_depth = None
+    track.scale = None
+    svg = doc._repr_svg_()
+    assert track.downsampled_count == 0
+    assert "reads hidden by downsampling" not in svg
+
+
+def test_downsampling_limits_rows():
+    # long reads, many more of which overlap each position than start nearby
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+5000, "+")
+    doc.add_view(view)
+
+    track = genomeview.SingleEndBAMTrack("data/quick_consensus_test.bam", name="pacbio")
+    track.draw_mismatches = False
+    track.max_depth = 4
+    view.add_track(track)
+
+    doc._repr_svg_()
+    assert track.downsampled_count > 0
+    assert len(track.rows) <= 4
+
+
+@pytest.mark.parametrize("width,expected", [(1000, "full"), (20000, "full"), (300000, "rects"), (1000000, "density"), (10000000, "coverage")])
+def test_level_of_detail(width, expected):
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96540000, 96540000+width, "+")
+    doc.add_view(view)
+
+    track = genomeview.SingleEndBAMTrack("data/quick_consensus_test.bam", name="pacbio")
+    track.draw_mismatches = False
+    view.add_track(track)
+
+    svg = doc._repr_svg_()
+    assert track.get_level_of_detail() == expected
+    assert ("level of detail: {}".format(expected) in svg) == (expected != "full")
+
+    if expected in ["density", "coverage"]:
+        assert track.height == track.summary_height
+        assert "max depth" in svg
+
+
+@pytest.mark.parametrize("track_class", [genomeview.SingleEndBAMTrack, genomeview.PairedEndBAMTrack])
+def test_intervals_to_rows(track_class):
+    class RowTrack(track_class):
+        def draw_interval(self, renderer, interval):
+            self.drawn_rows.append((interval.row, self.intervals_to_rows[interval.id]))
+            yield from super().draw_interval(renderer, interval)
+
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+1000, "+")
+    doc.add_view(view)
+
+    track = RowTrack("data/illumina.bam", name="reads")
+    track.drawn_rows = []
+    view.add_track(track)
+    doc._repr_svg_()
+
+    assert len(track.drawn_rows) > 0
+    assert all(row == mapped for row, mapped in track.drawn_rows)
+    assert len(track.intervals_to_rows) == len(set(track.intervals_to_rows))
+    # the reads are only held by the batch, which is freed once the track is rendered
+    assert track._region_reads is None and track._batch is None
+
+
+def test_read_ids_ignore_filters():
+    # reads are numbered among all reads of the region, as before filtering was added
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    start, end = 96549060, 96549060+1000
+    expected = {read.query_name + str(i) for i, read in enumerate(bam.fetch("4", start, end))
+                if not read.is_unmapped and not read.is_reverse}
+
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", start, end, "+")
+    doc.add_view(view)
+
+    track = genomeview.SingleEndBAMTrack("data/illumina.bam")
+    track.draw_mismatches = False
+    track.read_filter = genomeview.ReadFilter(strand="+")
+    view.add_track(track)
+    doc.layout()
+
+    assert set(track.intervals_to_rows) == expected
+    assert {interval.id for interval in track} == expected
+
+
+def test_coverage_runs():
+    x, y = genomeview.coverage_runs([10, 12, 20], [15, 14, 22], 8, 25)
+
+    assert list(x) == [8, 9, 10, 11, 12, 13, 14, 15, 19, 20, 21, 22, 24]
+    assert list(y) == [0, 0, 1, 1, 2, 2, 1, 0, 0, 1, 1, 0, 0]
+
+
+def test_grouped_track_shares_consensus():
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+2000, "+")
+    doc.add_view(view)
+
+    track = genomeview.GroupedBAMTrack("data/illumina.bam", lambda read: read.is_reverse, 
+                                       genomeview.PairedEndBAMTrack)
+    view.add_track(track)
+    doc.layout()
+
+    assert len(track.subtracks) == 2
+    assert track.subtracks[0].mismatch_counts is track.subtracks[1].mismatch_counts
+
+    reverse = [read.is_reverse for read in track.subtracks[1].fetch()]
+    assert len(reverse) > 0 and all(reverse)
+
+    doc.layout()
+    assert len(track.subtracks) == 2
+
+
+def test_read_filter():
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    reads = list(bam.fetch("4", 96549060, 96551060))
+    batch = ReadBatch.from_reads(reads)
+
+    read_filter = genomeview.ReadFilter(min_mapq=30, strand="-", exclude_flags=0x400)
+    expected = [read.mapping_quality >= 30 and read.is_reverse and not read.is_duplicate for read in reads]
+    assert [read_filter(read) for read in reads] == expected
+    assert list(read_filter.mask(batch)) == expected
+
+    assert read_filter == genomeview.ReadFilter(min_mapq=30, require_flags=0x10, exclude_flags=0x400)
+    assert len({read_filter, genomeview.ReadFilter(min_mapq=30, strand="-", exclude_flags=0x400)}) == 1
+
+    tag_filter = genomeview.ReadFilter(tags={"NM": [0, 1]})
+    assert list(tag_filter.mask(batch)) == [read.has_tag("NM") and read.get_tag("NM") in [0, 1] for read in reads]
+
+    combined = read_filter.combine(tag_filter)
+    assert list(combined.mask(batch)) == [a and b for a, b in zip(expected, tag_filter.mask(batch))]
+
+
+def test_track_read_filter():
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+1000, "+")
+    doc.add_view(view)
+
+    track = genomeview.SingleEndBAMTrack("data/illumina.bam")
+    track.draw_mismatches = False
+    track.read_filter = genomeview.ReadFilter(strand="+")
+    view.add_track(track)
+    doc.layout()
+
+    batch = track.fetch_batch()
+    assert len(batch) > 0 and not batch.reverse.any()
@@ -0,0 +1,52 @@
+import pytest
+
+import genomeview
+from genomeview import export
+
+
+def _doc():
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+1000, "+")
+    doc.add_view(view)
+    track = genomeview.SingleEndBAMTrack("data/illumina.bam", name="reads")
+    track.draw_mismatches = False
+    view.add_track(track)
+    return doc
+
+
+def test_save_with_converter(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(export.shutil, "which", lambda program: program == "rsvg-convert")
+    monkeypatch.setattr(export.subprocess, "check_call", lambda args: calls.append(args))
+
+    outpath = str(tmp_path / "with space; rm.png")
+    genomeview.save(_doc(), outpath, converter="auto")
+
+    # the paths are passed as separate arguments, never through a shell
+    [args] = calls
+    assert args[:3] == ["rsvg-convert", "-f", "png"]
+    assert args[-2] == outpath and args[-1].endswith("temp.svg")
+
+    with pytest.raises(ValueError):
+        genomeview.save(_doc(), outpath, converter="webkittopdf")
+    with pytest.raises(ValueError):
+        genomeview.save(_doc(), outpath, converter="ghostscript")
+
+
+def test_save_without_converter(tmp_path):
+    outpath = tmp_path / "doc.png"
+    genomeview.save(_doc(), str(outpath))
+    assert outpath.read_bytes().startswith(b"\x89PNG")
+
+
+def test_save_pdf_with_converter(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(export.shutil, "which", lambda program: True)
+    monkeypatch.setattr(export.subprocess, "check_call", lambda args: calls.append(args))
+
+    outpath = str(tmp_path / "doc.pdf")
+    genomeview.save(_doc(), outpath, converter="inkscape")
+    genomeview.save(_doc(), outpath, converter="auto")
+
+    assert calls[0][0] == "inkscape" and calls[0][-1] == "--export-pdf=" + outpath
+    assert calls[1][0] == "webkitToPDF" and calls[1][-1] == outpath
@@ -0,0 +1,158 @@
+import numpy
+
+from genomeview import genomesource
+from genomeview.genomeview import Scale
+
+
+def test_scale_seq_array():
+    source = genomesource.GenomeSource({"chr1": "acgtNNACGTacgt"})
+    scale = Scale("chr1", 2, 12, "+", source)
+    scale.pixel_width = 100
+
+    seq = scale.get_seq_array()
+    assert seq.dtype == numpy.uint8
+    assert seq.tobytes() == b"GTNNACGTAC"
+    assert scale.get_seq(4, 8) == "NNAC"
+    assert not scale.get_seq_array(4, 8).flags.writeable
+
+
+def _write_fasta(path, names_to_seqs):
+    import pysam
+
+    with open(path, "w") as f:
+        for name, seq in names_to_seqs.items():
+            f.write(">{}\n".format(name))
+            for i in range(0, len(seq), 60):
+                f.write(seq[i:i+60] + "\n")
+    pysam.faidx(str(path))
+
+
+def test_fasta_chunk_cache(tmp_path):
+    import pickle
+    import random
+
+    rng = random.Random(0)
+    seqs = {"chr1": "".join(rng.choice("ACGTacgtN") for i in range(5000)),
+            "chr2": "".join(rng.choice("ACGT") for i in range(700))}
+    path = tmp_path / "genome.fa"
+    _write_fasta(path, seqs)
+
+    source = genomesource.FastaGenomeSource(str(path), chunk_size=128, cache_bytes=1024)
+    for i in range(200):
+        chrom = rng.choice(["chr1", "chr2", "1"])
+        seq = seqs[chrom if chrom.startswith("chr") else "chr"+chrom]
+        start = rng.randint(0, len(seq)-1)
+        end = min(len(seq)-1, start + rng.randint(0, 600))
+        expected = seq[start:end+1]
+
+        assert source.get_seq(chrom, start, end, "+") == expected
+        assert source.get_seq(chrom, start, end, "-") == genomesource.reverse_comp(expected)
+        assert source._cached_bytes <= source.cache_bytes
+
+    assert source.resolve_chrom("1") == "chr1"
+
+    unpickled = pickle.loads(pickle.dumps(source))
+    assert len(unpickled._chunks) == 0
+    assert unpickled.get_seq("chr2", 10, 20, "+") == seqs["chr2"][10:21]
+
+
+def _write_twobit(path, names_to_seqs):
+    import re
+    import struct
+
+    records = []
+    for seq in names_to_seqs.values():
+        n_blocks = [(m.start(), m.end()-m.start()) for m in re.finditer("[Nn]+", seq)]
+        mask_blocks = [(m.start(), m.end()-m.start()) for m in re.finditer("[a-z]+", seq)]
+        codes = ["TCAG".index(c) if c in "TCAG" else 0 for c in seq.upper()]
+        codes += [0] * (-len(codes) % 4)
+        packed = bytes((a << 6) | (b << 4) | (c << 2) | d 
+                       for a, b, c, d in zip(*[iter(codes)]*4))
+
+        record = struct.pack("<II", len(seq), len(n_blocks))
+        record += b"".join(struct.pack("<I", s) for s, _ in n_blocks)
+        record += b"".join(struct.pack("<I", l) for _, l in n_blocks)
+        record += struct.pack("<I", len(mask_blocks))
+        record += b"".join(struct.pack("<I", s) for s, _ in mask_blocks)
+        record += b"".join(struct.pack("<I", l) for _, l in mask_blocks)
+        record += struct.pack("<I", 0) + packed
+        records.append(record)
+
+    offset = 16 + sum(1 + len(name) + 4 for name in names_to_seqs)
+    index = b""
+    for name, record in zip(names_to_seqs, records):
+        index += struct.pack("<B", len(name)) + name.encode() + struct.pack("<I", offset)
+        offset += len(record)
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IIII", 0x1A412743, 0, len(names_to_seqs), 0))
+        f.write(index + b"".join(records))
+
+
+def test_twobit(tmp_path):
+    import pickle
+    import random
+
+    rng = random.Random(1)
+    seqs = {"chr1": "NNNNacgtACGTTTGCAnnnGGGgtac" + "".join(rng.choice("ACGTacgtN") for i in range(3000)),
+            "chrM": "GATCACAGG"}
+    path = tmp_path / "genome.2bit"
+    _write_twobit(path, seqs)
+
+    source = genomesource.TwoBitGenomeSource(str(path))
+    assert source.keys() == ["chr1", "chrM"]
+
+    for i in range(200):
+        chrom = rng.choice(["chr1", "chrM", "M"])
+        seq = seqs[chrom if chrom.startswith("chr") else "chr"+chrom]
+        start = rng.randint(0, len(seq)-1)
+        end = min(len(seq)-1, start + rng.randint(0, rng.choice([10, 2000])))
+        expected = seq[start:end+1]
+
+        assert source.get_seq(chrom, start, end, "+") == expected
+        assert source.get_seq(chrom, start, end, "-") == genomesource.reverse_comp(expected)
+
+    assert source.get_seq("chrM", 5, 100, "+") == "CAGG"
+
+    unpickled = pickle.loads(pickle.dumps(source))
+    assert unpickled.get_seq("chr1", 0, 30, "+") == seqs["chr1"][:31]
+
+
+def _fetch_in_worker(source, chrom, start, end, strand):
+    return source.get_seq(chrom, start, end, strand)
+
+
+def test_array_genome_source():
+    import multiprocessing
+    import pickle
+
+    seqs = {"chr1": "ACGTNacgtnAACCGGTT", "chr2": b"GATTACA"}
+    source = genomesource.ArrayGenomeSource(seqs)
+    reference = genomesource.GenomeSource({"chr1": seqs["chr1"], "chr2": "GATTACA"})
+
+    for chrom, start, end in [("chr1", 0, 17), ("chr1", 3, 12), ("2", 1, 4), ("chr2", 5, 50)]:
+        for strand in "+-":
+            assert source.get_seq(chrom, start, end, strand) == reference.get_seq(chrom, start, end, strand)
+
+    view = source.get_seq_array("chr1", 2, 6, "+")
+    assert view.base is not None
+    assert not view.flags.writeable
+
+    assert pickle.loads(pickle.dumps(source)).get_seq("chr2", 0, 2, "+") == "GAT"
+
+    shared = source.to_shared_memory()
+    try:
+        assert len(pickle.dumps(shared)) < 1000
+        with multiprocessing.get_context("fork").Pool(2) as pool:
+            results = pool.starmap(_fetch_in_worker, [(shared, "chr1", 0, 17, "-"), (shared, "chr2", 0, 6, "+")])
+        assert results == [reference.get_seq("chr1", 0, 17, "-"), "GATTACA"]
+    finally:
+        shared.unlink()
+
+
+def test_scale_with_array_source():
+    source = genomesource.ArrayGenomeSource({"chr1": "acgtNNACGTacgt"})
+    scale = Scale("chr1", 2, 12, "+", source)
+    scale.pixel_width = 100
+
+    assert scale.get_seq() == "GTNNACGTAC"
@@ -0,0 +1,33 @@
+import random
+
+from genomeview.intervaltrack import RowPacker
+
+
+def _first_fit(intervals):
+    rows = []
+    placements = []
+    for start, end in intervals:
+        for row, row_end in enumerate(rows):
+            if start > row_end:
+                break
+        else:
+            rows.append(None)
+            row = len(rows) - 1
+        rows[row] = end
+        placements.append(row)
+    return placements
+
+
+def test_row_packer_matches_first_fit():
+    rng = random.Random(1)
+    intervals = []
+    for i in range(2000):
+        start = rng.randint(0, 5000)
+        intervals.append((start, start + rng.randint(1, 800)))
+    intervals.sort()
+
+    packer = RowPacker()
+    placements = [packer.place(start, end) for start, end in intervals]
+
+    assert placements == _first_fit(intervals)
+    assert len(packer.ends) == max(placements) + 1
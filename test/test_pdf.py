@@ -0,0 +1,69 @@
+import io
+import re
+import zlib
+
+import genomeview
+from genomeview.pdf import PDF
+from genomeview.svg import Renderer
+
+
+def _contents(data):
+    assert data.startswith(b"%PDF-1.4")
+
+    # every object is where the cross-reference table says it is
+    xref = int(data.rsplit(b"startxref\n", 1)[1].split()[0])
+    entries = data[xref:].split(b"\n")[3:]
+    n_objects = int(data[xref:].split(b"\n")[1].split()[1]) - 1
+    for i in range(n_objects):
+        assert data[int(entries[i][:10]):].startswith(b"%d 0 obj" % (i+1))
+
+    return [zlib.decompress(stream).decode("latin-1").split("\n")
+            for stream in re.findall(rb"stream\n(.*?)\nendstream", data, re.S)]
+
+
+def test_pdf():
+    class Element:
+        name = "element"
+        def render(self, renderer):
+            yield from renderer.rects([10, 30], 10, 10, 10, fill=["red", "#0000ff"], stroke="none")
+            yield from renderer.line(0, 50, 200, 50, stroke="black", opacity=0.5)
+            yield from renderer.text(100, 90, "(label)", anchor="end")
+
+    backend = PDF()
+    list(backend.start_document(220, 100))
+    list(Renderer(backend, 10, 5, 200, 90).render(Element()))
+    list(backend.stop_document())
+
+    outf = io.BytesIO()
+    backend.write(outf)
+    [content] = _contents(outf.getvalue())
+
+    assert content[0] == "1 0 0 -1 0 100 cm"
+    assert "q 10 5 200 90 re W n" in content and content[-1] == "Q"
+    assert content.index("1 0 0 rg") < content.index("20 15 10 10 re") < content.index("0 0 1 rg")
+    # the colors aren't repeated for shapes of the same color
+    assert content.count("1 0 0 rg") == 1
+    assert "/GS2 gs" in content and b"/ca 1 /CA 0.5" in outf.getvalue()
+    # the text is right-aligned using the width of the font's glyphs
+    assert "1 0 0 -1 82.22 95 Tm" in content
+    assert "(\\(label\\)) Tj" in content
+
+
+def test_render_to_pdf():
+    docs = []
+    for start in [96549060, 96549560]:
+        doc = genomeview.Document(900)
+        view = genomeview.GenomeView("chr4", start, start+500, "+")
+        doc.add_view(view)
+        view.add_track(genomeview.SingleEndBAMTrack("data/illumina.bam", name="reads"))
+        docs.append(doc)
+
+    outf = io.BytesIO()
+    genomeview.render_to_pdf(docs, outf)
+
+    pages = _contents(outf.getvalue())
+    assert b"/Count 2" in outf.getvalue()
+    assert len(pages) == 2
+    for content in pages:
+        assert content.count("BT") == content.count("ET") > 0
+        assert sum(line.startswith("q ") for line in content) == content.count("Q")
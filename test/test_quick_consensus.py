@@ -1,3 +1,4 @@
+import pytest
 import pysam
 from genomeview import MismatchCounts
 
@@ -25,3 +26,134 @@ def test_compare_quick_consensus():
     assert (cython_consensus.counts == python_consensus.counts).all()
     assert (cython_consensus.insertions == python_consensus.insertions).all()
 
+
+def _pileup_consensus(bam, chrom, start, end):
+    consensus = MismatchCounts(chrom, start, end)
+
+    for pileupcolumn in bam.pileup(chrom, start, end, truncate=True):
+        for pileupread in pileupcolumn.pileups:
+            if pileupread.is_refskip:
+                continue
+            elif pileupread.is_del:
+                consensus.add_count(pileupcolumn.pos, "DEL")
+            else:
+                nuc = pileupread.alignment.query_sequence[pileupread.query_position]
+                if nuc != "N":
+                    consensus.add_count(pileupcolumn.pos, nuc)
+            if pileupread.indel > 0:
+                consensus.add_count(pileupcolumn.pos, "INS")
+
+    return consensus
+
+
+@pytest.mark.parametrize("bam_path,chrom,start,end", [
+    ("data/quick_consensus_test.bam", "4", 96549060, 96549060+2000), 
+    ("data/illumina.bam", "4", 96549060, 96549060+2000),
+    # overlapping mates with deletions
+    ("../examples/data/10x.chr14.bam", "chr14", 66908564, 66913564)])
+def test_tally_matches_pileup(bam_path, chrom, start, end):
+    bam = pysam.AlignmentFile(bam_path)
+
+    pileup_consensus = _pileup_consensus(bam, chrom, start, end)
+
+    consensus = MismatchCounts(chrom, start, end)
+    consensus.tally_reads(bam)
+
+    assert (pileup_consensus.counts == consensus.counts).all()
+    assert (pileup_consensus.insertions == consensus.insertions).all()
+
+
+def test_consensus_thresholds():
+    consensus = MismatchCounts("4", 100, 110)
+    for i in range(8):
+        consensus.add_count(105, "A")
+    for i in range(2):
+        consensus.add_count(105, "C")
+    consensus.add_count(105, "DEL")
+
+    assert consensus.supported("A", 105)
+    assert not consensus.supported("C", 105)
+    assert not consensus.supported("DEL", 105)
+    assert not consensus.supported("A", 104)
+    assert consensus.query("A", 103, 106)
+
+    consensus.thresholds["C"] = 0.1
+    assert consensus.supported("C", 105)
+    assert consensus.mask("C").sum() == 1
+
+
+def test_chunked_counts():
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    start, end = 96549060, 96549060+2000
+
+    dense = MismatchCounts("4", start, end)
+    dense.tally_reads(bam)
+
+    chunked = MismatchCounts("4", start, end, chunk_size=300)
+    chunked.tally_reads(bam)
+
+    assert (dense.counts == chunked.counts).all()
+    assert (dense.insertions == chunked.insertions).all()
+    assert (dense.mask("A") == chunked.mask("A")).all()
+    assert dense.counts.max() < 256
+    assert dense.nbytes <= MismatchCounts.estimate_nbytes(end-start, dense.counts.max())
+
+
+def test_batched_tally():
+    bam = pysam.AlignmentFile("data/illumina.bam")
+    start, end = 96549060, 96549060+2000
+    reads = list(bam.fetch("4", start, end))
+
+    whole = MismatchCounts("4", start, end)
+    whole.tally_alignments(reads)
+
+    batched = MismatchCounts("4", start, end)
+    batched.max_batch_bases = 1000
+    batched.tally_alignments(reads)
+
+    assert (whole.counts == batched.counts).all()
+    assert (whole.insertions == batched.insertions).all()
+
+
+def test_estimate_nbytes():
+    # deeper coverage needs wider counts
+    assert MismatchCounts.estimate_nbytes(10**6, 300) > MismatchCounts.estimate_nbytes(10**6, 30)
+    # temporaries for aligned bases are bounded by the batch size
+    assert MismatchCounts.estimate_nbytes(10**6, 30, 10**9) == MismatchCounts.estimate_nbytes(10**6, 30, 10**8)
+    assert MismatchCounts.estimate_nbytes(10**6, 30, 10**5) < MismatchCounts.estimate_nbytes(10**6, 30, 10**8)
+
+
+def test_counts_widen():
+    consensus = MismatchCounts("4", 100, 10**9)
+    for i in range(300):
+        consensus.add_count(500, "G")
+
+    assert consensus.nbytes < 2**20
+    assert consensus.supported("G", 500)
+    assert consensus.query("G", 499, 501)
+    assert not consensus.query("G", 501, 510)
+
+
+def test_add_count_outside_window():
+    consensus = MismatchCounts("4", 100, 200)
+    consensus.add_count(50, "A")
+    consensus.add_count(200, "A")
+    consensus.add_count(150, "A")
+
+    assert consensus.counts.sum() == 1
+
+
+def test_counts_read_only():
+    consensus = MismatchCounts("4", 100, 200)
+    consensus.add_count(150, "A")
+
+    counts = consensus.counts
+    assert consensus.counts is counts
+    with pytest.raises(ValueError):
+        counts[0, 50] += 1
+    with pytest.raises(ValueError):
+        consensus.insertions[50] = 1
+
+    # updating the counts replaces the snapshot
+    consensus.add_count(150, "A")
+    assert counts[0, 50] == 1 and consensus.counts[0, 50] == 2
@@ -0,0 +1,74 @@
+import io
+import numpy
+import re
+import struct
+import zlib
+
+import genomeview
+from genomeview.raster import Raster, write_png
+
+
+def _read_png(data):
+    assert data.startswith(b"\x89PNG\r\n\x1a\n")
+    chunks = {}
+    i = 8
+    while i < len(data):
+        length, kind = struct.unpack(">I4s", data[i:i+8])
+        chunks[kind] = data[i+8:i+8+length]
+        assert struct.unpack(">I", data[i+8+length:i+12+length])[0] == zlib.crc32(kind+chunks[kind])
+        i += 12 + length
+
+    width, height = struct.unpack(">II", chunks[b"IHDR"][:8])
+    rows = numpy.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=numpy.uint8).reshape(height, -1)
+    assert (rows[:, 0] == 0).all()
+    return rows[:, 1:].reshape(height, width, 4)
+
+
+def test_raster():
+    class Element:
+        name = "element"
+        def render(self, renderer):
+            yield from renderer.rects([10, 30], 10, 10, 10, fill=["red", "#0000ff"], stroke="none")
+            yield from renderer.line(0, 50, 200, 50, stroke="black")
+            yield from renderer.block_arrow(10, 60, 20, 10, 5, "right", fill="lime")
+            # outside of the clipped group
+            yield from renderer.rect(0, 0, 200, 5, fill="black")
+            yield from renderer.text(100, 90, "label")
+
+    backend = Raster()
+    list(backend.start_document(220, 100))
+    list(genomeview.svg.Renderer(backend, 10, 5, 200, 90).render(Element()))
+    pixels = backend.pixels()
+
+    assert pixels.shape == (100, 220, 4)
+    assert tuple(pixels[20, 25]) == (255, 0, 0, 255)
+    assert tuple(pixels[20, 45]) == (0, 0, 255, 255)
+    assert tuple(pixels[20, 35]) == (255, 255, 255, 255)
+    # a 1 pixel line centered on a pixel boundary is spread across both pixels
+    assert tuple(pixels[54, 100]) == tuple(pixels[55, 100]) == (128, 128, 128, 255)
+    assert tuple(pixels[70, 40]) == (0, 255, 0, 255)
+    assert tuple(pixels[2, 50]) == (255, 255, 255, 255)
+    assert (pixels[88:95, 100:130, 0] < 128).any()
+
+    outf = io.BytesIO()
+    write_png(pixels, outf)
+    assert (_read_png(outf.getvalue()) == pixels).all()
+
+
+def test_render_to_png():
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+1000, "+")
+    doc.add_view(view)
+    track = genomeview.SingleEndBAMTrack("data/illumina.bam", name="reads")
+    track.draw_mismatches = False
+    view.add_track(track)
+
+    outf = io.BytesIO()
+    genomeview.render_to_png(doc, outf, scale=2, draw_text=False)
+    pixels = _read_png(outf.getvalue())
+
+    height = int(re.search('height="([0-9]+)"', next(doc.render())).group(1))
+    assert pixels.shape == (height*2, 1800, 4)
+    assert (pixels[..., 3] == 255).all()
+    # some of the reads are drawn
+    assert (pixels[..., 2] > pixels[..., 0]).any()
@@ -0,0 +1,115 @@
+import numpy
+import re
+
+import genomeview
+from genomeview.svg import GraphicsBackend, Renderer, SVG
+
+
+def test_batched_primitives():
+    backend = SVG()
+    xs = numpy.array([1.234, 5.0, -0.5])
+    fills = ["red", "blue", None]
+
+    rects = list(backend.rects(xs, 2, xs*2, [3, 4, 5], fill=fills, stroke="none"))
+    expected = [tag for x, w, h, fill in zip(xs, xs*2, [3, 4, 5], fills)
+                for tag in backend.rect(x, 2, w, h, fill=fill, stroke="none")]
+    assert rects == ["\n".join(expected)]
+
+    # the default implementation draws each element in turn
+    assert list(GraphicsBackend.rects(backend, xs, 2, xs*2, [3, 4, 5], fill=fills, stroke="none")) == expected
+
+    lines = list(backend.lines(xs, xs, xs+1, 7, **{"stroke-width":1}))
+    expected = [tag for x in xs for tag in backend.line(x, x, x+1, 7, **{"stroke-width":1})]
+    assert lines == ["\n".join(expected)]
+
+    assert list(backend.rects([], [], [], [])) == []
+
+
+def test_renderer_indents_batches():
+    class Element:
+        name = "element"
+        def render(self, renderer):
+            yield from renderer.rects([0, 10], [0, 0], 5, 5)
+
+    renderer = Renderer(SVG(), 100, 0, 200, 20)
+    rendered = list(renderer.render(Element()))
+    assert rendered[3].startswith("   <rect x=\"100.00\"")
+    assert rendered[3].split("\n")[1].startswith("   <rect x=\"110.00\"")
+
+
+def _render(backend, draw):
+    class Element:
+        name = "element"
+        def render(self, renderer):
+            yield from draw(renderer)
+
+    return [line.strip() for line in Renderer(backend, 0, 0, 100, 100).render(Element())]
+
+
+def test_merge_paths():
+    def draw(renderer):
+        yield from renderer.rects([0, 20, 40], 0, 10, 10, fill="red", stroke="none")
+        # overlaps the second red rect, so must stay above it
+        yield from renderer.rect(25, 5, 10, 10, fill="blue", stroke="none")
+        yield from renderer.rect(28, 8, 10, 10, fill="red", stroke="none")
+        yield from renderer.lines([0, 0], [50, 60], [100, 100], [50, 60], stroke="gray")
+
+    merged = _render(SVG(merge_paths=True), draw)
+
+    assert merged[-1] == "</g>"
+    body = merged[3:-1]
+    assert body == [
+        '<path d="M0.00 0.00h10.00v10.00h-10.00zM20.00 0.00h10.00v10.00h-10.00zM40.00 0.00h10.00v10.00h-10.00z" fill="red" stroke="none" />',
+        '<path d="M0.00 50.00L100.00 50.00M0.00 60.00L100.00 60.00" fill="none" stroke="gray" />',
+        '<rect x="25.00" y="5.00" width="10.00" height="10.00" fill="blue" stroke="none" />',
+        '<rect x="28.00" y="8.00" width="10.00" height="10.00" fill="red" stroke="none" />']
+
+
+def test_shared_styles():
+    doc = genomeview.Document(900)
+    view = genomeview.GenomeView("chr4", 96549060, 96549060+1000, "+")
+    doc.add_view(view)
+    for name in ["first", "second"]:
+        track = genomeview.SingleEndBAMTrack("data/illumina.bam", name=name)
+        track.draw_mismatches = False
+        view.add_track(track)
+
+    doc.renderer = SVG(shared_styles=True)
+    svg = doc._repr_svg_()
+
+    # the label background filter is only defined once, and styles are defined as classes
+    assert svg.count("<filter") == 1
+    assert "<style>" in svg and re.search(' class="s[0-9]+"', svg)
+    assert ' fill="' not in svg.split("<style>")[0].split("</defs>")[-1]
+
+    # rendering again starts a new document (apart from the ids and class names)
+    def strip_ids(svg):
+        return re.sub("(clip_path_|solid|arrow|s)[0-9]+", r"\1", svg)
+    assert strip_ids(doc._repr_svg_()) == strip_ids(svg)
+
+    arrows = list(SVG(shared_styles=True).line_with_arrows(0, 5, 100, 5, n=4, color="red"))
+    assert sum(tag.startswith("<defs>") for tag in arrows) == 1
+    assert sum(tag.startswith("<use") for tag in arrows) == 4
+
+
+def test_ids_unique_across_documents():
+    # documents displayed in the same page (eg, a notebook) must not share ids or class names
+    def render(bg, color):
+        backend = SVG(shared_styles=True)
+        lines = list(backend.start_document(100, 100))
+        lines.extend(backend.text_with_background(50, 50, "label", bg=bg))
+        lines.extend(backend.line_with_arrows(0, 5, 100, 5, n=2, color=color))
+        lines.extend(backend.rect(10, 10, 20, 20, fill=color))
+        lines.extend(backend.stop_document())
+        svg = "\n".join(lines)
+
+        ids = set(re.findall(' id="([^"]+)"', svg))
+        classes = set(re.findall(r"^ *\.([^ ]+) \{", svg, re.M))
+        assert ids and classes
+        return ids, classes
+
+    first_ids, first_classes = render("white", "red")
+    second_ids, second_classes = render("yellow", "blue")
+
+    assert not first_ids & second_ids
+    assert not first_classes & second_classes
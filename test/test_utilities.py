@@ -0,0 +1,92 @@
+import os
+import pysam
+
+from genomeview import utilities
+
+
+def test_alignment_file_pool():
+    pool = utilities.AlignmentFilePool(max_open=1)
+
+    illumina = pool.get("data/illumina.bam")
+    assert pool.get("data/illumina.bam") is illumina
+
+    pool.get("data/quick_consensus_test.bam")
+    assert len(pool) == 1
+    assert not illumina.is_open
+
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_alignment_file_pool_after_fork():
+    pool = utilities.AlignmentFilePool()
+    parent_handle = pool.get("data/illumina.bam")
+
+    # pretend that we've been forked into a child process
+    pool._pid = -1
+    child_handle = pool.get("data/illumina.bam")
+
+    assert child_handle is not parent_handle
+    assert parent_handle.is_open
+
+
+def test_decompression_threads():
+    pool = utilities.AlignmentFilePool()
+
+    single = pool.get("data/illumina.bam")
+    threaded = pool.get("data/illumina.bam", threads=2)
+    assert single is not threaded
+    assert pool.get("data/illumina.bam", threads=2) is threaded
+
+    try:
+        utilities.set_decompression_threads(2)
+        assert pool.get("data/illumina.bam") is threaded
+    finally:
+        utilities.set_decompression_threads(1)
+
+
+def test_probe_alignment_file(tmp_path):
+    import shutil
+
+    info = utilities.probe_alignment_file("data/illumina.bam", "chr4", 96549060, 96550000)
+    assert info.paired and not info.long_reads
+    assert utilities.probe_alignment_file("data/illumina.bam", "chr4", 96549060, 96550000) is info
+
+    # aligned with a long-read aligner, according to the header
+    info = utilities.probe_alignment_file("data/quick_consensus_test.bam")
+    assert not info.paired and info.long_reads
+
+    path = str(tmp_path / "copy.bam")
+    shutil.copy("data/illumina.bam", path)
+    shutil.copy("data/illumina.bam.bai", path + ".bai")
+    first = utilities.probe_alignment_file(path)
+    os.utime(path, (0, 0))
+    second = utilities.probe_alignment_file(path)
+    assert first == second and first is not second
+
+
+def test_probe_alignment_file_regions(tmp_path):
+    # paired short reads in one region, unpaired long reads in another
+    path = str(tmp_path / "mixed.bam")
+    header = {"HD":{"VN":"1.6", "SO":"coordinate"}, "SQ":[{"SN":"chr1", "LN":100000}]}
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for i, (start, length, flag) in enumerate([(100, 100, 0x1|0x2|0x20|0x40), (300, 100, 0x1|0x2|0x10|0x80), 
+                                                   (50000, 2000, 0)]):
+            read = pysam.AlignedSegment()
+            read.query_name = "read{}".format(i if flag == 0 else "pair")
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = [(0, length)]
+            read.query_sequence = "A" * length
+            if flag:
+                read.next_reference_id = 0
+                read.next_reference_start = 400 - start
+            bam.write(read)
+    pysam.index(path)
+
+    paired = utilities.probe_alignment_file(path, "chr1", 0, 1000)
+    long_reads = utilities.probe_alignment_file(path, "chr1", 49000, 53000)
+    assert paired.paired and not paired.long_reads
+    assert long_reads.long_reads and not long_reads.paired